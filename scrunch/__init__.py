@@ -1,13 +1,59 @@
-from .session import connect
-from .datasets import (
-    get_user, get_project, get_dataset, get_team, create_team)
-from .streaming_dataset import get_streaming_dataset
-from .mutable_dataset import get_mutable_dataset, create_dataset
+import importlib
+import pkgutil
+import sys
+
 from .version import __version__
 
 
+# Public names and the submodule defining them. They are imported on first
+# access (PEP 562) so `import scrunch` doesn't load requests, pycrunch and
+# the whole dataset machinery up front.
+_LAZY_ATTRIBUTES = {
+    'connect': 'session',
+    'get_user': 'datasets',
+    'get_project': 'datasets',
+    'get_dataset': 'datasets',
+    'get_team': 'datasets',
+    'create_team': 'datasets',
+    'get_streaming_dataset': 'streaming_dataset',
+    'get_mutable_dataset': 'mutable_dataset',
+    'create_dataset': 'mutable_dataset',
+}
+
+
 __all__ = [
     'connect', 'get_user', 'get_project', 'get_dataset', 'get_team',
     'get_streaming_dataset', 'get_mutable_dataset', 'create_team',
     'create_dataset', '__version__'
 ]
+
+
+def _submodules():
+    return [name for _, name, _ in pkgutil.iter_modules(__path__)]
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        # Submodules are attributes too, e.g. `scrunch.datasets`
+        if name.startswith('_') or name not in _submodules():
+            raise AttributeError(
+                "module %r has no attribute %r" % (__name__, name))
+        module = importlib.import_module(__name__ + '.' + name)
+        globals()[name] = module
+        return module
+    module = importlib.import_module('.' + module_name, __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES)
+                  | set(_submodules()))
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # No module level __getattr__, import everything eagerly
+    for _name in _LAZY_ATTRIBUTES:
+        __getattr__(_name)
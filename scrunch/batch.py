@@ -0,0 +1,159 @@
+# coding: utf-8
+
+"""
+Deferred dataset mutations, see BaseDataset.batch().
+"""
+
+import json
+from collections import OrderedDict
+
+from pycrunch.lemonpy import ClientError
+
+from scrunch.exceptions import BatchError
+from scrunch.helpers import shoji_catalog_wrapper
+from scrunch.metadata import invalidate as invalidate_metadata
+
+# Variable attributes the variables catalog accepts in a PATCH. Others are
+# sent to the variable entity, still one request per variable.
+CATALOG_ATTRIBUTES = frozenset(
+    ['name', 'alias', 'description', 'notes', 'discarded', 'view', 'format',
+     'uniform_basis'])
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def patch_variables(catalog, edits, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Sends `edits`, a {variable URL: {attribute: value}} mapping, to the
+    variables `catalog` as shoji:catalog PATCHes of `chunk_size` variables.
+    When the API rejects a chunk its variables are sent one at a time, so
+    a single bad edit doesn't fail the others. Other failures, like server
+    or connection errors, fail the whole chunk and the next one is still
+    sent.
+
+    Returns a {variable URL: exception} mapping of the failed edits.
+    """
+    failures = OrderedDict()
+    urls = list(edits)
+    for start in range(0, len(urls), chunk_size):
+        chunk = OrderedDict(
+            (url, edits[url]) for url in urls[start:start + chunk_size])
+        try:
+            catalog.patch(shoji_catalog_wrapper(chunk))
+            continue
+        except ClientError as exc:
+            if len(chunk) == 1:
+                failures.update((url, exc) for url in chunk)
+                continue
+        except Exception as exc:
+            failures.update((url, exc) for url in chunk)
+            continue
+        for url, attributes in chunk.items():
+            try:
+                catalog.patch(shoji_catalog_wrapper({url: attributes}))
+            except Exception as exc:
+                failures[url] = exc
+    return failures
+
+
+class DatasetBatch(object):
+    """
+    Mutations queued while a `with ds.batch():` block runs, sent when it
+    exits with as few requests as possible:
+
+    * Variable edits, hide and unhide are merged per variable and sent as
+      PATCHes to the variables catalog, `chunk_size` variables at a time.
+    * Category edits only send the final categories of each variable.
+    * Missing rules changes only send the final rules of each variable.
+    * Created variables are added to the local catalog from their POST
+      payload instead of being fetched one by one.
+
+    The variables catalog is reloaded once, after everything is sent.
+    """
+
+    def __init__(self, dataset, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+        # variable URL -> [Variable, {attribute: value}]
+        self.variable_edits = OrderedDict()
+        # variable URL -> [variable resource, categories]
+        self.category_edits = OrderedDict()
+        # variable URL -> [variable resource, rules]
+        self.missing_rules = OrderedDict()
+        self.created = 0
+
+    def __len__(self):
+        return (len(self.variable_edits) + len(self.category_edits)
+                + len(self.missing_rules))
+
+    def edit_variable(self, variable, **attributes):
+        if variable.url in self.variable_edits:
+            self.variable_edits[variable.url][1].update(attributes)
+        else:
+            self.variable_edits[variable.url] = [variable, attributes]
+
+    def edit_categories(self, resource, categories):
+        self.category_edits[resource.self] = [resource, categories]
+
+    def set_missing_rules(self, resource, rules):
+        self.missing_rules[resource.self] = [resource, rules]
+
+    def add_created(self):
+        self.created += 1
+
+    def flush(self):
+        """
+        Sends the queued mutations and reloads the variables catalog.
+
+        A failed request doesn't stop the others from being sent, they are
+        all reported at the end with a BatchError. The catalog is reloaded
+        in any case, to match what the server has.
+        """
+        errors = []
+        try:
+            catalog_edits = OrderedDict()
+            for url, (variable, attributes) in self.variable_edits.items():
+                entity_edits = dict(attributes)
+                if not variable.is_subvar:
+                    # Catalog tuple URLs may be relative to the catalog
+                    url = getattr(url, 'absolute', url)
+                    for key in CATALOG_ATTRIBUTES.intersection(attributes):
+                        catalog_edits.setdefault(url, {})[key] = \
+                            entity_edits.pop(key)
+                if entity_edits:
+                    try:
+                        variable.resource.edit(**entity_edits)
+                    except Exception as exc:
+                        errors.append((url, exc))
+
+            failures = patch_variables(
+                self.dataset._catalog, catalog_edits, self.chunk_size)
+            errors.extend(failures.items())
+
+            for url, (resource, categories) in self.category_edits.items():
+                try:
+                    resource.edit(categories=categories)
+                except Exception as exc:
+                    errors.append((url, exc))
+
+            for url, (resource, rules) in self.missing_rules.items():
+                try:
+                    result = resource.session.put(
+                        resource.fragments.missing_rules,
+                        json.dumps({'rules': rules}))
+                    assert result.status_code == 204
+                except Exception as exc:
+                    errors.append((url, exc))
+        finally:
+            if len(self) or self.created:
+                invalidate_metadata(self.dataset.resource.self)
+                self.dataset._reload_variables()
+            self.discard()
+        if errors:
+            raise BatchError(errors)
+
+    def discard(self):
+        self.variable_edits.clear()
+        self.category_edits.clear()
+        self.missing_rules.clear()
+        self.created = 0
@@ -0,0 +1,373 @@
+# coding: utf-8
+
+"""
+Caches for values that are expensive to fetch from the API.
+
+DiskCache keeps small values, like feature flags, across processes. Entries
+are JSON files, written atomically and readable only by the current user,
+that expire after a TTL. Any problem reading or writing the cache is
+treated as a miss.
+
+HTTPCache keeps GET responses that carry an ETag or Last-Modified header,
+so ScrunchSession can revalidate them with a conditional request and
+reuse the body when the API answers 304 Not Modified.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import six
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# os.replace overwrites on every platform, Python 2 only has os.rename
+_replace = getattr(os, "replace", os.rename)
+
+
+def cache_dir():
+    """
+    Directory holding scrunch's caches: $SCRUNCH_CACHE_DIR, or `scrunch`
+    under $XDG_CACHE_HOME (~/.cache by default).
+    """
+    path = os.environ.get("SCRUNCH_CACHE_DIR")
+    if not path:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache")
+        path = os.path.join(base, "scrunch")
+    return path
+
+
+class DiskCache(object):
+    """
+    JSON values stored under `cache_dir()/namespace`, one file per key,
+    named after the key's hash. A small `.key` file next to it holds the
+    key itself, so prefixes can be matched without reading the values.
+
+    :param namespace: Subdirectory for this kind of values.
+    :param ttl: Seconds an entry stays valid. 0 or None disables the cache.
+    :param path: Base directory, defaults to `cache_dir()`.
+    """
+
+    def __init__(self, namespace, ttl, path=None):
+        self.path = os.path.join(path or cache_dir(), namespace)
+        self.ttl = ttl
+
+    def _file(self, key, ext=".json"):
+        digest = hashlib.sha256(six.ensure_binary(key)).hexdigest()
+        return os.path.join(self.path, digest + ext)
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+        try:
+            with open(self._file(key)) as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get("expires", 0) < time.time():
+            return None
+        return entry.get("value")
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores `value`, valid for `ttl` seconds if given (capped to the
+        cache's own TTL) so values can expire earlier than the default.
+        """
+        if not self.ttl:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        entry = {"expires": time.time() + ttl, "value": value}
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            # The key goes first, so every entry can be found by prefix
+            self._write(self._file(key, ".key"), key)
+            self._write(self._file(key), json.dumps(entry))
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+
+    def _write(self, file_path, text):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(six.ensure_binary(text))
+            os.chmod(tmp_path, 0o600)
+            # Atomic, so readers never see a partial file
+            _replace(tmp_path, file_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def delete(self, key):
+        self._remove(self._file(key))
+        self._remove(self._file(key, ".key"))
+
+    def _names(self):
+        try:
+            return os.listdir(self.path)
+        except (IOError, OSError):
+            return []
+
+    def delete_prefix(self, prefix):
+        """
+        Deletes the entries whose key starts with `prefix`. Only the `.key`
+        files are read, the values are left alone.
+        """
+        names = set(self._names())
+        for name in names:
+            base, ext = os.path.splitext(name)
+            if ext == ".key":
+                try:
+                    with open(os.path.join(self.path, name), "rb") as fh:
+                        key = six.ensure_text(fh.read())
+                except (IOError, OSError, UnicodeDecodeError):
+                    key = None
+            elif ext == ".json" and base + ".key" not in names:
+                # No key to match it by, it may be under the prefix
+                key = None
+            else:
+                continue
+            if key is None or key.startswith(prefix):
+                self._remove(os.path.join(self.path, base + ".json"))
+                self._remove(os.path.join(self.path, base + ".key"))
+
+    def clear(self):
+        for name in self._names():
+            if name.endswith((".json", ".key")):
+                self._remove(os.path.join(self.path, name))
+
+    def _remove(self, file_path):
+        try:
+            os.remove(file_path)
+        except (IOError, OSError):
+            pass
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping holding at most `max_size` units, as measured by
+    `sizeof(value)` (1 per entry by default), evicting the least recently
+    used entries first.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value  # Most recently used goes last
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.size -= self.sizeof(self._data.pop(key))
+            if size > self.max_size:
+                return  # Would evict everything else and still not fit
+            self._data[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self.size -= self.sizeof(self._data.pop(key))
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            while self.size > self.max_size:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                self.size -= self.sizeof(self._data.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class CachedResponse(object):
+    """
+    What HTTPCache keeps of a response: enough to rebuild it and the
+    validators for the conditional request.
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = dict(headers)
+        self.content = content
+
+    @property
+    def validators(self):
+        headers = {}
+        stored = CaseInsensitiveDict(self.headers)
+        etag = stored.get("ETag")
+        if etag:
+            headers["If-None-Match"] = etag
+        last_modified = stored.get("Last-Modified")
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def to_json(self):
+        return {
+            "url": self.url,
+            "status_code": self.status_code,
+            "headers": self.headers,
+            "content": base64.b64encode(self.content).decode("ascii"),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["url"], data["status_code"], data["headers"],
+                   base64.b64decode(data["content"]))
+
+
+class HTTPCache(object):
+    """
+    Cache of GET responses for ScrunchSession, validated against the API
+    on every use, so it never serves stale documents.
+
+    :param max_bytes: Memory used by the cached bodies, least recently used
+        ones are dropped past it.
+    :param disk_ttl: When set, responses are also kept on disk (see
+        DiskCache) for that many seconds and shared between processes.
+    :param path: Base directory for the disk tier, defaults to
+        `cache_dir()`.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, disk_ttl=None, path=None):
+        self.memory = LRUCache(
+            max_bytes, sizeof=lambda cached: len(cached.content))
+        self.disk = DiskCache("http", disk_ttl, path) if disk_ttl else None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        cached = self.memory.get(url)
+        if cached is None and self.disk is not None:
+            data = self.disk.get(url)
+            if data is not None:
+                cached = CachedResponse.from_json(data)
+                self.memory.set(url, cached)
+        return cached
+
+    def set(self, url, response):
+        cached = CachedResponse(url, response.status_code, response.headers,
+                                response.content)
+        self.memory.set(url, cached)
+        if self.disk is not None:
+            self.disk.set(url, cached.to_json())
+
+    def invalidate(self, url):
+        """
+        Drops `url` and any URL under it (query strings, sub resources).
+        """
+        prefix = url.split("?", 1)[0]
+        self.memory.delete_prefix(prefix)
+        if self.disk is not None:
+            self.disk.delete_prefix(prefix)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
+def _is_cacheable(response):
+    if response.status_code != 200:
+        return False
+    if "no-store" in response.headers.get("Cache-Control", ""):
+        return False
+    return ("ETag" in response.headers
+            or "Last-Modified" in response.headers)
+
+
+class CachingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter answering GET requests through an HTTPCache: known URLs
+    are requested with If-None-Match/If-Modified-Since and a 304 reply is
+    turned into the cached 200 response before any response hook sees it.
+    Other methods are never cached and drop the cache entries of the URL
+    they modify. Streamed requests bypass the cache.
+    """
+
+    def __init__(self, cache, *args, **kwargs):
+        self.cache = cache
+        super(CachingHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != "GET":
+            if request.method not in ("HEAD", "OPTIONS"):
+                self.cache.invalidate(request.url)
+            return super(CachingHTTPAdapter, self).send(
+                request, stream=stream, **kwargs)
+        if stream:
+            return super(CachingHTTPAdapter, self).send(
+                request, stream=stream, **kwargs)
+
+        cached = self.cache.get(request.url)
+        if cached is not None:
+            request.headers.update(cached.validators)
+        response = super(CachingHTTPAdapter, self).send(
+            request, stream=stream, **kwargs)
+
+        if cached is not None and response.status_code == 304:
+            self.cache.hits += 1
+            return self._from_cache(cached, request, response)
+        self.cache.misses += 1
+        if _is_cacheable(response):
+            self.cache.set(request.url, response)
+        return response
+
+    def _from_cache(self, cached, request, not_modified):
+        response = Response()
+        response.status_code = cached.status_code
+        response.headers = CaseInsensitiveDict(cached.headers)
+        # The 304 may carry updated headers, like a new ETag
+        for name in ("ETag", "Last-Modified", "Date", "Set-Cookie"):
+            if name in not_modified.headers:
+                response.headers[name] = not_modified.headers[name]
+        response._content = cached.content
+        response._content_consumed = True
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = "OK"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = not_modified.elapsed
+        # Keeps cookies from the actual reply reaching the session's jar
+        response.raw = not_modified.raw
+        response.from_cache = True
+        return response
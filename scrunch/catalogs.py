@@ -0,0 +1,139 @@
+# coding: utf-8
+
+"""
+Incremental reading of the big documents of a dataset, its variables
+catalog and its `/table/?limit=0` metadata, for datasets with tens of
+thousands of variables where loading them whole takes gigabytes.
+
+Responses are streamed and, when the optional `ijson` package is
+installed (`pip install scrunch[streaming]`), parsed one entry at a time.
+Without it each response is still parsed in one go, so catalogs are best
+read in pages then.
+
+Sessions with an HTTP cache (`connect(..., http_cache=True)`) get these
+documents through it instead, not streamed: the cache keeps whole bodies
+in memory anyway, and revalidating them with their ETag spares the
+download when the dataset didn't change.
+"""
+
+import json
+
+import six
+from pycrunch.elements import Document
+
+from scrunch.cache import HTTPCache
+
+if six.PY2:  # pragma: no cover
+    from urlparse import urljoin
+else:
+    from urllib.parse import urljoin
+
+DEFAULT_PAGE_SIZE = 500
+
+# Bytes read from the response at a time when streaming
+CHUNK_SIZE = 64 * 1024
+
+
+def _ijson():
+    try:
+        import ijson
+    except ImportError:
+        return None
+    return ijson
+
+
+class _ResponseReader(object):
+    # File-like view of a streamed response body, for ijson
+    def __init__(self, response):
+        self._chunks = response.iter_content(CHUNK_SIZE)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _no_hook(response, *args, **kwargs):
+    return response
+
+
+def _get(session, url, params=None):
+    # pycrunch's response hook reads the whole body to build `.payload`,
+    # it's replaced (a None hook would fall back to the session's one) and
+    # only called for errors, to raise ClientError and ServerError
+    stream = not isinstance(getattr(session, 'http_cache', None), HTTPCache)
+    response = session.get(url, params=params, stream=stream,
+                           hooks={'response': _no_hook})
+    if response.status_code >= 400:
+        session.hooks['response'](response)
+    return response
+
+
+def iter_members(session, url, member, params=None):
+    """
+    Yields the (key, value) pairs of the `member` object (like `index` or
+    `metadata`) of the JSON document at `url`, without keeping the whole
+    document in memory when `ijson` is available.
+    """
+    response = _get(session, url, params)
+    try:
+        ijson = _ijson()
+        if ijson is None:
+            document = json.loads(response.content.decode('utf-8'))
+            for item in six.iteritems(document.get(member) or {}):
+                yield item
+            return
+        reader = _ResponseReader(response)
+        for item in ijson.kvitems(reader, member, use_float=True):
+            yield item
+    finally:
+        response.close()
+
+
+def iter_catalog(session, url, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Yields the (entity URL, tuple) pairs of the shoji:catalog at `url`,
+    requesting `page_size` entries at a time (`limit`/`offset` query
+    parameters). When the API sends the whole catalog regardless, it is
+    read only once.
+    """
+    offset = 0
+    first_url = None
+    while True:
+        params = {'limit': page_size, 'offset': offset}
+        count = 0
+        for key, var_tuple in iter_members(session, url, 'index', params):
+            entity_url = urljoin(url, key)
+            if count == 0:
+                if entity_url == first_url:
+                    return  # The API isn't paging, this is the first page
+                first_url = first_url or entity_url
+            count += 1
+            yield entity_url, var_tuple
+        if count != page_size:
+            # A short page is the last one, a longer one was not paged
+            return
+        offset += count
+
+
+def iter_table_metadata(resource):
+    """
+    Yields the (variable id, definition) pairs of the `/table/?limit=0`
+    metadata of a dataset resource, streamed when `ijson` is available.
+    """
+    if _ijson() is None or not isinstance(resource, Document):
+        table = resource.follow('table', 'limit=0')
+        for item in six.iteritems(table.metadata):
+            yield item
+        return
+    url = resource.void('table').self.rsplit('?', 1)[0]
+    for item in iter_members(resource.session, url, 'metadata',
+                             {'limit': 0}):
+        yield item
@@ -5,15 +5,34 @@ from six import PY2
 from scrunch.helpers import ReadOnly
 
 
+def _save_categories(resource, categories, batch=None):
+    """
+    Sends the new categories of a variable, or queues them when a dataset
+    batch is active.
+    """
+    if batch is not None:
+        resource.body['categories'] = categories
+        batch.edit_categories(resource, categories)
+        return
+    resource.edit(categories=categories)
+    resource.refresh()
+
+
 class Category(ReadOnly):
+    # Variables can have many categories, keep them small. As with
+    # Variable.__slots__ the saving is partial, the __dict__ slot keeps
+    # other attributes assignable.
+    __slots__ = ('resource', 'url', '_category', '_batch', '__dict__')
+
     _MUTABLE_ATTRIBUTES = {'name', 'numeric_value', 'missing', 'selected', 'date'}
     _IMMUTABLE_ATTRIBUTES = {'id'}
     _ENTITY_ATTRIBUTES = _MUTABLE_ATTRIBUTES | _IMMUTABLE_ATTRIBUTES
     _NULLABLE_ATTRIBUTES = {"date", "numeric_value", "selected"}
 
-    def __init__(self, variable_resource, category):
+    def __init__(self, variable_resource, category, batch=None):
         super(Category, self).__init__(variable_resource)
         self._category = category
+        self._batch = batch
 
     def __getattr__(self, item):
         if item in self._ENTITY_ATTRIBUTES:
@@ -58,8 +77,7 @@ class Category(ReadOnly):
 
         categories = [cat for cat in self.resource.body['categories']
                       if cat['id'] != self.id]
-        self.resource.edit(categories=categories)
-        self.resource.refresh()
+        _save_categories(self.resource, categories, self._batch)
 
     def edit(self, **kwargs):
         if self.resource.body.get('derivation'):
@@ -70,22 +88,24 @@ class Category(ReadOnly):
 
         categories = [self.as_dict(**kwargs) if cat['id'] == self.id else cat
                       for cat in self.resource.body['categories']]
-        self.resource.edit(categories=categories)
-        self.resource.refresh()
+        _save_categories(self.resource, categories, self._batch)
 
 
 class CategoryList(OrderedDict):
 
+    _batch = None
+
     @classmethod
-    def _from(cls, variable_resource):
+    def _from(cls, variable_resource, batch=None):
         cls.resource = variable_resource
-        categories = [(cat['id'], Category(variable_resource, cat))
+        categories = [(cat['id'], Category(variable_resource, cat, batch))
                       for cat in variable_resource.body['categories']]
-        return cls(categories)
+        category_list = cls(categories)
+        category_list._batch = batch
+        return category_list
 
     def order(self, *new_order):
         categories = sorted(
             self.resource.body['categories'], key=lambda c: new_order.index(c['id'])
         )
-        self.resource.edit(categories=categories)
-        self.resource.refresh()
+        _save_categories(self.resource, categories, self._batch)
@@ -2,8 +2,10 @@
 
 import os
 import six
+import time
 import logging
 import pycrunch
+from scrunch.cache import DiskCache
 from scrunch.session import connect
 from scrunch.exceptions import AuthenticationError
 
@@ -15,6 +17,14 @@ else:
 
 LOG = logging.getLogger('scrunch')
 
+DEFAULT_SITE_URL = 'https://app.crunch.io/api/'
+
+# Seconds a login token is reused across processes when the token cache is
+# enabled (CRUNCH_TOKEN_CACHE), unless the token cookie expires earlier.
+TOKEN_CACHE_TTL = int(os.environ.get('CRUNCH_TOKEN_CACHE_TTL', 12 * 60 * 60))
+
+_TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
 
 def _set_debug_log():
     # ref: http://docs.python-requests.org/en/master/api/#api-changes
@@ -36,10 +46,58 @@ def _set_debug_log():
     requests_log.propagate = True
 
 
+def _session_token(session):
+    """
+    Returns the login token cookie of an authenticated session and the
+    seconds it is still valid for (None if it has no expiry).
+    """
+    for cookie in session.cookies:
+        if cookie.name == 'token':
+            ttl = cookie.expires - time.time() if cookie.expires else None
+            return cookie.value, ttl
+    return None, None
+
+
+def _connect_with_token_cache(connection_kwargs):
+    """
+    Connects with username and password, reusing the login token another
+    process stored on disk for the same site and user. API key connections
+    don't log in, so they don't go through the cache.
+    """
+    site_url = connection_kwargs.get('site_url', DEFAULT_SITE_URL)
+    cache = DiskCache('tokens', TOKEN_CACHE_TTL)
+    key = '%s %s' % (site_url, connection_kwargs['username'])
+
+    token = cache.get(key)
+    if token:
+        try:
+            return connect(api_key=token, site_url=site_url)
+        except Exception:
+            LOG.debug('Cached token for %s was rejected, logging in', site_url)
+            cache.delete(key)
+
+    site = connect(**connection_kwargs)
+    token, ttl = _session_token(site.session)
+    if token and (ttl is None or ttl > 0):
+        cache.set(key, token, ttl=ttl)
+    return site
+
+
+def _connect(connection_kwargs, token_cache):
+    if token_cache and 'username' in connection_kwargs:
+        return _connect_with_token_cache(connection_kwargs)
+    return connect(**connection_kwargs)
+
+
 def _get_connection(file_path='crunch.ini'):
     """
     Utilitarian function that reads credentials from
     file or from ENV variables
+
+    Setting CRUNCH_TOKEN_CACHE (in the environment or the .ini file) to
+    true keeps the login token of username/password connections on disk,
+    readable only by the current user, so other processes skip the login
+    request until the token expires (see TOKEN_CACHE_TTL).
     """
     if pycrunch.session is not None:
         return pycrunch.session
@@ -47,6 +105,8 @@ def _get_connection(file_path='crunch.ini'):
     connection_kwargs = {}
 
     # try to get credentials from environment
+    token_cache = os.environ.get(
+        'CRUNCH_TOKEN_CACHE', '').strip().lower() in _TRUE_VALUES
     site = os.environ.get('CRUNCH_URL')
     if site:
         connection_kwargs["site_url"] = site
@@ -61,7 +121,7 @@ def _get_connection(file_path='crunch.ini'):
         connection_kwargs["pw"] = password
 
     if connection_kwargs:
-        return connect(**connection_kwargs)
+        return _connect(connection_kwargs, token_cache)
 
     # try reading from .ini file
     config = configparser.ConfigParser()
@@ -73,7 +133,6 @@ def _get_connection(file_path='crunch.ini'):
     else:
         connection_kwargs["site_url"] = site
 
-
     try:
         api_key = config.get('DEFAULT', 'CRUNCH_API_KEY')
     except Exception:
@@ -91,9 +150,15 @@ def _get_connection(file_path='crunch.ini'):
             connection_kwargs["username"] = username
             connection_kwargs["pw"] = password
 
+    try:
+        token_cache = token_cache or config.getboolean(
+            'DEFAULT', 'CRUNCH_TOKEN_CACHE')
+    except Exception:
+        pass  # Config not found in .ini file. Do not change env value
+
     # now try to login with obtained creds
     if connection_kwargs:
-        return connect(**connection_kwargs)
+        return _connect(connection_kwargs, token_cache)
     else:
         raise AuthenticationError(
             "Unable to find crunch session, crunch.ini file "
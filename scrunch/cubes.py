@@ -2,9 +2,7 @@ import six
 
 from pycrunch.cubes import fetch_cube, count
 from scrunch.datasets import Variable
-from scrunch.expressions import parse_expr, process_expr
-
-from cr.cube.cube import Cube
+from scrunch.expressions import _prepare_expr, process_expr
 
 
 def variable_to_url(variable, dataset):
@@ -15,8 +13,9 @@ def variable_to_url(variable, dataset):
     if isinstance(variable, Variable):
         return variable.url
     elif isinstance(variable, six.string_types):
-        if variable in dataset.keys():
-            return dataset[variable].url
+        var_tuple = dataset._variable_index.get(variable, keys=('alias',))
+        if var_tuple is not None:
+            return var_tuple.entity_url
     return variable
 
 
@@ -29,11 +28,14 @@ def crtabs(dataset, variables, weight=None, filter_=None, transforms=None, **mea
     :param filter_: Scrunch filter expression
     :param transforms: cr.cube transforms dictionary
     """
+    # cr.cube pulls in NumPy and SciPy, only load it when needed
+    from cr.cube.cube import Cube
+
     variables = [variable_to_url(var, dataset) for var in variables]
     if weight is not None:
         weight = variable_to_url(weight, dataset)
     if filter_ is not None:
-        filter_ = process_expr(parse_expr(filter_), dataset.resource)
+        filter_ = process_expr(_prepare_expr(filter_), dataset.resource)
 
     # if six.PY2:
     #     raise DeprecationWarning("Crunch Cube isn't supported in Python 2.x")
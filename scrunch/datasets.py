@@ -1,32 +1,34 @@
 import collections
+import contextlib
 import copy
 import datetime
 import json
 import re
 import sys
+from multiprocessing.pool import ThreadPool
 from warnings import warn
 from math import fsum
 
-try:
-    import pandas as pd
-except ImportError:
-    # pandas has not been installed, don't worry!
-    # ... unless you have to worry about pandas
-    pd = None
-
-
 import six
 
 import pycrunch
 import warnings
 from pycrunch import importing
+from pycrunch.lemonpy import URL
 from pycrunch.progress import DefaultProgressTracking
 from pycrunch.exporting import export_dataset
-from pycrunch.shoji import Entity, TaskProgressTimeoutError, TaskError
+from pycrunch.shoji import (Catalog, Entity, TaskProgressTimeoutError,
+                            TaskError, Tuple)
+from scrunch.batch import (CATALOG_ATTRIBUTES, DEFAULT_CHUNK_SIZE,
+                           DatasetBatch, patch_variables)
+from scrunch.catalogs import DEFAULT_PAGE_SIZE, iter_catalog
 from scrunch.categories import CategoryList
 from scrunch.exceptions import InvalidParamError, InvalidVariableTypeError
-from scrunch.expressions import parse_expr, prettify, process_expr
+from scrunch.expressions import (Expression, _prepare_expr, prettify,
+                                 process_expr, process_exprs)
 from scrunch.folders import DatasetFolders
+from scrunch.metadata import (DatasetMetadata, dataset_metadata,
+                              invalidate as invalidate_metadata)
 from scrunch.views import DatasetViews
 from scrunch.scripts import DatasetScripts, SystemScript
 from scrunch.helpers import (ReadOnly, _validate_category_rules, abs_url,
@@ -34,7 +36,8 @@ from scrunch.helpers import (ReadOnly, _validate_category_rules, abs_url,
                              subvar_alias, validate_categories, shoji_catalog_wrapper,
                              get_else_case, else_case_not_selected, SELECTED_ID,
                              NOT_SELECTED_ID, NO_DATA_ID, valid_categorical_date,
-                             generate_subvariable_codes, shoji_order_wrapper)
+                             generate_subvariable_codes, shoji_order_wrapper,
+                             import_pandas, AliasRegistry)
 from scrunch.order import DatasetVariablesOrder
 from scrunch.subentity import Deck, Filter, Multitable
 from scrunch.variables import (combinations_from_map, combine_categories_expr,
@@ -57,6 +60,14 @@ CATEGORICAL_TYPES = {
 }
 RESOLUTION_TYPES = ['Y', 'Q', 'M', 'W', 'D', 'h', 'm', 's', 'ms']
 
+# Variable attributes that are only read from the variable entity, never
+# from the catalog tuple, so `prefetch()` has to fetch entities for them.
+ENTITY_ONLY_FIELDS = frozenset(['categories', 'missing_rules'])
+
+# Concurrent GETs made by `prefetch()`, below the session's default
+# connection pool size.
+PREFETCH_WORKERS = 8
+
 
 class SavepointRestore:
     """
@@ -704,31 +715,106 @@ class DatasetSettings(dict):
     del __readonly__
 
 
+class VariableIndex(object):
+    """
+    The Tuples of a variables catalog keyed by alias, name, URL and id.
+    Built once per catalog load, so lookups don't walk the whole catalog
+    like `Catalog.by()` does on every call.
+    """
+
+    # Lookup precedence, same as DatasetVariablesMixin.__getitem__
+    KEYS = ('alias', 'name', 'url', 'id')
+
+    def __init__(self, catalog=None):
+        self._keys = {key: {} for key in self.KEYS}
+        index = getattr(catalog, 'index', None)
+        if isinstance(index, dict):
+            for url, var_tuple in six.iteritems(index):
+                self.add(url, var_tuple)
+
+    def __len__(self):
+        return len(self._keys['id'])
+
+    def add(self, url, var_tuple):
+        if var_tuple is None:
+            return
+        for key in ('alias', 'name', 'id'):
+            value = var_tuple.get(key)
+            if value is not None:
+                self._keys[key][value] = var_tuple
+        self._keys['url'][url] = var_tuple
+        entity_url = getattr(var_tuple, 'entity_url', None)
+        if entity_url:
+            self._keys['url'][entity_url] = var_tuple
+
+    def get(self, item, keys=KEYS):
+        for key in keys:
+            var_tuple = self._keys[key].get(item)
+            if var_tuple is not None:
+                return var_tuple
+        return None
+
+
 class DatasetVariablesMixin(Mapping):
     """
     Handles dataset variable iteration in a dict-like way
     """
+    __slots__ = ()
 
     def __getitem__(self, item):
         """
         Returns a Variable() instance, `item` can be either a variable alias,
-        name or URL
+        name, URL or id
         """
-        # Check if the attribute corresponds to a variable alias
+        variable = self._lookup_variable(item)
+        if variable is None:
+            # Variable doesn't exists, must raise a ValueError
+            raise ValueError(
+                'Entity %s has no (sub)variable with a name or alias %s'
+                % (self.name, item))
+        return self._make_variable(variable)
+
+    def _make_variable(self, var_tuple):
+        """
+        Returns the Variable for a catalog Tuple, reusing the one built
+        before for it when the dataset caches its variables.
+        """
+        # make sure we pass the parent dataset to subvariables
+        dataset = self.dataset if isinstance(self, Variable) else self
+        cache = getattr(dataset, '_variable_cache', None)
+        if not isinstance(cache, dict):
+            return Variable(var_tuple, dataset)
+        variable = cache.get(var_tuple.entity_url)
+        if variable is None or variable.shoji_tuple is not var_tuple:
+            variable = Variable(var_tuple, dataset)
+            cache[var_tuple.entity_url] = variable
+        return variable
+
+    def _lookup_variable(self, item):
+        """
+        Returns the catalog Tuple for a variable alias, name, URL or id, or
+        None if there is no such variable.
+        """
+        variable = self._variable_index.get(item)
+        if variable is not None:
+            return variable
+        # Not indexed, try the catalog itself, which also resolves URLs
+        # that are relative to it
+        if not self._catalog:
+            return None
         variable = self._catalog.by('alias').get(item)
         if variable is None:  # Not found by alias
             variable = self._catalog.by('name').get(item)
             if variable is None:  # Not found by name
                 variable = self._catalog.index.get(item)
-                if variable is None:  # Not found by URL
-                    # Variable doesn't exists, must raise a ValueError
-                    raise ValueError(
-                        'Entity %s has no (sub)variable with a name or alias %s'
-                        % (self.name, item))
-        # make sure we pass the parent dataset to subvariables
-        if isinstance(self, Variable):
-            return Variable(variable, self.dataset)
-        return Variable(variable, self)
+        return variable
+
+    @property
+    def _variable_index(self):
+        # Built on first lookup, so reloading the catalog stays cheap
+        if self._var_index is None:
+            self._var_index = VariableIndex(self._catalog)
+        return self._var_index
 
     def _set_catalog(self):
         self._catalog = self.resource.variables
@@ -740,7 +826,10 @@ class DatasetVariablesMixin(Mapping):
         """
         self._set_catalog()
         self._vars = self._catalog.index.items()
+        self._var_index = None
         self._order = None
+        if getattr(self, '_variable_cache', None) is not None:
+            self._variable_cache = {}
 
     @property
     def order(self):
@@ -757,16 +846,92 @@ class DatasetVariablesMixin(Mapping):
             self._order = DatasetVariablesOrder(self._catalog, order)
         return self._order
 
-    def _var_create_reload_return(self, payload):
+    def refresh_variables(self):
         """
-        helper function for POSTing to variables, reload
-        the catalog of variables and return newly created var
+        Downloads the variables catalog again, and the dataset metadata
+        when next needed. Variables created through scrunch are added to
+        the local catalog as they are created, this is only needed to see
+        changes made by other means.
         """
-        new_var = self.resource.variables.create(payload)
-        # needed to update the variables collection
+        invalidate_metadata(self.resource.self)
+        if getattr(self, '_alias_registry', None) is not None:
+            self._alias_registry = None
         self._reload_variables()
+
+    def _var_create_reload_return(self, payload):
+        """
+        helper function for POSTing to variables, add the new
+        variable to the local catalog and return it
+        """
+        new_var = self._variables_to_post().create(payload)
+        invalidate_metadata(self.resource.self)
+        batch = getattr(self, '_batch', None)
+        var_url = new_var['self']
+        if not isinstance(var_url, six.string_types):
+            # Not an entity URL the catalog can be keyed by, reload it and
+            # look the new variable up there as before
+            self._reload_variables()
+            return self[var_url]
+        if batch is not None:
+            # The catalog gets reloaded when the batch is done, use what
+            # was sent until then instead of fetching the variable
+            var_tuple = self._add_variable_tuple(var_url, new_var.body)
+            batch.add_created()
+        else:
+            var_tuple = self._add_variable_tuple(var_url)
+        self._register_aliases(var_tuple, payload)
         # return an instance of Variable
-        return self[new_var['self']]
+        return self._make_variable(var_tuple)
+
+    def _variables_to_post(self):
+        """
+        The variables catalog to POST new variables to. Reading
+        `resource.variables` GETs the whole catalog, so an empty Catalog
+        is made for its URL instead.
+        """
+        if not isinstance(self.resource, Entity):
+            return self.resource.variables
+        if 'variables' not in self.resource.get('catalogs', {}):
+            self.resource.refresh()
+        url = self.resource.catalogs['variables']
+        return Catalog(self.resource.session, self=url)
+
+    def _register_aliases(self, var_tuple, payload):
+        # Adds the aliases of a new variable, and of the subvariables it
+        # was created with, to the dataset's AliasRegistry if it's loaded
+        registry = getattr(self, '_alias_registry', None)
+        if not isinstance(registry, AliasRegistry):
+            return
+        registry.add(var_tuple.get('alias'))
+        body = payload.get('body') or {}
+        for alias in _reference_aliases(body.get('derivation')):
+            registry.add(alias)
+
+    def _add_variable_tuple(self, var_url, body=None):
+        """
+        Inserts the Tuple of a just created variable into the local catalog
+        and its index, fetching only the new variable instead of the whole
+        catalog again. When `body` is given it is used as is and nothing
+        is fetched.
+        """
+        index = self._catalog.index
+        session = self.resource.session
+        entity_url = URL(var_url, self._catalog.self)
+        if body is None:
+            entity = session.get(var_url).payload
+            var_tuple = Tuple(session, entity_url, **entity.body)
+            # Variable() needs the entity right away, don't fetch it twice
+            var_tuple._entity = entity
+        else:
+            var_tuple = Tuple(session, entity_url, **body)
+            # Variable() reads it, the entity would be fetched otherwise
+            var_tuple.setdefault('derived', 'derivation' in body)
+        index[var_url] = var_tuple
+        self._vars = index.items()
+        self._order = None
+        if self._var_index is not None:
+            self._var_index.add(var_url, var_tuple)
+        return var_tuple
 
     def __iter__(self):
         for var in self._vars:
@@ -777,7 +942,7 @@ class DatasetVariablesMixin(Mapping):
 
     def itervalues(self):
         for _, var_tuple in self._vars:
-            yield Variable(var_tuple, self)
+            yield self._make_variable(var_tuple)
 
     def iterkeys(self):
         """
@@ -819,6 +984,12 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
     _EDITABLE_SETTINGS = {'viewers_can_export', 'viewers_can_change_weight',
                           'viewers_can_share', 'dashboard_deck',
                           'variable_folders'}
+    # DatasetBatch collecting mutations while a `batch()` block runs
+    _batch = None
+    # {variable URL: Variable} when `cache_variables()` is on
+    _variable_cache = None
+    # AliasRegistry, loaded on first use
+    _alias_registry = None
 
     def __init__(self, resource):
         """
@@ -1061,6 +1232,210 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
 
         return self.resource.edit(**kwargs)
 
+    @contextlib.contextmanager
+    def batch(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Context manager deferring variable mutations until the block exits,
+        so they are sent with as few requests as possible:
+
+            with ds.batch():
+                for alias in aliases:
+                    ds[alias].edit(description='...')
+                    ds[alias].hide()
+
+        Queued are `Variable.edit()`, `hide()`, `unhide()`, missing rules
+        and category changes, which only take effect on the server once
+        the block is done. Variable creation is not grouped: each
+        `create_*` call still sends its own POST right away, the API has
+        no endpoint creating several variables at once. Only the catalog
+        reload that follows is deferred, to a single one at the end.
+        If the block raises, queued mutations are discarded. Requests
+        failing once it's done don't stop the others from being sent, a
+        BatchError reports them all at the end.
+
+        :param chunk_size: Max number of variables edited per request.
+        """
+        if self._batch is not None:
+            # Nested block, the outermost one sends everything
+            yield self._batch
+            return
+        batch = self._batch = DatasetBatch(self, chunk_size)
+        try:
+            yield batch
+        except Exception:
+            self._batch = None
+            batch.discard()
+            # Local values were updated as mutations were queued
+            self._reload_variables()
+            raise
+        self._batch = None
+        batch.flush()
+
+    @property
+    def alias_registry(self):
+        """
+        AliasRegistry of the variables and subvariables aliases in the
+        dataset, read from the table metadata once and kept up to date as
+        scrunch creates, renames and deletes variables. Used to generate
+        unique subvariable codes; `refresh_variables()` loads it again.
+        """
+        if self._alias_registry is None:
+            self._alias_registry = AliasRegistry(
+                self.variable_aliases(include_subvariables=True))
+        return self._alias_registry
+
+    def cache_variables(self, enabled=True):
+        """
+        Makes `ds[alias]`, `ds.values()` and friends return the same
+        Variable object every time for a given variable, instead of
+        building a new one on every access, until the variables catalog
+        is reloaded. Handy when iterating wide datasets many times.
+        """
+        self._variable_cache = {} if enabled else None
+
+    def edit_variables(self, edits, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Edits the attributes of many variables with a few requests to the
+        variables catalog, instead of one request per variable:
+
+            failed = ds.edit_variables({
+                'age': {'name': 'Age', 'description': 'Age in years'},
+                'gender': {'view': {'show_counts': True}},
+            })
+
+        Only the attributes the catalog accepts can be edited: `name`,
+        `description`, `notes`, `view`, `format`, `uniform_basis`,
+        `discarded` to hide or unhide variables and, where aliases can
+        change (like in `Variable.edit()`), `alias`. Others fail with an
+        AttributeError.
+
+        :param edits: {variable alias, name, URL or id: {attribute: value}}
+        :param chunk_size: Max number of variables edited per request.
+        :return: {variable: exception} for the edits that failed, either
+            here or on the server; the others are applied.
+        """
+        failures = collections.OrderedDict()
+        catalog_edits = collections.OrderedDict()
+        keys = {}
+        alias_mutable = self.resource.body.get('streaming') == 'no'
+        for key, attributes in edits.items():
+            var_tuple = self._lookup_variable(key)
+            if var_tuple is None:
+                failures[key] = ValueError(
+                    'Entity %s has no (sub)variable with a name or alias %s'
+                    % (self.name, key))
+                continue
+            allowed = CATALOG_ATTRIBUTES.difference(['alias'])
+            if alias_mutable and not var_tuple.get('derived'):
+                allowed = CATALOG_ATTRIBUTES
+            invalid = sorted(set(attributes) - allowed)
+            if invalid:
+                failures[key] = AttributeError(
+                    "Can't edit attribute %s of variable %s"
+                    % (', '.join(invalid), key))
+                continue
+            url = var_tuple.entity_url
+            url = getattr(url, 'absolute', url)
+            catalog_edits.setdefault(url, {}).update(attributes)
+            keys.setdefault(url, (key, var_tuple))
+
+        rejected = patch_variables(self._catalog, catalog_edits, chunk_size)
+        if catalog_edits:
+            invalidate_metadata(self.resource.self)
+        for url, attributes in catalog_edits.items():
+            key, var_tuple = keys[url]
+            if url in rejected:
+                failures[key] = rejected[url]
+                continue
+            if 'alias' in attributes and self._alias_registry is not None:
+                self._alias_registry.rename(
+                    var_tuple['alias'], attributes['alias'])
+            # Keep the local catalog in sync instead of reloading it
+            var_tuple.update(attributes)
+        if len(rejected) < len(catalog_edits):
+            self._var_index = None
+        return failures
+
+    def iter_variables(self, batch_size=DEFAULT_PAGE_SIZE):
+        """
+        Yields the variables of the dataset reading its variables catalog
+        `batch_size` entries at a time, streamed and parsed incrementally
+        when `ijson` is installed (see scrunch.catalogs). Unlike `values()`
+        the catalog is read again and never kept whole in memory, meant for
+        going once through datasets with a huge number of variables.
+        """
+        session = self.resource.session
+        url = self.resource.catalogs['variables']
+        for var_url, body in iter_catalog(session, url, batch_size):
+            # Tuples need a pycrunch URL to fetch their entity
+            var_url = URL(var_url, url)
+            yield Variable(Tuple(session, var_url, **body), self)
+
+    def prefetch(self, aliases=None, fields=None, max_workers=PREFETCH_WORKERS):
+        """
+        Loads the data of many variables at once, so reading their
+        attributes afterwards doesn't make one request per variable:
+
+            ds.prefetch(fields=['derived', 'subreferences'])
+            derived = [v.alias for v in ds.values() if v.derived]
+
+        When all the `fields` are in the dataset's table metadata they are
+        copied from it into the variables catalog with a single request.
+        Otherwise, or when no `fields` are given, the variable entities are
+        fetched with up to `max_workers` concurrent requests and kept in
+        the catalog, so `Variable.resource` doesn't fetch them again.
+
+        :param aliases: Variables to load, all of them by default.
+        :param fields: Attributes that will be read.
+        """
+        if aliases is None:
+            tuples = [var_tuple for _, var_tuple in self._vars]
+        else:
+            tuples = []
+            for alias in aliases:
+                var_tuple = self._lookup_variable(alias)
+                if var_tuple is None:
+                    raise ValueError(
+                        'Entity %s has no (sub)variable with a name or '
+                        'alias %s' % (self.name, alias))
+                tuples.append(var_tuple)
+        tuples = [t for t in tuples if getattr(t, '_entity', None) is None]
+        if fields is not None:
+            tuples = self._prefetch_from_table(tuples, set(fields))
+        if not tuples:
+            return
+        pool = ThreadPool(min(max_workers, len(tuples)))
+        try:
+            entities = pool.map(lambda var_tuple: var_tuple.fetch(), tuples)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        for var_tuple, entity in zip(tuples, entities):
+            var_tuple._entity = entity
+
+    def _prefetch_from_table(self, tuples, fields):
+        """
+        Copies `fields` from the table metadata into the catalog `tuples`
+        that lack them, returns the ones that still need their entity.
+        """
+        tuples = [t for t in tuples if not fields.issubset(t)]
+        if not tuples or fields & ENTITY_ONLY_FIELDS:
+            return tuples
+        metadata = dataset_metadata(self.resource).metadata
+        missing = []
+        for var_tuple in tuples:
+            var_metadata = metadata.get(var_tuple.get('id'))
+            if var_metadata is None or not fields.issubset(var_metadata):
+                missing.append(var_tuple)
+                continue
+            for field in fields:
+                var_tuple[field] = var_metadata[field]
+        return missing
+
     def add_user(self, user, edit=False):
         """
         :param user: email or User instance, or list/tuple of same
@@ -1120,9 +1495,6 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         :param description: Description of the new variable
         :return:
         """
-        if not hasattr(self.resource, 'variables'):
-            self.resource.refresh()
-
         # Pluck `else` case out.
         else_case = [c for c in variables if c["case"] == "else"]
         else_case = else_case[0] if else_case else {}
@@ -1149,9 +1521,8 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
                 ]
             }
         }]
-        exprs = [parse_expr(c["case"]) for c in variables]
-        exprs = process_expr(exprs, self.resource)
-        args.extend(exprs)
+        cases = [c["case"] for c in variables]
+        args.extend(process_exprs(cases, self.resource))
 
         if "name" in else_case:
             # We are in the else_case of a category. Add there the extra default
@@ -1204,9 +1575,6 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
             if 'numeric_value' not in cat:
                 cat['numeric_value'] = None
 
-        if not hasattr(self.resource, 'variables'):
-            self.resource.refresh()
-
         args = [{
             'column': [c['id'] for c in categories],
             'type': {
@@ -1228,11 +1596,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
                 numeric_value=None,
                 missing=True))
 
-        more_args = []
-        for case in cases:
-            more_args.append(parse_expr(case))
-
-        more_args = process_expr(more_args, self.resource)
+        more_args = process_exprs(cases, self.resource)
 
         expr = dict(function='case', args=args + more_args)
 
@@ -1278,11 +1642,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
             description=description,
             notes=notes))
 
-        new_var = self.resource.variables.create(payload)
-        # needed to update the variables collection
-        self._reload_variables()
-        # return the variable instance
-        return self[new_var['body']['alias']]
+        return self._var_create_reload_return(payload)
 
     def derive_multiple_response(self, categories, subvariables, name, alias,
         description='', notes='', uniform_basis=False):
@@ -1317,13 +1677,22 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         for subvar in subvariables:
             _validate_category_rules(categories, subvar['cases'])
 
+        # Cases of all the subvariables are processed together
+        cases = [
+            case
+            for subvar in subvariables
+            for case in subvar['cases'].values()
+            if isinstance(case, (six.string_types, Expression))
+        ]
+        cases = iter(process_exprs(cases, self.resource))
+
         responses_map = collections.OrderedDict()
         for subvar in subvariables:
-            _cases = []
-            for case in subvar['cases'].values():
-                if isinstance(case, six.string_types):
-                    _case = process_expr(parse_expr(case), self.resource)
-                    _cases.append(_case)
+            _cases = [
+                next(cases)
+                for case in subvar['cases'].values()
+                if isinstance(case, (six.string_types, Expression))
+            ]
 
             resp_id = '%04d' % subvar['id']
             responses_map[resp_id] = case_expr(
@@ -1357,13 +1726,16 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         """
         Creates a Multiple response (array) of only 2 categories, selected and not selected.
         """
-        responses_map = collections.OrderedDict()
+        cases = [get_else_case(resp['case'], responses) for resp in responses]
+        processed = iter(process_exprs(
+            [case for case in cases
+             if isinstance(case, (six.string_types, Expression))],
+            self.resource))
 
-        for resp in responses:
-            case = resp['case']
-            case = get_else_case(case, responses)
-            if isinstance(case, six.string_types):
-                case = process_expr(parse_expr(case), self.resource)
+        responses_map = collections.OrderedDict()
+        for resp, case in zip(responses, cases):
+            if isinstance(case, (six.string_types, Expression)):
+                case = next(processed)
 
             resp_id = '%04d' % resp['id']
             responses_map[resp_id] = case_expr(
@@ -1391,22 +1763,49 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         return self._var_create_reload_return(payload)
 
     def variable_aliases(self, include_subvariables=False):
-        existing_aliases = set()
-        # We have to fetch from the `/table/` endpoint because it includes
-        # the subvariables aliases.
-        variables_metadata = self.resource.table['metadata']
-        for var_tuple in variables_metadata.values():
-            var_alias = var_tuple["alias"]
-            existing_aliases.add(var_alias)
-            if include_subvariables and "subreferences" in var_tuple:
-                subreferences = var_tuple["subreferences"]
-                existing_aliases.update({sr["alias"] for sr in subreferences.values()})
-
-        return existing_aliases
+        # We have to use the `/table/` metadata because it includes the
+        # subvariables aliases.
+        return dataset_metadata(self.resource).variable_aliases(
+            include_subvariables)
+
+    def snapshot_schema(self, path):
+        """
+        Saves the dataset's table metadata, variables catalog, folders and
+        exclusion filter to `path` (gzipped if it ends in `.gz`), so aliases
+        and category ids can be resolved without the API:
+
+            ds.snapshot_schema('survey.jsonl.gz')
+            schema = DatasetMetadata.load('survey.jsonl.gz')
+            process_expr(parse_expr('gender in ["Male"]'), schema)
+
+        :return: The DatasetMetadata written.
+        """
+        current = dataset_metadata(self.resource)
+        catalog = collections.OrderedDict(
+            (var_tuple.entity_url.absolute, dict(var_tuple))
+            for _, var_tuple in self._vars)
+        exclusion = self.resource.exclusion
+        # The raw expression, prettify() would need the API to read it back
+        expr = None
+        if 'body' in exclusion:
+            expr = exclusion['body'].get('expression') or None
+        snapshot = DatasetMetadata(
+            current.metadata,
+            version=current.version,
+            catalog=catalog,
+            folders=self.folders.tree(),
+            exclusion=expr,
+            dataset={'id': self.id, 'name': self.name, 'url': self.url},
+        )
+        snapshot.dump(path)
+        return snapshot
 
     def get_url_by_alias(self, alias):
         # This helper allows to be mocked for tests rather than __getitem__
-        return self[alias].url
+        variable = self._lookup_variable(alias)
+        if variable is None:
+            return self[alias].url  # Raises the usual ValueError
+        return variable.entity_url
 
     def bind_categorical_array(self, name, alias, subvariables, description='',
         notes='', subvariable_codes=None):
@@ -1472,10 +1871,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         Used to create new numeric variables using Crunch's derived
         expressions
         """
-        expr = process_expr(parse_expr(derivation), self.resource)
-
-        if not hasattr(self.resource, 'variables'):
-            self.resource.refresh()
+        expr = process_expr(_prepare_expr(derivation), self.resource)
 
         payload = shoji_entity_wrapper(dict(
             alias=alias,
@@ -2145,11 +2541,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
             A DataFrame representation of all attributes from all forks
             on the given dataset.
         """
-        if pd is None:
-            raise ImportError(
-                "Pandas is not installed, please install it in your "
-                "environment to use this function."
-            )
+        pd = import_pandas()
 
         if len(self.resource.forks.index) == 0:
             return None
@@ -2234,7 +2626,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
 
         # Option for exporting metadata as json
         if metadata_path is not None:
-            metadata = self.resource.table['metadata']
+            metadata = dataset_metadata(self.resource).metadata
             if variables is not None:
                 if sys.version_info >= (3, 0):
                     metadata = {
@@ -2257,7 +2649,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
                 payload['filter'] = {'filter': filter.resource.self}
             else:
                 payload['filter'] = process_expr(
-                    parse_expr(filter), self.resource)
+                    _prepare_expr(filter), self.resource)
 
         # convert variable list to crunch identifiers
         if variables and isinstance(variables, list):
@@ -2312,8 +2704,8 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         it as both query filter and exclusion at the same time will result in 0
         rows.
         """
-        if isinstance(expr, six.string_types):
-            expr_obj = parse_expr(expr)
+        if isinstance(expr, (six.string_types, Expression)):
+            expr_obj = _prepare_expr(expr)
             # cause we need URLs
             expr_obj = process_expr(expr_obj, self.resource)
         elif expr is None:
@@ -2334,7 +2726,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         return prettify(expr, self) if expr else None
 
     def add_filter(self, name, expr, public=False):
-        expression = process_expr(parse_expr(expr), self.resource)
+        expression = process_expr(_prepare_expr(expr), self.resource)
         payload = shoji_entity_wrapper(dict(
             name=name,
             expression=expression,
@@ -2468,7 +2860,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
                 else:
                     payload['variables'][self[alias].id] = {'value': val}
         if filter:
-            payload['filter'] = process_expr(parse_expr(filter), self.resource)
+            payload['filter'] = process_expr(_prepare_expr(filter), self.resource)
 
         # Remove query parameters from table url
         table = self.resource.table
@@ -2502,7 +2894,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         csv_fh.seek(0)
 
         if rows_filter is not None:
-            rows_filter = process_expr(parse_expr(rows_filter), self.resource)
+            rows_filter = process_expr(_prepare_expr(rows_filter), self.resource)
         back_filler = BackfillFromCSV(self, pk_alias, aliases, rows_filter, timeout)
         back_filler.execute(csv_fh)
 
@@ -2526,20 +2918,20 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         ds = self
         if streaming_state != 'streaming':
             ds = self.make_streaming()
-        importer = pycrunch.importing.Importer()
+        from scrunch.streaming_dataset import columnar_ldjson, stream_ldjson
+        pd = import_pandas()
         df_chunks = pd.read_csv(
             filename,
             header=0,
             chunksize=chunksize
         )
         for chunk in df_chunks:
-            # This is a trick to get rid of np.int64, which is not
-            # json serializable
-            stream = chunk.to_json(orient='records')
-            stream = json.loads(stream)
+            # Serialize the whole chunk at once, pandas takes care of the
+            # np.int64 and friends which are not json serializable
+            stream = list(columnar_ldjson(chunk, chunksize))
             # trap the timeout and allow it to finish
             try:
-                importer.stream_rows(self.resource, stream)
+                stream_ldjson(self.resource, stream)
                 # We force the row push to instantly see any errors in the data
                 # and to allow changing to streaming status back to it's previous
                 # state
@@ -2633,6 +3025,8 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         """
         # build template payload
         parsed_template = []
+        # Expression queries, processed together after the loop
+        expr_queries = []
 
         for q in template:
             processed = False
@@ -2644,12 +3038,14 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
             # the special case of q being a multiple_response variable alias,
             # we need to build a different payload
 
-            if q['query'] in self.keys():
+            var_tuple = None
+            if isinstance(q['query'], six.string_types):
+                var_tuple = self._variable_index.get(q['query'], keys=('alias',))
+            if var_tuple is not None:
                 # this means is a variable in this dataset
-                var_alias = q['query']
-                var_url = self[var_alias].resource.self
+                var_url = var_tuple.entity_url.absolute
                 multi_types = 'multiple_response', 'categorical_array'
-                if self[var_alias].type in multi_types:
+                if var_tuple['type'] in multi_types:
                     as_json['query'] = [
                         {
                             'each': var_url
@@ -2674,14 +3070,18 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
                 processed = True
 
             if not processed:
-                parsed_q = process_expr(parse_expr(q['query']), self.resource)
-                # wrap the query in a list of one dict element
-                as_json['query'] = [parsed_q]
+                expr_queries.append((as_json, _prepare_expr(q['query'])))
             if 'transform' in q.keys():
                 as_json['transform'] = q['transform']
 
             parsed_template.append(as_json)
 
+        parsed_queries = process_exprs(
+            [query for _, query in expr_queries], self.resource)
+        for (as_json, _), parsed_q in zip(expr_queries, parsed_queries):
+            # wrap the query in a list of one dict element
+            as_json['query'] = [parsed_q]
+
         payload = shoji_entity_wrapper(dict(
             name=name,
             is_public=is_public,
@@ -2753,7 +3153,7 @@ class BaseDataset(ReadOnly, DatasetVariablesMixin):
         """
         :param: filter: An scrunch filter expression that matches rows to drop
         """
-        filters = process_expr(parse_expr(filter), self.resource)
+        filters = process_expr(_prepare_expr(filter), self.resource)
         payload = {
             'command': 'delete',
             'filter': filters,
@@ -2840,17 +3240,33 @@ class Dataset(BaseDataset):
 
 
 class DatasetSubvariablesMixin(DatasetVariablesMixin):
+    __slots__ = ()
 
     def _reload_variables(self):
         """
         Helper that takes care of updating self._vars on init and
-        whenever the dataset adds a variable
+        whenever the dataset adds a variable. The subvariables are only
+        loaded when used, finding them out needs the variable entity.
         """
-        self._vars = []
-        self._catalog = {}
-        if getattr(self.resource, 'subvariables', None):
-            self._catalog = self.resource.subvariables
-            self._vars = self._catalog.index.items()
+        self._subvariables = None
+        self._var_index = None
+
+    def _load_subvariables(self):
+        if self._subvariables is None:
+            catalog, variables = {}, []
+            if getattr(self.resource, 'subvariables', None):
+                catalog = self.resource.subvariables
+                variables = catalog.index.items()
+            self._subvariables = (catalog, variables)
+        return self._subvariables
+
+    @property
+    def _catalog(self):
+        return self._load_subvariables()[0]
+
+    @property
+    def _vars(self):
+        return self._load_subvariables()[1]
 
     def __iter__(self):
         if getattr(self.resource, 'subvariables', None):
@@ -2858,12 +3274,51 @@ class DatasetSubvariablesMixin(DatasetVariablesMixin):
                 yield (var_url, dict(self._vars)[var_url])
 
 
+def _reference_aliases(obj):
+    """
+    Yields the aliases a derivation gives to subvariables: the ones in
+    `references.subreferences` of arrays, and in the `references` of the
+    subvariable expressions of multiple responses built from a `map`.
+    """
+    if isinstance(obj, dict):
+        references = obj.get('references')
+        if isinstance(references, dict):
+            if references.get('alias') is not None:
+                yield references['alias']
+            for subreference in references.get('subreferences') or []:
+                if isinstance(subreference, dict):
+                    yield subreference.get('alias')
+        for key, value in obj.items():
+            if key != 'references':
+                for alias in _reference_aliases(value):
+                    yield alias
+    elif isinstance(obj, list):
+        for item in obj:
+            for alias in _reference_aliases(item):
+                yield alias
+
+
+def _put_missing_rules(resource, rules, batch=None):
+    """
+    Replaces the missing rules of a variable, or queues the change when
+    a dataset batch is active.
+    """
+    if batch is not None:
+        batch.set_missing_rules(resource, rules)
+        return
+    result = resource.session.put(
+        resource.fragments.missing_rules,
+        json.dumps({'rules': rules}))
+    assert result.status_code == 204
+
+
 class MissingRules(dict):
     """
     Handles variables missing rules in a dict fashion.
     del var.missing_rules['skipped']  --> deletes a missing rule
     var.missing_rules['not asked'] = 999  --> adds a missing rule
     """
+    _batch = None
 
     def __init__(self, resource, *args):
         self.resource = resource
@@ -2882,10 +3337,7 @@ class MissingRules(dict):
             if key == k:
                 data[k]['value'] = value
         # send the json to the missing_rules endpoint
-        result = self.resource.session.put(
-            self.resource.fragments.missing_rules,
-            json.dumps({'rules': data}))
-        assert result.status_code == 204
+        _put_missing_rules(self.resource, data, self._batch)
         super(MissingRules, self).__setitem__(key, value)
 
     def __delitem__(self, key):
@@ -2895,16 +3347,11 @@ class MissingRules(dict):
             # wrap value in a {'value': value} for crunch
             data[k] = {'value': v}
         del data[key]
-        result = self.resource.session.put(
-            self.resource.fragments.missing_rules,
-            json.dumps({'rules': data}))
-        assert result.status_code == 204
+        _put_missing_rules(self.resource, data, self._batch)
         super(MissingRules, self).__delitem__(key)
 
     def clear(self):
-        self.resource.session.put(
-            self.resource.fragments.missing_rules,
-            json.dumps({'rules': {}}))
+        _put_missing_rules(self.resource, {}, self._batch)
         super(MissingRules, self).clear()
 
 
@@ -2921,6 +3368,12 @@ class Variable(ReadOnly, DatasetSubvariablesMixin):
     _ENTITY_ATTRIBUTES = _MUTABLE_ATTRIBUTES | _IMMUTABLE_ATTRIBUTES
     _OVERRIDDEN_ATTRIBUTES = {'categories'}
 
+    # There is one Variable per variable access, keep them small. The
+    # saving is partial: the __dict__ slot keeps other attributes
+    # assignable, so every instance still carries a (lazily allocated) dict.
+    __slots__ = ('shoji_tuple', 'is_instance', '_resource', 'url', 'dataset',
+                 '_subvariables', '_var_index', '__dict__')
+
     def __init__(self, var_tuple, dataset):
         """
         :param var_tuple: A Shoji Tuple for a dataset variable
@@ -2945,6 +3398,12 @@ class Variable(ReadOnly, DatasetSubvariablesMixin):
     def is_subvar(self):
         return 'subvariables' in self.url
 
+    @property
+    def _batch(self):
+        # The DatasetBatch of the dataset, if a `batch()` block is running
+        batch = getattr(self.dataset, '_batch', None)
+        return batch if isinstance(batch, DatasetBatch) else None
+
     @property
     def resource(self):
         if not self.is_instance:
@@ -2970,8 +3429,32 @@ class Variable(ReadOnly, DatasetSubvariablesMixin):
                 raise AttributeError(
                     "Can't edit attribute %s of variable %s"
                     % (key, self.name))
+        batch = self._batch
+        if batch is not None:
+            self._queue_edit(batch, **kwargs)
+            return
+        alias = self.alias
         self.dataset._reload_variables()
-        return self.resource.edit(**kwargs)
+        resp = self.resource.edit(**kwargs)
+        invalidate_metadata(self.dataset.resource.self)
+        if 'alias' in kwargs:
+            self._rename_alias(alias, kwargs['alias'])
+        return resp
+
+    def _queue_edit(self, batch, **kwargs):
+        # Reflect the change locally, the server gets it when the batch ends
+        if 'alias' in kwargs:
+            self._rename_alias(self.alias, kwargs['alias'])
+        for key, value in kwargs.items():
+            self.shoji_tuple[key] = value
+            if self.is_instance:
+                self._resource.body[key] = value
+        batch.edit_variable(self, **kwargs)
+
+    def _rename_alias(self, alias, new_alias):
+        registry = getattr(self.dataset, '_alias_registry', None)
+        if isinstance(registry, AliasRegistry):
+            registry.rename(alias, new_alias)
 
     def __repr__(self):
         return "<Variable: name='{}'; id='{}'>".format(self.name, self.id)
@@ -2985,17 +3468,31 @@ class Variable(ReadOnly, DatasetSubvariablesMixin):
             raise TypeError(
                 "Variable of type %s do not have categories"
                 % self.resource.body.type)
-        return CategoryList._from(self.resource)
+        return CategoryList._from(self.resource, self._batch)
 
     def delete(self):
         self.resource.delete()
+        invalidate_metadata(self.dataset.resource.self)
+        registry = getattr(self.dataset, '_alias_registry', None)
+        if isinstance(registry, AliasRegistry):
+            registry.discard(self.alias)
         self.dataset._reload_variables()
 
     def hide(self):
+        batch = self._batch
+        if batch is not None:
+            self._queue_edit(batch, discarded=True)
+            return
         self.resource.edit(discarded=True)
+        invalidate_metadata(self.dataset.resource.self)
 
     def unhide(self):
+        batch = self._batch
+        if batch is not None:
+            self._queue_edit(batch, discarded=False)
+            return
         self.resource.edit(discarded=False)
+        invalidate_metadata(self.dataset.resource.self)
 
     def integrate(self):
         if self.derived:
@@ -3057,12 +3554,8 @@ class Variable(ReadOnly, DatasetSubvariablesMixin):
                 'value': {
                     'class': 'categorical',
                     'categories': categories}}}]
-        # build the expression
-        more_args = []
-        for rule in rules:
-            more_args.append(parse_expr(rule))
-        # get dataset and build the expression
-        more_args = process_expr(more_args, self.dataset)
+        # build the expression against the dataset
+        more_args = process_exprs(rules, self.dataset.resource)
         # epression value building
         expr = dict(function='case', args=args + more_args)
         payload = shoji_entity_wrapper(dict(expr=expr))
@@ -3097,10 +3590,18 @@ class Variable(ReadOnly, DatasetSubvariablesMixin):
                 "Variable of type %s do not have missing rules"
                 % self.resource.body.type)
 
-        result = self.resource.session.get(
-            self.resource.fragments.missing_rules)
-        assert result.status_code == 200
-        return MissingRules(self.resource, result.json()['body']['rules'])
+        batch = self._batch
+        queued = batch.missing_rules.get(self.resource.self) if batch else None
+        if queued is not None:
+            # The server doesn't have them yet, start from the queued ones
+            rules = MissingRules(self.resource, queued[1])
+        else:
+            result = self.resource.session.get(
+                self.resource.fragments.missing_rules)
+            assert result.status_code == 200
+            rules = MissingRules(self.resource, result.json()['body']['rules'])
+        rules._batch = batch
+        return rules
 
     def set_missing_rules(self, rules):
         """
@@ -3125,11 +3626,7 @@ class Variable(ReadOnly, DatasetSubvariablesMixin):
         for k, v in rules.items():
             # wrap value in a {'value': value} for crunch
             data[k] = {'value': v}
-        result = self.resource.session.put(
-            self.resource.fragments.missing_rules,
-            json.dumps({'rules': data})
-        )
-        assert result.status_code == 204
+        _put_missing_rules(self.resource, data, self._batch)
 
     def set_geodata_view(self, geodata, feature_key):
         """
@@ -3368,13 +3865,18 @@ class BackfillFromCSV:
         Returns a dict mapping each variable to its url and also
         fills it up for subvariables
         """
-        ds = self.dataset.resource
         alias_to_url = {}
-        for alias, vdef in ds.variables.by("alias").items():
-            alias_to_url[alias] = vdef.entity_url
-            if "subvariables" in vdef:
-                for sv_alias, svdef in vdef.entity.subvariables.by("alias").items():
-                    alias_to_url[sv_alias] = svdef.entity_url
+        # The subvariable ids come from the table metadata, so the array
+        # entities and subvariables catalogs aren't fetched one by one
+        variables = dataset_metadata(self.dataset.resource).variables
+        for _, vdef in self.dataset._vars:
+            alias_to_url[vdef["alias"]] = vdef.entity_url
+            if "subvariables" not in vdef:
+                continue
+            array = variables.get(vdef["alias"]) or {}
+            for sv_id, svdef in (array.get("subreferences") or {}).items():
+                alias_to_url[svdef["alias"]] = "%ssubvariables/%s/" % (
+                    vdef.entity_url, sv_id)
 
         return alias_to_url
 
@@ -28,3 +28,28 @@ class InvalidVariableTypeError(Exception):
 
 class InvalidParamError(Exception):
     pass
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of sending a request while the session's circuit
+    breaker is open after repeated transient API failures.
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super(CircuitOpenError, self).__init__(
+            "Crunch API is failing, not sending requests for the next "
+            "%.1f seconds" % retry_after)
+
+
+class BatchError(Exception):
+    """ Raised once a `ds.batch()` block has sent its mutations when some
+    of them failed, the others went through. `errors` lists the
+    (URL, exception) pairs of the failed ones.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(BatchError, self).__init__(
+            "%d batched mutations failed, first: %s: %s"
+            % (len(errors), errors[0][0], errors[0][1]))
@@ -39,28 +39,32 @@ the dataset. They are not yet ready to be sent to Crunch -- the API still
 needs some metadata-driven rewrites (subvariable -> parent+axes, category
 name -> id, array variable expansion, etc.). Those rewrites are applied
 by `process_expr` in a second pass, given a dataset entity.
+
+Filters applied to many datasets, like the waves of a tracker, can be
+wrapped in an `Expression`, parsed once and only processed again for
+datasets whose variables differ.
 """
 
 import ast
 import copy
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
 
 import six
 
 import scrunch
+from scrunch.cache import LRUCache
 from scrunch.helpers import is_number
+from scrunch.metadata import ARRAY_TYPES, dataset_metadata
 from scrunch.variables import validate_variable_url
 
 import sys
 
 GT_PY_311 = sys.version_info[:2] >= (3, 11)
 
-if six.PY2:
-    from urllib import urlencode
-else:
-    from urllib.parse import urlencode
-
-ARRAY_TYPES = ('categorical_array', 'multiple_response', 'numeric_array')
-
 CRUNCH_FUNC_MAP = {
     'valid': 'is_valid',
     'missing': 'is_missing',
@@ -170,14 +174,158 @@ def r(lower, upper):
     return list(range(lower, upper + 1))
 
 
+class FrozenDict(dict):
+    """
+    Read-only dict, as found in the expressions returned by `parse_expr`.
+    Copies made with `copy.deepcopy` are regular, mutable, dicts.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            "Parsed expressions are shared, use copy.deepcopy() to modify them")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict(
+            (key, copy.deepcopy(value, memo)) for key, value in self.items())
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class FrozenList(list):
+    """
+    Read-only list, the `list` counterpart of FrozenDict.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            "Parsed expressions are shared, use copy.deepcopy() to modify them")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = \
+        insert = pop = remove = clear = sort = reverse = _read_only
+    if six.PY2:  # pragma: no cover
+        __setslice__ = __delslice__ = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(value, memo) for value in self]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return FrozenDict((key, _freeze(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(_freeze(value) for value in obj)
+    return obj
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class ParseCache(object):
+    """
+    LRU cache of the expressions `parse_expr` returned, by expression
+    string, with hit/miss counters. A `max_size` of 0 disables it.
+    """
+
+    def __init__(self, max_size):
+        self.entries = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, expr):
+        parsed = self.entries.get(expr)
+        with self._lock:
+            if parsed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return parsed
+
+    def set(self, expr, parsed):
+        if self.entries.max_size:
+            self.entries.set(expr, parsed)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.entries.max_size,
+                         len(self.entries))
+
+    def clear(self):
+        self.entries.clear()
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def resize(self, max_size):
+        self.entries.resize(max_size)
+
+
+# Number of expression strings kept parsed, see `set_parse_cache_size()`
+PARSE_CACHE_SIZE = int(os.environ.get("SCRUNCH_PARSE_CACHE_SIZE", 1024))
+
+_parse_cache = ParseCache(PARSE_CACHE_SIZE)
+
+
+def set_parse_cache_size(max_size):
+    """
+    Sets how many parsed expressions `parse_expr` keeps, least recently
+    used ones are dropped first. 0 disables the cache.
+    """
+    _parse_cache.resize(max_size)
+
+
 def parse_expr(expr):
     """
     Converts a text python-like expression into ZCL tree.
 
-    :param expr: String with a python-like expression
+    Results are cached by expression string (see `set_parse_cache_size`,
+    `parse_expr.cache_info()` and `parse_expr.cache_clear()`) and shared
+    between callers, so they are read-only: `process_expr` works on a copy
+    and `copy.deepcopy` returns a mutable one.
+
+    :param expr: String with a python-like expression, or an Expression
     :return: Dictionary with a ZCL expression
     """
+    if expr is None:
+        return dict()
+
+    if isinstance(expr, Expression):
+        return expr.parsed
+    if not isinstance(expr, six.string_types):
+        return _freeze(_parse_expr(expr))
+    parsed = _parse_cache.get(expr)
+    if parsed is None:
+        parsed = _freeze(_parse_expr(expr))
+        _parse_cache.set(expr, parsed)
+    return parsed
+
+
+parse_expr.cache_info = _parse_cache.info
+parse_expr.cache_clear = _parse_cache.clear
 
+
+def _prepare_expr(expr):
+    """
+    `parse_expr` for expressions about to go through `process_expr`,
+    which reuses the bindings of Expression objects, so those are kept.
+    """
+    if isinstance(expr, Expression):
+        return expr
+    return parse_expr(expr)
+
+
+def _parse_expr(expr):
     def _var_term(_var_id):
         return {"var": _var_id}
 
@@ -445,48 +593,18 @@ def parse_expr(expr):
 
         return obj
 
-    if expr is None:
-        return dict()
-
     return _parse(ast.parse(expr, mode='eval'))
 
 
 def get_dataset_variables(ds):
     """
     Returns an Alias based dictionary pointing to a variable definition
-    from the /api/datasets/:id/table/ endpoint
+    from the /api/datasets/:id/table/ endpoint, see DatasetMetadata
 
     :param ds: Dataset() instance
     :return: Dictionary keyed by alias
     """
-    table = ds.follow("table", urlencode({
-        'limit': 0
-    }))
-
-    # Build the variables dict, using `alias` as the key.
-    variables = dict()
-    for _id, var in table.metadata.items():
-        var['id'] = _id
-        variables[var['alias']] = var
-
-        if var['type'] in ARRAY_TYPES:
-            subreferences = var.get('subreferences', {})
-            for subvar_id, subvar in subreferences.items():
-                subvar['is_subvar'] = True
-                subvar['id'] = subvar_id
-                subvar['parent_id'] = _id
-                subvar['type'] = 'categorical'
-                subvar['description'] = ''
-                if var.get("categories") is not None:
-                    # Numeric arrays do not have categories
-                    subvar['categories'] = var.get("categories")
-
-                # TODO: This is a problem when subvariable codes are reused
-                variables[subvar['alias']] = subvar
-                # Poorman's square bracket lookup
-                variables["%s[%s]" % (var["alias"], subvar['alias'])] = subvar
-
-    return variables
+    return dataset_metadata(ds).variables
 
 
 def get_subvariables_resource(var_url, var_index):
@@ -570,12 +688,21 @@ def process_expr(obj, ds):
       5. Array variable expansion: `Q2.any([1,2,3])` over an array gets
          expanded into an `or(...)` chain over its subvariables.
 
+    `Expression` objects are bound to the dataset instead, reusing their
+    result for datasets with the same layout.
+
     Aliases are NOT converted to URLs -- the API accepts alias-based `var`
     terms directly. Alias existence is validated here as a side-effect of
     the metadata lookups.
     """
 
-    variables = get_dataset_variables(ds)
+    if isinstance(obj, Expression):
+        return obj.bind(ds)
+
+    # Category names are resolved with the {name: id} index of the
+    # metadata, built once per variable
+    metadata = dataset_metadata(ds)
+    variables = metadata.variables
 
     def ensure_category_ids(subitems, values, arrays, variables=variables):
         """Replace category-name strings in value args with their numeric
@@ -584,45 +711,28 @@ def process_expr(obj, ds):
         _subitems = []
 
         def category_ids(var_alias, var_value, variables=variables):
-            value = None
+            var = variables.get(var_alias)
+            if var is None or 'categories' not in var or var['type'] == 'datetime':
+                # Nothing to resolve, return the original value(s)
+                return var_value
+            ids = metadata.category_ids(var_alias)
             if isinstance(var_value, list) or isinstance(var_value, tuple):
-                # {'values': [val1, val2, ...]}
+                # {'values': [val1, val2, ...]}, numbers are ids already.
+                # Names take the ids of every category they match, unknown
+                # names are left out.
                 value = []
                 for val in var_value:
                     if is_number(val):
-                        # val1 is an id already
                         value.append(val)
-                        continue
-                    for var in variables:
-                        if variables[var]['alias'] == var_alias:
-                            if 'categories' in variables[var]:
-                                for cat in variables[var]['categories']:
-                                    if cat['name'] == val:
-                                        value.append(cat['id'])
-                            else:
-                                # variable has no categories, return original
-                                # list of values
-                                value = var_value
+                    else:
+                        value.extend(ids.get(val, ()))
+                return value
             elif isinstance(var_value, str):
-                for va, var in variables.items():
-                    # if the variable is a date, don't try to process it's categories
-                    if var['type'] == 'datetime':
-                        return var_value
-                    if va == var_alias and 'categories' in var:
-                        found = False
-                        for cat in var['categories']:
-                            if cat['name'] == var_value:
-                                value = cat['id']
-                                found = True
-                                break
-                        if not found:
-                            raise ValueError("Couldn't find a category id for category %s in filter for variable %s" % (var_value, var))
-                    elif 'categories' not in variables[var['alias']]:
-                        return var_value
-
-            else:
-                return var_value
-            return value
+                if var_value not in ids:
+                    raise ValueError("Couldn't find a category id for category %s in filter for variable %s" % (var_value, var))
+                # The first category with that name
+                return ids[var_value][0]
+            return var_value
 
         # MR special case: use the table-derived variables map, not
         # ds.variables.index, because variables.index may only contain sparse
@@ -717,6 +827,16 @@ def process_expr(obj, ds):
             ]
         }
 
+    parents = {}
+
+    def _parents_by_ids():
+        # Built once per call, only when a subvariable is found
+        if not parents:
+            parents.update(
+                (v['id'], v) for v in variables.values()
+                if not v.get('is_subvar'))
+        return parents
+
     def _process(obj, variables):
         op = None
         arrays = []
@@ -727,7 +847,9 @@ def process_expr(obj, ds):
         array_var = None
 
         # === Walk children, collecting arrays / values / op ============
-        new_obj = copy.deepcopy(obj)
+        # `obj` is already a private copy (see below), a shallow copy is
+        # enough to rewrite this level
+        new_obj = dict(obj)
         for key, val in obj.items():
             if isinstance(val, dict) and "array" not in val:
                 # Nested ZCL expression -- recurse.
@@ -772,8 +894,7 @@ def process_expr(obj, ds):
                 if not var:
                     raise ValueError("Invalid variable alias '%s'" % val)
                 if var.get('is_subvar'):
-                    parents_by_ids = {v['id']: v for v in variables.values() if not v.get('is_subvar')}
-                    parent = parents_by_ids[var['parent_id']]
+                    parent = _parents_by_ids()[var['parent_id']]
                     new_obj[key] = parent['alias']
                     new_obj['axes'] = [val]
             elif key == 'function':
@@ -796,13 +917,137 @@ def process_expr(obj, ds):
 
         return obj
 
+    # The input is copied once here, `_process` rewrites the copy
     if isinstance(obj, list):
         return [
-            _process(copy.deepcopy(element), variables) for element in obj
+            element.bind(metadata) if isinstance(element, Expression)
+            else _process(copy.deepcopy(element), variables)
+            for element in obj
         ]
     return _process(copy.deepcopy(obj), variables)
 
 
+def process_exprs(exprs, ds):
+    """
+    Parses and processes a list of expressions for the dataset `ds` with a
+    single metadata lookup, for the builders taking one expression per
+    case, response or query. Items can be expression strings, `Expression`
+    objects or already parsed expressions.
+
+    :return: The processed expressions, in the same order
+    """
+    if not exprs:
+        return []  # No need for the metadata
+    metadata = dataset_metadata(ds)
+    return process_expr([
+        parse_expr(expr) if isinstance(expr, six.string_types) else expr
+        for expr in exprs
+    ], metadata)
+
+
+def _referenced_aliases(obj, aliases=None):
+    # Aliases of the `var` terms of a parsed expression
+    if aliases is None:
+        aliases = set()
+    if isinstance(obj, dict):
+        if isinstance(obj.get('var'), six.string_types):
+            aliases.add(obj['var'])
+        for value in obj.values():
+            _referenced_aliases(value, aliases)
+    elif isinstance(obj, list):
+        for value in obj:
+            _referenced_aliases(value, aliases)
+    return aliases
+
+
+def _variable_layout(var):
+    # What `process_expr` reads of a variable: its type, categories and
+    # subvariables. Names, descriptions and the like don't matter.
+    categories = [
+        [cat.get('id'), cat.get('name'), cat.get('selected', False)]
+        for cat in var.get('categories') or []
+    ]
+    subreferences = var.get('subreferences') or {}
+    subvariables = [
+        [subvar_id, subreferences[subvar_id]['alias']]
+        for subvar_id in var.get('subvariables') or sorted(subreferences)
+        if subvar_id in subreferences
+    ]
+    return [var['alias'], var['type'], categories, subvariables]
+
+
+def schema_fingerprint(ds, aliases):
+    """
+    Returns a digest of the layout of the variables `aliases` in the
+    dataset (or DatasetMetadata) `ds`: their types, categories and
+    subvariables, along with those of the arrays of subvariables. Two
+    datasets with the same fingerprint get the same `process_expr` result
+    for expressions only referring to these aliases.
+    """
+    metadata = dataset_metadata(ds)
+    layouts = []
+    for alias in sorted(aliases):
+        var = metadata.variables.get(alias)
+        if var is None:
+            layouts.append([alias, None])
+            continue
+        if var.get('is_subvar'):
+            parent = metadata.metadata[var['parent_id']]
+            var = metadata.variables[parent['alias']]
+        layouts.append([alias, _variable_layout(var)])
+    layouts = json.dumps(layouts, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(layouts).hexdigest()
+
+
+class Expression(object):
+    """
+    An expression parsed once and applied to any number of datasets:
+
+        expr = Expression('gender == "Male" and age > 30')
+        for ds in waves:
+            ds.exclude(expr)
+
+    Wherever scrunch takes a filter expression string, an Expression can
+    be used instead. `bind(ds)` returns the `process_expr` result for a
+    dataset, which is only computed again when the variables the
+    expression refers to have a different layout (type, categories or
+    subvariables, see `schema_fingerprint()`) than in the datasets it was
+    already bound to. Results are shared, so read-only like the ones of
+    `parse_expr`.
+    """
+
+    # Layouts an expression keeps the result of
+    MAX_BINDINGS = 32
+
+    def __init__(self, expr, max_bindings=MAX_BINDINGS):
+        self.expr = expr
+        self.parsed = parse_expr(expr)
+        self.aliases = frozenset(_referenced_aliases(self.parsed))
+        self._bindings = LRUCache(max_bindings)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.expr)
+
+    def __str__(self):
+        return str(self.expr)
+
+    def fingerprint(self, ds):
+        return schema_fingerprint(ds, self.aliases)
+
+    def bind(self, ds):
+        """
+        Returns the expression processed for `ds`, a dataset resource or
+        a DatasetMetadata.
+        """
+        metadata = dataset_metadata(ds)
+        fingerprint = self.fingerprint(metadata)
+        processed = self._bindings.get(fingerprint)
+        if processed is None:
+            processed = _freeze(process_expr(self.parsed, metadata))
+            self._bindings.set(fingerprint, processed)
+        return processed
+
+
 def clean_integer(value):
     """It cleans values that are `floats` but can be integers"""
     if isinstance(value, float) and value.is_integer():
@@ -201,6 +201,20 @@ class Folder(object):
         self.folder_ent.refresh()
 
 
+def _folder_tree(folder_ent):
+    index = folder_ent.index
+    children = []
+    for item_url in folder_ent.graph:
+        if item_url not in index:
+            continue
+        item_tup = index[item_url]
+        if item_tup['type'] == 'folder':
+            children.append(_folder_tree(item_tup.entity))
+        else:
+            children.append(item_tup['alias'])
+    return {'name': folder_ent.body.name, 'children': children}
+
+
 class DatasetFolders(object):
     def __init__(self, dataset):
         self.dataset = dataset
@@ -221,6 +235,20 @@ class DatasetFolders(object):
     def get(self, path):
         return self.public.get(path)
 
+    def tree(self):
+        """
+        Returns the folders hierarchy as nested
+        {'name': name, 'children': [variable alias or subfolder, ...]}
+        dicts, keyed by 'public', 'hidden' and 'secure' when available.
+        """
+        tree = {}
+        for name in ('public', 'hidden', 'secure'):
+            folder = getattr(self, name, None)
+            if folder is not None:
+                folder.folder_ent.refresh()  # Always up to date
+                tree[name] = _folder_tree(folder.folder_ent)
+        return tree
+
     def __getitem__(self, path):
         return self.public.get(path)
 
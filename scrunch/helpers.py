@@ -24,6 +24,9 @@ class ReadOnly(object):
     """
     class for protecting undesired writes to attributes
     """
+    # Lets subclasses declare __slots__ of their own
+    __slots__ = ()
+
     def __init__(self, resource):
         # need to call parent to make sure we call other mixin's __init__
         object.__setattr__(self, "resource", resource)
@@ -320,16 +323,79 @@ def make_unique(proposed, existing_values):
     return new_val
 
 
+def _split_suffix(alias):
+    # "alias__2" -> ("alias", 2), None as suffix when there isn't one
+    base_alias, sep, suffix = alias.rpartition("__")
+    if sep and suffix.isdigit():
+        return base_alias, int(suffix)
+    return alias, None
+
+
+class AliasRegistry(object):
+    """
+    The aliases in use in a dataset, variables and subvariables, along with
+    the highest `__N` suffix taken for each base alias, so `unique()` finds
+    a free alias right away instead of probing `__1`, `__2`... like
+    `make_unique()` does.
+
+    Datasets keep one (see `BaseDataset.alias_registry`) loaded once from
+    the table metadata and updated as scrunch creates, renames and deletes
+    variables.
+    """
+
+    def __init__(self, aliases=()):
+        self.aliases = set()
+        # base alias -> highest __N suffix in use
+        self.suffixes = {}
+        for alias in aliases:
+            self.add(alias)
+
+    def __contains__(self, alias):
+        return alias in self.aliases
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def add(self, alias):
+        if alias is None:
+            return
+        self.aliases.add(alias)
+        base_alias, suffix = _split_suffix(alias)
+        if suffix is not None and suffix > self.suffixes.get(base_alias, 0):
+            self.suffixes[base_alias] = suffix
+
+    def discard(self, alias):
+        # Suffix counters are left as they are, they only need to be high
+        # enough
+        self.aliases.discard(alias)
+
+    def rename(self, old_alias, new_alias):
+        self.discard(old_alias)
+        self.add(new_alias)
+
+    def unique(self, proposed):
+        """
+        Returns `proposed`, or a `__N` suffixed version of it when taken,
+        and registers it as in use.
+        """
+        new_alias = proposed
+        if proposed in self.aliases:
+            base_alias, suffix = _split_suffix(proposed)
+            new_alias = "%s__%d" % (
+                base_alias, self.suffixes.get(base_alias, 0) + 1)
+        self.add(new_alias)
+        return new_alias
+
+
 def generate_subvariable_codes(dataset, subvariables):
     # The user did not provide the subvariable codes to use in this
-    # new array. Then we do the expensive bit of computing them.
-    existing_aliases = dataset.variable_aliases(include_subvariables=True)
-    subvariable_codes = []
-    for subvar in subvariables:
-        unique_code = make_unique(subvar["alias"], existing_aliases)
-        existing_aliases.add(unique_code)
-        subvariable_codes.append(unique_code)
-    return subvariable_codes
+    # new array. Datasets keep their aliases at hand, anything else (like
+    # a DatasetMetadata snapshot) is asked for them.
+    registry = getattr(dataset, "alias_registry", None)
+    if not isinstance(registry, AliasRegistry):
+        registry = AliasRegistry(
+            dataset.variable_aliases(include_subvariables=True))
+    return [registry.unique(subvar["alias"]) for subvar in subvariables]
 
 
 def is_number(value):
@@ -338,3 +404,18 @@ def is_number(value):
         return True
     except (ValueError, TypeError):
         return False
+
+
+def import_pandas(purpose="use this function"):
+    """
+    Imports pandas on demand, so `import scrunch` stays fast for everyone
+    not working with DataFrames.
+    """
+    try:
+        import pandas
+    except ImportError:
+        raise ImportError(
+            "Pandas is not installed, please install it in your "
+            "environment to %s." % purpose
+        )
+    return pandas
@@ -0,0 +1,234 @@
+# coding: utf-8
+
+"""
+Snapshot of a dataset's variables metadata, as returned by its
+`/table/?limit=0` endpoint, shared by everything in scrunch that needs it
+(expressions, variable aliases, exports, dataset comparison) so it is
+downloaded once instead of once per call.
+
+A snapshot belongs to a dataset resource and is fetched again when:
+
+* The resource's `modification_time` changes, after a `refresh()`.
+* scrunch sends a request modifying the dataset, or anything under it,
+  through a ScrunchSession (see `invalidate()`). Variable creation and
+  edits, `edit_variables()` and batches invalidate it themselves too, so
+  datasets opened over plain pycrunch sessions don't go stale.
+* `invalidate()` is called for the dataset URL, for changes made by other
+  means, like `ds.refresh_variables()` does.
+
+Snapshots can also be saved with `ds.snapshot_schema(path)` and read back
+with `DatasetMetadata.load(path)`, to resolve aliases and category ids
+without the API, e.g. `process_expr(parse_expr(expr), snapshot)`.
+"""
+
+import gzip
+import io
+import json
+import threading
+from collections import OrderedDict
+
+import six
+
+ARRAY_TYPES = ('categorical_array', 'multiple_response', 'numeric_array')
+
+# First line of the files written by DatasetMetadata.dump()
+SNAPSHOT_FORMAT = 'scrunch-schema'
+SNAPSHOT_VERSION = 1
+
+# Dataset URL -> number of times it was invalidated
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+def _generation(dataset_url):
+    if not isinstance(dataset_url, six.string_types):
+        return 0
+    with _generations_lock:
+        return _generations.setdefault(dataset_url, 0)
+
+
+def invalidate(url):
+    """
+    Marks the snapshots of the dataset `url` belongs to as stale. `url`
+    can be the dataset URL or any URL under it (variables, folders...).
+    """
+    if not isinstance(url, six.string_types):
+        return
+    with _generations_lock:
+        for dataset_url in _generations:
+            if url.startswith(dataset_url):
+                _generations[dataset_url] += 1
+
+
+class DatasetMetadata(object):
+    """
+    The variables of a dataset keyed by id (`metadata`, as the API returns
+    them) along with the lookups built from them:
+
+    * `variables`: alias -> definition, subvariables included, also as
+      `array_alias[subvariable_alias]`.
+    * `parents`: subvariable alias -> array alias.
+    * `category_ids(alias)`: category name -> ids.
+
+    Snapshots saved to disk also carry the variables `catalog` (URL ->
+    tuple), the `folders` hierarchy, the `exclusion` expression and some
+    `dataset` attributes (id, name, URL).
+    """
+
+    def __init__(self, metadata, version=None, generation=0, catalog=None,
+                 folders=None, exclusion=None, dataset=None):
+        self.metadata = metadata
+        self.version = version
+        self.generation = generation
+        self.catalog = catalog
+        self.folders = folders
+        self.exclusion = exclusion
+        self.dataset = dataset
+        self.variables = {}
+        self.parents = {}
+        self._category_ids = {}
+        for var_id, var in metadata.items():
+            # Copies, `metadata` stays as the API returned it
+            var = dict(var, id=var_id)
+            self.variables[var['alias']] = var
+            if var['type'] not in ARRAY_TYPES:
+                continue
+            subreferences = var.get('subreferences') or {}
+            if subreferences:
+                # The array's own subreferences point to the annotated copies
+                var['subreferences'] = type(subreferences)()
+            for subvar_id, subvar in subreferences.items():
+                subvar = dict(
+                    subvar,
+                    is_subvar=True,
+                    id=subvar_id,
+                    parent_id=var_id,
+                    type='categorical',
+                    description='',
+                )
+                if var.get("categories") is not None:
+                    # Numeric arrays do not have categories
+                    subvar['categories'] = var.get("categories")
+                var['subreferences'][subvar_id] = subvar
+
+                # TODO: This is a problem when subvariable codes are reused
+                self.variables[subvar['alias']] = subvar
+                # Poorman's square bracket lookup
+                self.variables["%s[%s]" % (var["alias"], subvar['alias'])] = subvar
+                self.parents[subvar['alias']] = var['alias']
+
+    @classmethod
+    def fetch(cls, resource):
+        from scrunch.catalogs import iter_table_metadata
+
+        generation = _generation(resource.self)
+        metadata = OrderedDict(iter_table_metadata(resource))
+        return cls(metadata, _version(resource), generation)
+
+    def is_current(self, resource):
+        return (self.version == _version(resource)
+                and self.generation == _generation(resource.self))
+
+    def variable_aliases(self, include_subvariables=False):
+        # Same as BaseDataset.variable_aliases()
+        aliases = {var['alias'] for var in self.metadata.values()}
+        if include_subvariables:
+            aliases.update(self.parents)
+        return aliases
+
+    def category_ids(self, alias):
+        """
+        Returns the {category name: [ids]} mapping of a variable, empty for
+        variables without categories. Names shared by several categories
+        map to all their ids, in category order.
+        """
+        ids = self._category_ids.get(alias)
+        if ids is None:
+            ids = {}
+            for cat in self.variables[alias].get('categories') or []:
+                ids.setdefault(cat['name'], []).append(cat['id'])
+            self._category_ids[alias] = ids
+        return ids
+
+    def dump(self, path):
+        """
+        Writes the snapshot to `path` as JSON lines, one per variable,
+        gzipped when `path` ends in `.gz`.
+        """
+        with _open(path, 'wb') as f:
+            _write(f, {
+                'format': SNAPSHOT_FORMAT,
+                'version': SNAPSHOT_VERSION,
+                'dataset': self.dataset,
+                'modification_time': self.version,
+            })
+            for var_id, var in six.iteritems(self.metadata):
+                _write(f, {'table': var_id, 'metadata': var})
+            for url, var_tuple in six.iteritems(self.catalog or {}):
+                _write(f, {'variable': url, 'tuple': var_tuple})
+            _write(f, {'folders': self.folders})
+            _write(f, {'exclusion': self.exclusion})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a snapshot written by `dump()` or `ds.snapshot_schema()`.
+        """
+        header = None
+        metadata = OrderedDict()
+        catalog = OrderedDict()
+        extra = {}
+        with _open(path, 'rb') as f:
+            for line in f:
+                record = json.loads(line.decode('utf-8'))
+                if header is None:
+                    if record.get('format') != SNAPSHOT_FORMAT:
+                        break
+                    if record.get('version') != SNAPSHOT_VERSION:
+                        raise ValueError(
+                            'Unsupported schema snapshot version %s'
+                            % record.get('version'))
+                    header = record
+                elif 'table' in record:
+                    metadata[record['table']] = record['metadata']
+                elif 'variable' in record:
+                    catalog[record['variable']] = record['tuple']
+                else:
+                    extra.update(record)
+        if header is None:
+            raise ValueError('%s is not a schema snapshot' % path)
+        return cls(
+            metadata, version=header['modification_time'], catalog=catalog,
+            folders=extra.get('folders'), exclusion=extra.get('exclusion'),
+            dataset=header['dataset'])
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return io.open(path, mode)
+
+
+def _write(f, record):
+    f.write((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+
+
+def _version(resource):
+    body = getattr(resource, 'body', None) or {}
+    return body.get('modification_time')
+
+
+def dataset_metadata(resource):
+    """
+    Returns the DatasetMetadata of a dataset resource, only fetching it
+    when there is no current snapshot. Snapshots are returned as is, so
+    they can be used offline in place of a dataset.
+    """
+    if isinstance(resource, DatasetMetadata):
+        return resource
+    snapshot = getattr(resource, '_metadata_snapshot', None)
+    if isinstance(snapshot, DatasetMetadata) and snapshot.is_current(resource):
+        return snapshot
+    snapshot = DatasetMetadata.fetch(resource)
+    resource._metadata_snapshot = snapshot
+    return snapshot
@@ -0,0 +1,222 @@
+# coding: utf-8
+
+"""
+Instrumentation of the HTTP requests scrunch sessions make.
+
+Every request is recorded with its method, endpoint template (the URL path
+with IDs replaced by `{id}`), status, latency and bytes sent/received into
+the module level `registry`, which keeps counters and latency histograms:
+
+    import scrunch.metrics
+    scrunch.metrics.registry.counters  # {(method, endpoint, status): count}
+
+To look at a block of code, `collect()` gathers the requests made while it
+is active and summarizes them, which makes N+1 request patterns stand out:
+
+    with scrunch.metrics.collect() as summary:
+        ds = scrunch.get_dataset('My dataset')
+        ds.create_categorical(...)
+    print(summary.report())
+"""
+
+import bisect
+import contextlib
+import re
+import threading
+import time
+from collections import namedtuple
+
+import six
+
+if six.PY2:  # pragma: no cover
+    from urlparse import urlparse
+else:
+    from urllib.parse import urlparse
+
+
+# Latency buckets in seconds, upper bounds.
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+RequestRecord = namedtuple('RequestRecord', [
+    'method', 'endpoint', 'status', 'elapsed', 'bytes_sent', 'bytes_received',
+    'url',
+])
+
+_ID_SEGMENT = re.compile(
+    r'^(\d+|[0-9a-f]{32}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+    r'[0-9a-f]{12}|(?=[a-z]*\d)[0-9a-f]{6,})$'
+)
+
+
+def endpoint_template(url):
+    """
+    Returns the path of `url` with every ID segment (numbers, hex IDs and
+    UUIDs) replaced by `{id}`, so requests to the same endpoint on different
+    entities are grouped together:
+
+    https://app.crunch.io/api/datasets/2f8a9c.../variables/?limit=0
+        -> /api/datasets/{id}/variables/
+    """
+    path = urlparse(url).path
+    return '/'.join(
+        '{id}' if _ID_SEGMENT.match(segment) else segment
+        for segment in path.split('/')
+    )
+
+
+class Histogram(object):
+    """
+    Distribution of observed values over fixed buckets, plus their count,
+    sum, min and max.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # Last is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the `q` quantile, or the max seen
+        if it falls past the last bucket.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+class Metrics(object):
+    """
+    Thread safe counters and histograms of the recorded requests.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (method, endpoint, status) -> number of requests
+            self.counters = {}
+            # (method, endpoint) -> Histogram of latencies in seconds
+            self.histograms = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def record(self, record):
+        with self._lock:
+            key = (record.method, record.endpoint, record.status)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            key = (record.method, record.endpoint)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(record.elapsed)
+            self.bytes_sent += record.bytes_sent
+            self.bytes_received += record.bytes_received
+
+    @property
+    def total_requests(self):
+        return sum(self.counters.values())
+
+
+class Summary(object):
+    """
+    The requests recorded while a `collect()` block was active.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.started = time.time()
+        self.elapsed = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def by_endpoint(self):
+        """
+        Returns (method, endpoint, count, total seconds) tuples, most
+        requested first.
+        """
+        grouped = {}
+        for record in self.records:
+            key = (record.method, record.endpoint)
+            count, total = grouped.get(key, (0, 0.0))
+            grouped[key] = (count + 1, total + record.elapsed)
+        rows = [key + value for key, value in grouped.items()]
+        return sorted(rows, key=lambda row: (-row[2], -row[3]))
+
+    def report(self):
+        lines = ['%d requests, %.3fs in HTTP calls, %d bytes sent, '
+                 '%d bytes received' % (
+                     len(self.records),
+                     sum(r.elapsed for r in self.records),
+                     sum(r.bytes_sent for r in self.records),
+                     sum(r.bytes_received for r in self.records))]
+        for method, endpoint, count, total in self.by_endpoint():
+            lines.append('%6d %-7s %s (%.3fs)' % (count, method, endpoint, total))
+        return '\n'.join(lines)
+
+
+registry = Metrics()
+
+# Set to False to stop recording requests altogether.
+enabled = True
+
+_collectors = []
+_collectors_lock = threading.Lock()
+
+
+def record_request(method, url, status, elapsed, bytes_sent=0, bytes_received=0):
+    """
+    Records a finished HTTP request. `status` is None when no response was
+    received (connection errors, timeouts).
+    """
+    if not enabled:
+        return
+    record = RequestRecord(method.upper(), endpoint_template(url), status,
+                           elapsed, bytes_sent, bytes_received, url)
+    registry.record(record)
+    with _collectors_lock:
+        for summary in _collectors:
+            summary.records.append(record)
+
+
+@contextlib.contextmanager
+def collect(logger=None):
+    """
+    Context manager yielding a Summary of the requests made, from any
+    thread, while the block runs. When `logger` is given the summary report
+    is logged at INFO level on exit.
+    """
+    summary = Summary()
+    with _collectors_lock:
+        _collectors.append(summary)
+    try:
+        yield summary
+    finally:
+        with _collectors_lock:
+            _collectors.remove(summary)
+        summary.elapsed = time.time() - summary.started
+        if logger is not None:
+            logger.info(summary.report())
@@ -5,14 +5,21 @@ from pycrunch.progress import DefaultProgressTracking
 from scrunch.datasets import (LOG, BaseDataset, _get_connection, _get_dataset,
                               CATEGORICAL_TYPES)
 from scrunch.exceptions import InvalidDatasetTypeError
-from scrunch.expressions import parse_expr, process_expr
+from scrunch.expressions import _prepare_expr, process_expr
 from scrunch.helpers import shoji_entity_wrapper
+from scrunch.metadata import DatasetMetadata, dataset_metadata
 
 from warnings import warn
 
 ARRAY_TYPES = frozenset(('multiple_response', 'categorical_array', 'numeric_array'))
 
 
+def _metadata(dataset):
+    if isinstance(dataset, DatasetMetadata):
+        return dataset
+    return dataset_metadata(dataset.resource)
+
+
 def compare_datasets(left_ds, right_ds, use_crunch=False):
     """
     Compare the difference in structure between datasets.
@@ -28,8 +35,9 @@ def compare_datasets(left_ds, right_ds, use_crunch=False):
     point to subvariables that belong to other ds (Not implemented)
     (6) missing rules of the variable.
 
-    :param: left_ds: dataset instance to compare
-    :param: right_ds: dataset instance to compare with
+    :param: left_ds: dataset instance, or DatasetMetadata snapshot, to compare
+    :param: right_ds: dataset instance, or DatasetMetadata snapshot, to
+        compare with
     :param: use_crunch: Use the Crunch comparison to compare
     :return: a dictionary of differences
     """
@@ -58,8 +66,8 @@ def compare_datasets(left_ds, right_ds, use_crunch=False):
             for v in metadata.values()
         }
 
-    left_ds_meta = process_metadata(left_ds.resource.table["metadata"])
-    dataset_meta = process_metadata(right_ds.resource.table["metadata"])
+    left_ds_meta = process_metadata(_metadata(left_ds).metadata)
+    dataset_meta = process_metadata(_metadata(right_ds).metadata)
     common_aliases = frozenset(left_ds_meta.keys()) & frozenset(dataset_meta.keys())
 
     left_ds_names = {}
@@ -250,7 +258,7 @@ class MutableDataset(BaseDataset):
         if filter:
             # in the case of a filter, convert it to crunch
             # and attach the filter to the payload
-            expr = process_expr(parse_expr(filter), right_ds)
+            expr = process_expr(_prepare_expr(filter), right_ds)
             payload['body']['filter'] = {'expression': expr}
 
         progress = self.resource.variables.post(payload)
@@ -307,6 +315,10 @@ class MutableDataset(BaseDataset):
 
         # 1. match variables by alias and compare types
         common_aliases = frozenset(vars_a.keys()) & frozenset(vars_b.keys())
+        # Categories, subvariables and missing rules are read from the
+        # variable entities, fetch them in bulk
+        self.prefetch(common_aliases)
+        dataset.prefetch(common_aliases)
         for alias in common_aliases:
             if vars_a[alias] != vars_b[alias]:
                 diff['variables']['by_type'].append(dataset[alias].name)
@@ -402,7 +414,7 @@ class MutableDataset(BaseDataset):
 
         if filter:
             # parse the filter expression
-            payload['body']['filter'] = process_expr(parse_expr(filter), dataset.resource)
+            payload['body']['filter'] = process_expr(_prepare_expr(filter), dataset.resource)
 
         return self.resource.batches.create(payload)
 
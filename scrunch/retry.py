@@ -0,0 +1,141 @@
+# coding: utf-8
+
+"""
+Retry policy and circuit breaker used by ScrunchSession to ride out
+transient API failures (429/5xx responses and dropped connections).
+"""
+
+import random
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+from scrunch.exceptions import CircuitOpenError
+
+# Methods that do not change anything on the server, retried by default.
+SAFE_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# Statuses that signal a transient condition worth trying again.
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+
+def parse_retry_after(value):
+    """
+    Returns the seconds to wait according to a `Retry-After` header, which
+    is either a number of seconds or an HTTP date, or None if not valid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed requests are tried again and how long to wait.
+
+    :param total: Max number of retries for a single request.
+    :param backoff_factor: Base delay in seconds; the n-th retry waits a
+        random time ("full jitter") up to `backoff_factor * 2 ** n`.
+    :param max_backoff: Upper bound in seconds for any single wait,
+        including the ones requested through `Retry-After`.
+    :param methods: HTTP methods retried by default. Other methods are only
+        retried when the caller opts in (see ScrunchSession.retrying).
+    :param statuses: Response statuses that trigger a retry. Connection
+        errors and timeouts are always considered transient.
+    """
+
+    def __init__(self, total=3, backoff_factor=0.5, max_backoff=60,
+                 methods=SAFE_METHODS, statuses=RETRY_STATUSES):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.methods = frozenset(m.upper() for m in methods)
+        self.statuses = frozenset(statuses)
+
+    def allows(self, method):
+        return method.upper() in self.methods
+
+    def is_retryable(self, response):
+        """
+        `response` is None when the request failed at the connection level.
+        """
+        return response is None or response.status_code in self.statuses
+
+    def backoff(self, attempt, response=None):
+        """
+        Seconds to wait before retry number `attempt` (starting at 0).
+        """
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return min(retry_after, self.max_backoff)
+        ceiling = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests for `reset_timeout` seconds after
+    `failure_threshold` consecutive transient failures, then lets a single
+    trial request through to find out whether the API has recovered.
+
+    While the circuit is open requests raise CircuitOpenError, or, with
+    `block=True`, wait until the trial request is due, so long batch jobs
+    slow down instead of aborting halfway.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, block=False):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.block = block
+        self.failures = 0
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        while True:
+            with self._lock:
+                if self.state == self.CLOSED:
+                    return
+                remaining = self.opened_at + self.reset_timeout - time.time()
+                if self.state == self.OPEN and remaining <= 0:
+                    # Let this request through as the trial
+                    self.state = self.HALF_OPEN
+                    return
+            if not self.block:
+                raise CircuitOpenError(max(0, remaining))
+            time.sleep(max(remaining, 0.1))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+            self.opened_at = None
+
+    def release(self):
+        """
+        Leaves the failure count as it is. If the request was the trial of
+        a half-open circuit the next request gets to be the trial instead.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
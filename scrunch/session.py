@@ -1,11 +1,25 @@
+import contextlib
+import functools
 import os
+import threading
+import time
 
+import requests
+import six
+from requests.adapters import HTTPAdapter
 from pycrunch import connect as _connect
 from pycrunch.elements import ElementSession
+from pycrunch.lemonpy import ClientError, ServerError
 from pycrunch.version import __version__ as pycrunch_version
 
+from . import metadata, metrics
+from .cache import CachingHTTPAdapter, DiskCache, HTTPCache
+from .retry import SAFE_METHODS, RetryPolicy
 from .version import __version__
 
+# Seconds feature flags are cached on disk, per site URL. 0 disables it.
+FEATURE_FLAGS_TTL = int(os.environ.get("SCRUNCH_FEATURE_FLAGS_TTL", 3600))
+
 SSL_UNSAFE = os.environ.get("SSL_UNSAFE", "").strip().lower() in (
     "1",
     "true",
@@ -14,11 +28,233 @@ SSL_UNSAFE = os.environ.get("SSL_UNSAFE", "").strip().lower() in (
 )
 
 
+# Connection options understood by ScrunchSession and `connect()` on top
+# of the ones pycrunch sessions take.
+SESSION_OPTIONS = ("pool_connections", "pool_maxsize", "pool_block",
+                   "keep_alive", "timeout", "retry", "circuit_breaker",
+                   "http_cache")
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
 class ScrunchSession(ElementSession):
+    """
+    The pycrunch session used by scrunch, with configurable HTTP
+    connection pooling:
+
+    :param pool_connections: Number of per-host connection pools to keep.
+    :param pool_maxsize: Max connections kept alive in each host's pool;
+        set it to the number of threads making concurrent requests.
+    :param pool_block: When True, requests wait for a free connection
+        instead of opening (and later discarding) extra ones.
+    :param keep_alive: When False, connections are closed after every
+        response.
+    :param timeout: Default socket timeout for every request, either
+        seconds or a (connect, read) tuple. Requests can still override it.
+    :param retry: RetryPolicy for transient failures (429/5xx responses
+        and connection errors). Defaults to retrying safe methods 3 times,
+        pass False to disable retries.
+    :param circuit_breaker: Optional CircuitBreaker shared by all requests
+        of the session.
+    :param http_cache: True or an HTTPCache to revalidate repeated GETs
+        with ETag/Last-Modified instead of downloading them again.
+
+    Requests can pass `retry=True` (or a RetryPolicy) to be retried even
+    when their method is not safe, or `retry=False` to never be retried.
+    See also `retrying()` for requests issued through pycrunch entities.
+    """
+
     headers = {
         "user-agent": "scrunch/%s (pycrunch/%s)" % (__version__, pycrunch_version)
     }
 
+    def __init__(self, *args, **kwargs):
+        pool_connections = kwargs.pop("pool_connections", DEFAULT_POOL_CONNECTIONS)
+        pool_maxsize = kwargs.pop("pool_maxsize", DEFAULT_POOL_MAXSIZE)
+        pool_block = kwargs.pop("pool_block", False)
+        keep_alive = kwargs.pop("keep_alive", True)
+        self.timeout = kwargs.pop("timeout", None)
+        retry = kwargs.pop("retry", None)
+        self.retry_policy = RetryPolicy() if retry is None else retry
+        self.circuit_breaker = kwargs.pop("circuit_breaker", None)
+        http_cache = kwargs.pop("http_cache", None)
+        if http_cache is True:
+            http_cache = HTTPCache()
+        self.http_cache = http_cache or None
+        self._retry_override = threading.local()
+        self._feature_flags = None
+        # The API root payload connect() got, saves fetching it again
+        # (see `root`) to read feature flags
+        self.site_root = None
+        super(ScrunchSession, self).__init__(*args, **kwargs)
+        pool_options = dict(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        for prefix in ("https://", "http://"):
+            if self.http_cache is not None:
+                adapter = CachingHTTPAdapter(self.http_cache, **pool_options)
+            else:
+                adapter = HTTPAdapter(**pool_options)
+            self.mount(prefix, adapter)
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+
+    @property
+    def feature_flags(self):
+        """
+        Server feature flags scrunch checks (see FLAGS_TO_CHECK). They are
+        only fetched when first read, and kept on disk for
+        FEATURE_FLAGS_TTL seconds so new sessions on the same site don't
+        request them again.
+        """
+        if self._feature_flags is None:
+            cache = DiskCache("feature_flags", FEATURE_FLAGS_TTL)
+            flags = cache.get(self.site_url)
+            if flags is None or not FLAGS_TO_CHECK.issubset(flags):
+                root = self.site_root
+                flags = fetch_feature_flags(root if root is not None else self.root)
+                cache.set(self.site_url, flags)
+            self._feature_flags = flags
+        return self._feature_flags
+
+    @feature_flags.setter
+    def feature_flags(self, flags):
+        self._feature_flags = flags
+
+    @contextlib.contextmanager
+    def retrying(self, policy=True):
+        """
+        Context manager making every request sent from this thread inside
+        the block retryable, regardless of its method. Meant for call sites
+        that know their request is idempotent but go through pycrunch
+        entities, which do not take a `retry` argument:
+
+            with ds.resource.session.retrying():
+                ds.resource.table.post(query)
+        """
+        previous = getattr(self._retry_override, "policy", None)
+        self._retry_override.policy = policy
+        try:
+            yield self
+        finally:
+            self._retry_override.policy = previous
+
+    def _get_retry_policy(self, method, retry):
+        if retry is None:
+            retry = getattr(self._retry_override, "policy", None)
+        if retry is None:
+            # Not decided by the caller, only retry safe methods
+            if self.retry_policy and self.retry_policy.allows(method):
+                return self.retry_policy
+            return None
+        if isinstance(retry, RetryPolicy):
+            return retry
+        if retry:
+            return self.retry_policy or RetryPolicy()
+        return None
+
+    def request(self, method, url, *args, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
+        policy = self._get_retry_policy(method, kwargs.pop("retry", None))
+        statuses = (policy or self.retry_policy or RetryPolicy()).statuses
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.before_request()
+            start = time.time()
+            try:
+                response = super(ScrunchSession, self).request(
+                    method, url, *args, **kwargs)
+            except (ClientError, ServerError) as exc:
+                # pycrunch raises these from its response hook, with the
+                # failed response as first argument
+                error, response = exc, exc.args[0]
+                transient = getattr(response, "status_code", None) in statuses
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error, response = exc, None
+                transient = True
+            else:
+                self._record_metrics(method, url, response, start)
+                self._record_result(failed=False)
+                if method.upper() not in SAFE_METHODS:
+                    # The dataset may have changed, drop its metadata
+                    metadata.invalidate(url)
+                return response
+
+            self._record_metrics(method, url, response, start)
+
+            if transient or not isinstance(error, ClientError):
+                # Server errors count against the API even when they are
+                # not worth retrying
+                self._record_result(failed=True)
+            elif self.circuit_breaker is not None:
+                # The API answered, but a 4xx says nothing about its health
+                self.circuit_breaker.release()
+            if (policy is None or attempt >= policy.total
+                    or not (transient and policy.is_retryable(response))):
+                raise error
+            time.sleep(policy.backoff(attempt, response))
+            attempt += 1
+
+    def _record_metrics(self, method, url, response, start):
+        elapsed = time.time() - start
+        if not isinstance(response, requests.Response):
+            metrics.record_request(method, url, None, elapsed)
+            return
+        body = response.request.body if response.request is not None else None
+        # File uploads and generators are not measured
+        if isinstance(body, (bytes, six.text_type)):
+            sent = len(six.ensure_binary(body))
+        else:
+            sent = 0
+        if getattr(response, "from_cache", False):
+            received = 0  # Revalidated, the body came from the HTTP cache
+        elif response._content_consumed and isinstance(response.content, bytes):
+            received = len(response.content)
+        else:
+            # Streamed downloads, don't consume the body here
+            received = int(response.headers.get("Content-Length") or 0)
+        metrics.record_request(
+            method, url, response.status_code, elapsed,
+            bytes_sent=sent, bytes_received=received)
+
+    def _record_result(self, failed):
+        if self.circuit_breaker is None:
+            return
+        if failed:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+    def pool_stats(self):
+        """
+        Returns usage of the connection pools, one entry per open host pool
+        keyed by `scheme://host:port`, with the connections opened so far,
+        requests made, idle connections and the pool's max size.
+        """
+        stats = {}
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                if pool is None or pool.pool is None:
+                    continue  # Closed pool
+                url = "%s://%s:%s" % (pool.scheme, pool.host, pool.port)
+                # The queue is pre-filled with None for connections not
+                # opened yet, only actual connections sitting there are idle
+                queued = list(pool.pool.queue)
+                stats[url] = {
+                    "connections": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "idle": sum(1 for conn in queued if conn is not None),
+                    "maxsize": pool.pool.maxsize,
+                }
+        return stats
+
 
 class ScrunchSSLUnsafeSession(ScrunchSession):
     """
@@ -34,19 +270,37 @@ class ScrunchSSLUnsafeSession(ScrunchSession):
 FLAGS_TO_CHECK = {"clients_strict_subvariable_syntax"}
 
 
-def set_feature_flags(site):
-    feature_flags = {
+def fetch_feature_flags(site):
+    return {
         flag_name: site.follow("feature_flag", "feature_name=%s" % flag_name).value[
             "active"
         ]
         for flag_name in FLAGS_TO_CHECK
     }
-    setattr(site.session, "feature_flags", feature_flags)
+
+
+def set_feature_flags(site):
+    setattr(site.session, "feature_flags", fetch_feature_flags(site))
     return site
 
 
 def connect(*args, **kwargs):
+    """
+    Logs in to Crunch, see `pycrunch.connect`. Also takes the connection
+    pool options of `ScrunchSession` (pool_connections, pool_maxsize,
+    pool_block, keep_alive and timeout).
+    """
     session_class = ScrunchSSLUnsafeSession if SSL_UNSAFE else ScrunchSession
+    if "username" in kwargs:
+        # Name used by scrunch.connections, pycrunch calls it `user`
+        kwargs["user"] = kwargs.pop("username")
+    session_options = {
+        option: kwargs.pop(option) for option in SESSION_OPTIONS
+        if option in kwargs
+    }
+    if session_options:
+        session_class = functools.partial(session_class, **session_options)
     _site = _connect(session_class=session_class, *args, **kwargs)
-    _site = set_feature_flags(_site)
+    # Feature flags are fetched lazily by the session, on first use
+    _site.session.site_root = _site
     return _site
@@ -1,7 +1,23 @@
-from pycrunch.importing import Importer
+import json
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+from six.moves import queue
+
 from scrunch.datasets import BaseDataset, _get_dataset
 from scrunch.exceptions import InvalidDatasetTypeError
-from scrunch.helpers import shoji_entity_wrapper
+from scrunch.helpers import import_pandas, shoji_entity_wrapper
+from scrunch.retry import RetryPolicy
+
+# Defaults for packing streamed rows into ldjson requests. A batch is sent
+# once it holds `DEFAULT_BATCH_SIZE` rows or would exceed `MAX_BATCH_BYTES`.
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_BYTES = 5 * 2 ** 20  # 5MB
+
+# Acknowledgement for every ldjson batch POSTed to the dataset's stream.
+StreamAck = namedtuple('StreamAck', ['rows', 'size', 'status_code'])
 
 
 def get_streaming_dataset(dataset, connection=None, editor=False, project=None):
@@ -20,27 +36,139 @@ def get_streaming_dataset(dataset, connection=None, editor=False, project=None):
     return ds
 
 
+def ldjson_batches(lines, batch_size=DEFAULT_BATCH_SIZE,
+                   max_batch_bytes=MAX_BATCH_BYTES):
+    """
+    Groups serialized ldjson lines into lists bounded both by number of
+    rows and by payload size. A single line bigger than `max_batch_bytes`
+    is still sent, on its own batch.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    batch = []
+    size = 0
+    for line in lines:
+        line_size = len(line) + 1  # Account for the newline separator
+        if batch and (len(batch) >= batch_size
+                      or size + line_size > max_batch_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(line)
+        size += line_size
+    if batch:
+        yield batch
+
+
+def is_columnar(data):
+    """
+    Tells whether `data` is columnar input that can be serialized in a
+    vectorized way: a pandas DataFrame, an Arrow table, a NumPy (structured)
+    array or a dict of NumPy arrays/pandas Series.
+    """
+    # Without pandas imported already `data` can't be a DataFrame
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(data, pd.DataFrame):
+        return True
+    if hasattr(data, 'to_pandas') or hasattr(data, 'dtype'):
+        return True
+    return isinstance(data, dict) and any(
+        hasattr(column, 'dtype') for column in data.values())
+
+
+def columnar_ldjson(data, chunk_size=DEFAULT_BATCH_SIZE):
+    """
+    Yields one ldjson line per row of columnar `data` (see `is_columnar`).
+
+    Rows are serialized `chunk_size` at a time with pandas' `to_json`, so
+    no per-row Python dicts are built and NumPy scalars need no conversion.
+    """
+    pd = import_pandas("stream columnar data")
+    if isinstance(data, pd.DataFrame):
+        frame = data
+    elif hasattr(data, 'to_pandas'):
+        # Arrow tables and record batches
+        frame = data.to_pandas()
+    else:
+        frame = pd.DataFrame(data)
+
+    for start in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[start:start + chunk_size].to_json(
+            orient='records', lines=True, date_format='iso',
+            double_precision=15)
+        # String values have their newlines escaped, so this only splits rows
+        for line in chunk.split('\n'):
+            if line:
+                yield line
+
+
+def stream_ldjson(resource, lines):
+    """
+    POSTs already serialized rows to a dataset's stream in a single request.
+    """
+    return resource.session.post(
+        resource.fragments.stream, data="\n".join(lines))
+
+
 class StreamingDataset(BaseDataset):
     """
     A Crunch entity that represents Datasets that are currently
     of the "streaming" class
     """
 
-    def stream_rows(self, columns):
+    def stream_rows(self, columns, batch_size=DEFAULT_BATCH_SIZE,
+                    max_batch_bytes=MAX_BATCH_BYTES):
         """
         Receives a dict with columns of values to add and streams them
         into the dataset. Client must call .push_rows(n) later or wait until
         Crunch automatically processes the batch.
 
+        `columns` can also be a pandas DataFrame, an Arrow table, a NumPy
+        structured array or a dict of NumPy arrays; those are serialized
+        column-wise without building a dict per row (requires pandas).
+
+        Rows are sent in ldjson batches of at most `batch_size` rows and
+        `max_batch_bytes` bytes each, one request per batch.
+
         Returns the total of rows streamed
         """
-        importer = Importer()
+        if is_columnar(columns):
+            lines = columnar_ldjson(columns, batch_size)
+            batches = ldjson_batches(lines, batch_size, max_batch_bytes)
+            return sum(self._stream_lines(batch).rows for batch in batches)
+
         count = len(list(columns.values())[0])
-        for x in range(count):
-            importer.stream_rows(self.resource,
-                                 {a: columns[a][x] for a in columns})
+        rows = ({a: columns[a][x] for a in columns} for x in range(count))
+        self.stream_batches(rows, batch_size, max_batch_bytes)
         return count
 
+    def stream_batches(self, rows, batch_size=DEFAULT_BATCH_SIZE,
+                       max_batch_bytes=MAX_BATCH_BYTES):
+        """
+        Streams an iterable of row dicts (in the Crunch I/O format) into the
+        dataset, packing them into ldjson batches bounded by `batch_size`
+        rows and `max_batch_bytes` bytes.
+
+        Returns a list of StreamAck, one per request sent.
+        """
+        return list(
+            self.iter_stream_batches(rows, batch_size, max_batch_bytes))
+
+    def iter_stream_batches(self, rows, batch_size=DEFAULT_BATCH_SIZE,
+                            max_batch_bytes=MAX_BATCH_BYTES):
+        """
+        Same as stream_batches(), yielding the StreamAck of each request as
+        it is sent, so callers know which rows went through if one fails.
+        """
+        lines = (json.dumps(row, indent=None) for row in rows)
+        for batch in ldjson_batches(lines, batch_size, max_batch_bytes):
+            yield self._stream_lines(batch)
+
+    def _stream_lines(self, lines):
+        resp = stream_ldjson(self.resource, lines)
+        size = sum(len(line) for line in lines) + len(lines) - 1
+        return StreamAck(len(lines), size, resp.status_code)
+
     def push_rows(self, count=None):
         """
         Batches in the rows that have been recently streamed. This forces
@@ -53,3 +181,233 @@ class StreamingDataset(BaseDataset):
                     'stream': count,
                     'type': 'ldjson'}
                 ))
+
+
+class _WriterCommand(object):
+    """
+    Marker placed on the StreamingWriter queue to request a flush (and
+    optionally a stop) from the background worker. Being in the same FIFO
+    as the rows guarantees every row written before it has been sent by
+    the time `done` is set.
+    """
+
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+
+class StreamingWriter(object):
+    """
+    Accepts rows from any thread into a bounded in-memory queue and ships
+    them to a StreamingDataset from a background worker, so callers do not
+    wait on HTTP requests:
+
+        with StreamingWriter(ds, push_interval=60) as writer:
+            for row in source:
+                writer.write(row)
+
+    Rows are streamed in batches once `batch_size` rows are pending or the
+    oldest pending row has waited `flush_interval` seconds. The streamed
+    rows are pushed into the dataset (see StreamingDataset.push_rows) every
+    `push_every` rows and/or every `push_interval` seconds, and always on
+    flush() and close().
+
+    When the queue holds `max_queue_size` rows, write() blocks until the
+    worker catches up. Errors in the worker are raised on the next call to
+    write(), flush() or close(). Rows that failed to be streamed are sent
+    again, before the newer ones, after waiting as `retry_policy` says
+    (RetryPolicy.backoff); new rows are left in the queue meanwhile, so
+    write() blocks once it is full. flush() and close() try again right
+    away; the rows still not sent when the writer is closed are left in
+    `unsent_rows`.
+
+    `acks` holds the StreamAck of the last `MAX_ACKS` requests,
+    `rows_streamed` counts the rows of all of them.
+    """
+
+    MAX_ACKS = 1000
+
+    def __init__(self, dataset, batch_size=DEFAULT_BATCH_SIZE,
+                 max_batch_bytes=MAX_BATCH_BYTES, max_queue_size=10000,
+                 flush_interval=1.0, push_every=None, push_interval=None,
+                 retry_policy=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.flush_interval = flush_interval
+        self.push_every = push_every
+        self.push_interval = push_interval
+        self.retry_policy = retry_policy or RetryPolicy(backoff_factor=1)
+        self.rows_streamed = 0
+        self.acks = deque(maxlen=self.MAX_ACKS)
+        self.unsent_rows = []
+        self._unpushed = 0
+        self._last_push = time.time()
+        self._error = None
+        self._closed = False
+        self._attempts = 0
+        self._retry_at = None
+        # Pending flush()/close() calls, they stop the back off
+        self._commands = 0
+        self._wakeup = threading.Condition()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._worker = threading.Thread(target=self._run, name='scrunch-streaming-writer')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, row, timeout=None):
+        """
+        Queues a row dict (in the Crunch I/O format) to be streamed. Blocks
+        only while the queue is full; raises queue.Full if that takes longer
+        than `timeout` seconds.
+        """
+        self._raise_error()
+        if self._closed:
+            raise ValueError("Cannot write to a closed StreamingWriter")
+        self._queue.put(row, timeout=timeout)
+
+    def flush(self):
+        """
+        Blocks until every row written so far has been streamed and pushed
+        into the dataset.
+        """
+        if self._closed:
+            raise ValueError("Cannot flush a closed StreamingWriter")
+        self._send_command(_WriterCommand())
+
+    def close(self):
+        """
+        Flushes the pending rows and stops the background worker.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._send_command(_WriterCommand(stop=True))
+        self._worker.join()
+
+    def _send_command(self, command):
+        with self._wakeup:
+            self._commands += 1
+            self._wakeup.notify()
+        self._queue.put(command)
+        command.done.wait()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _poll_timeout(self, first_row_at):
+        deadlines = []
+        if first_row_at is not None:
+            deadlines.append(first_row_at + self.flush_interval)
+        if self.push_interval is not None and self._unpushed:
+            deadlines.append(self._last_push + self.push_interval)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.time())
+
+    def _run(self):
+        rows = []
+        first_row_at = None
+        while True:
+            if self._retry_at is not None and not self._commands:
+                # Streaming failed, the failed rows go before reading more
+                if self._wait_retry():
+                    rows = self._stream(rows)
+                    first_row_at = time.time() if rows else None
+                continue
+            try:
+                item = self._queue.get(timeout=self._poll_timeout(first_row_at))
+            except queue.Empty:
+                item = None
+            command = item if isinstance(item, _WriterCommand) else None
+            if item is not None and command is None:
+                if not rows:
+                    first_row_at = time.time()
+                rows.append(item)
+
+            # While backing off only a command sends the failed rows again
+            due = rows and self._retry_at is None and (
+                len(rows) >= self.batch_size
+                or time.time() - first_row_at >= self.flush_interval)
+            if rows and (command is not None or due):
+                rows = self._stream(rows)
+                # Failed rows stay first in line for the next attempt
+                first_row_at = time.time() if rows else None
+
+            if command is not None:
+                with self._wakeup:
+                    self._commands -= 1
+                if self._unpushed:
+                    self._guarded(self._push)
+                if command.stop:
+                    self.unsent_rows = rows
+                    command.done.set()
+                    return
+                command.done.set()
+            elif self._push_due():
+                self._guarded(self._push)
+
+    def _guarded(self, func, *args):
+        # Keep the worker alive and report the first error to the caller.
+        try:
+            func(*args)
+        except Exception as exc:
+            if self._error is None:
+                self._error = exc
+
+    def _wait_retry(self):
+        # True once the back off is over, False if a command came first
+        with self._wakeup:
+            timeout = self._retry_at - time.time()
+            if timeout > 0 and not self._commands:
+                self._wakeup.wait(timeout)
+            return not self._commands and time.time() >= self._retry_at
+
+    def _stream(self, rows):
+        # Returns the rows to send again, once the back off is over
+        rows = self._send(rows)
+        if rows:
+            self._retry_at = time.time() + self.retry_policy.backoff(
+                self._attempts)
+            self._attempts += 1
+        else:
+            self._retry_at = None
+            self._attempts = 0
+        return rows
+
+    def _send(self, rows):
+        # Returns the rows that couldn't be sent
+        sent = 0
+        try:
+            for ack in self.dataset.iter_stream_batches(
+                    rows, self.batch_size, self.max_batch_bytes):
+                self.acks.append(ack)
+                sent += ack.rows
+                self.rows_streamed += ack.rows
+                self._unpushed += ack.rows
+        except Exception as exc:
+            if self._error is None:
+                self._error = exc
+        return rows[sent:]
+
+    def _push_due(self):
+        if not self._unpushed:
+            return False
+        if self.push_every is not None and self._unpushed >= self.push_every:
+            return True
+        return (self.push_interval is not None
+                and time.time() - self._last_push >= self.push_interval)
+
+    def _push(self):
+        count, self._unpushed = self._unpushed, 0
+        self._last_push = time.time()
+        self.dataset.push_rows(count)
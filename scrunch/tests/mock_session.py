@@ -18,6 +18,7 @@ class FixtureAdapter(BaseAdapter):
         self.requests = []
         self.post_responses = []
         self.patch_responses = []
+        self.put_responses = []
 
     def add_fixture(self, url, fixture):
         self.fixtures[url] = fixture
@@ -28,12 +29,17 @@ class FixtureAdapter(BaseAdapter):
     def add_patch_response(self, response):
         self.patch_responses.append(response)
 
+    def add_put_response(self, response):
+        self.put_responses.append(response)
+
     def send(self, request, **kwargs):
         self.requests.append(request)
         if request.method == 'POST':
             response = self.post_responses.pop(0)
         elif request.method == "PATCH":
             response = self.patch_responses.pop(0)
+        elif request.method == "PUT":
+            response = self.put_responses.pop(0)
         else:
             url = request.url
             if url not in self.fixtures:
@@ -66,6 +72,9 @@ class MockSession(ScrunchSession):
     def add_patch_response(self, response):
         self.adapter.add_patch_response(response)
 
+    def add_put_response(self, response):
+        self.adapter.add_put_response(response)
+
     def get_fixture(self, url):
         return self.adapter.fixtures[url]
 
@@ -0,0 +1,140 @@
+# coding: utf-8
+
+from unittest import TestCase
+
+import mock
+import pytest
+from pycrunch.lemonpy import ClientError
+from pycrunch.shoji import Entity
+
+from scrunch import catalogs
+from scrunch.cache import HTTPCache
+from scrunch.catalogs import iter_catalog, iter_table_metadata
+from scrunch.tests.mock_session import MockSession
+
+
+class TestIterCatalog(TestCase):
+    variables_url = 'http://host/api/datasets/abc/variables/'
+
+    def page(self, session, offset, var_ids, limit=2):
+        url = '%s?limit=%d&offset=%d' % (self.variables_url, limit, offset)
+        session.add_fixture(url, {
+            'element': 'shoji:catalog',
+            'self': url,
+            'index': {
+                '%s/' % var_id: {'alias': 'var_%s' % var_id, 'id': var_id}
+                for var_id in var_ids
+            }
+        })
+
+    def test_pages(self):
+        session = MockSession()
+        self.page(session, 0, ['001', '002'])
+        self.page(session, 2, ['003', '004'])
+        self.page(session, 4, ['005'])
+
+        entries = list(iter_catalog(session, self.variables_url, 2))
+        assert [url for url, _ in entries] == [
+            self.variables_url + '%03d/' % i for i in range(1, 6)]
+        assert entries[0][1] == {'alias': 'var_001', 'id': '001'}
+        assert len(session.requests) == 3
+
+    def test_not_paged_by_api(self):
+        session = MockSession()
+        # Same full catalog whatever the offset
+        self.page(session, 0, ['001', '002'])
+        self.page(session, 2, ['001', '002'])
+        entries = list(iter_catalog(session, self.variables_url, 2))
+        assert len(entries) == 2
+
+        session = MockSession()
+        self.page(session, 0, ['001', '002', '003'])
+        entries = list(iter_catalog(session, self.variables_url, 2))
+        assert len(entries) == 3
+        assert len(session.requests) == 1
+
+    def test_not_parsed_upfront(self):
+        session = MockSession()
+        url = '%s?limit=2&offset=0' % self.variables_url
+        # Larger than what ijson and _ResponseReader read at a time
+        description = 'x' * (4 * catalogs.CHUNK_SIZE)
+        session.add_fixture(url, {
+            'element': 'shoji:catalog',
+            'self': url,
+            'index': {
+                '001/': {'alias': 'var_001', 'id': '001'},
+                '002/': {'alias': 'var_002', 'id': '002',
+                         'description': description},
+            }
+        })
+        responses = []
+
+        def get(*args, **kwargs):
+            responses.append(catalogs_get(*args, **kwargs))
+            return responses[-1]
+
+        catalogs_get = catalogs._get
+        with mock.patch.object(catalogs, '_get', side_effect=get):
+            entries = iter_catalog(session, self.variables_url, 2)
+            next(entries)
+            # pycrunch's hook didn't read and parse the whole response
+            assert not hasattr(responses[0], 'payload')
+            if catalogs._ijson() is not None:
+                assert not responses[0]._content_consumed
+
+    def test_http_cache_not_streamed(self):
+        session = MockSession()
+        self.page(session, 0, ['001'])
+        with mock.patch.object(session, 'get', wraps=session.get) as get:
+            list(iter_catalog(session, self.variables_url, 2))
+            assert get.call_args[1]['stream'] is True
+
+            session.http_cache = HTTPCache()
+            list(iter_catalog(session, self.variables_url, 2))
+            # Revalidated through the cache instead
+            assert get.call_args[1]['stream'] is False
+
+    def test_errors_raised(self):
+        session = MockSession()
+        response = mock.MagicMock(status_code=404)
+        with mock.patch.object(session, 'get', return_value=response):
+            with mock.patch.object(session, 'hooks', {
+                    'response': mock.MagicMock(side_effect=ClientError(response))}):
+                with pytest.raises(ClientError):
+                    list(iter_catalog(session, self.variables_url))
+
+
+class TestIterTableMetadata(TestCase):
+    ds_url = 'http://host/api/datasets/abc/'
+
+    def dataset(self):
+        session = MockSession()
+        session.add_fixture(self.ds_url + 'table/?limit=0', {
+            'element': 'crunch:table',
+            'metadata': {
+                '001': {'alias': 'age', 'type': 'numeric', 'scale': 1.5},
+                '002': {'alias': 'gender', 'type': 'categorical'},
+            }
+        })
+        return Entity(session, **{
+            'element': 'shoji:entity',
+            'self': self.ds_url,
+            'body': {},
+            'views': {'table': self.ds_url + 'table/'},
+        })
+
+    def test_metadata(self):
+        resource = self.dataset()
+        assert dict(iter_table_metadata(resource)) == {
+            '001': {'alias': 'age', 'type': 'numeric', 'scale': 1.5},
+            '002': {'alias': 'gender', 'type': 'categorical'},
+        }
+
+    def test_streamed(self):
+        pytest.importorskip('ijson')
+        resource = self.dataset()
+        with mock.patch.object(catalogs, 'CHUNK_SIZE', 16):
+            metadata = dict(iter_table_metadata(resource))
+        assert metadata['001']['scale'] == 1.5
+        assert resource.session.requests[0].url == (
+            self.ds_url + 'table/?limit=0')
@@ -153,6 +153,11 @@ class TestCategories(TestCase):
         assert variable.categories[1].selected is False
         assert str(excinfo.value) == error_msg
 
+        # Other attributes can be set
+        category = variable.categories[1]
+        category.color = 'red'
+        assert category.color == 'red'
+
     def test_edit_derived(self):
         resource = EditableMock()
         resource.entity.body = dict(
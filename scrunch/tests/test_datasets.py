@@ -3,6 +3,10 @@
 import collections
 import json
 import copy
+import os
+import shutil
+import tempfile
+import threading
 
 import mock
 from mock import MagicMock
@@ -23,13 +27,19 @@ from unittest import TestCase
 from requests import Response
 
 import pytest
+from pycrunch.lemonpy import ClientError, ServerError
 from pycrunch.shoji import Entity, Catalog, Tuple, as_entity
 from pycrunch.elements import JSONObject, ElementSession, Document
 from pycrunch.variables import cast
 
 import scrunch
-from scrunch.datasets import Variable, BaseDataset, Project
+from scrunch.datasets import (Variable, BaseDataset, BackfillFromCSV, Project,
+                              VariableIndex)
+from scrunch.exceptions import BatchError
+from scrunch.expressions import Expression
+from scrunch.helpers import AliasRegistry, generate_subvariable_codes
 from scrunch.subentity import Filter, Multitable, Deck
+from scrunch.metadata import DatasetMetadata
 from scrunch.mutable_dataset import MutableDataset
 from scrunch.streaming_dataset import StreamingDataset
 from scrunch.tests.test_categories import EditableMock, TEST_CATEGORIES
@@ -267,7 +277,7 @@ class TestDatasets(TestDatasetBase, TestCase):
 
     @pytest.mark.skipif(pandas is None, reason='pandas is not installed')
     @mock.patch('scrunch.streaming_dataset.StreamingDataset.push_rows')
-    @mock.patch('pycrunch.importing.Importer.stream_rows')
+    @mock.patch('scrunch.streaming_dataset.stream_ldjson')
     def test_replace_from_csv(self, mocked_stream_rows, mocked_push_rows):
         ds_shoji = copy.deepcopy(self.ds_shoji)
         ds_shoji['body']['streaming'] = 'negative'
@@ -278,7 +288,7 @@ class TestDatasets(TestDatasetBase, TestCase):
         file.write("id, age\n1, 15")
         file.seek(0)
         ds.replace_from_csv(file, chunksize=5)
-        mocked_stream_rows.assert_called_with(ds_mock, [{'id': 1, ' age': 15}])
+        mocked_stream_rows.assert_called_with(ds_mock, ['{"id":1," age":15}'])
         mocked_push_rows.assert_called_with(5)
         assert ds.resource.body.get('streaming') == 'negative'
 
@@ -1378,6 +1388,23 @@ class TestVariables(TestDatasetBase, TestCase):
         assert var.view == dict(show_counts=True)
         var.resource._edit.assert_called_with(**changes)
 
+    def test_edit_categorical(self):
+        ds_mock = self._dataset_mock()
+        ds = StreamingDataset(ds_mock)
+        var = ds['var1_alias']
+        categories = [
+            {'id': 1, 'name': 'Low', 'numeric_value': None, 'missing': False},
+            {'id': 2, 'name': 'High', 'numeric_value': None, 'missing': False},
+        ]
+        var.edit_categorical(
+            categories, rules=['var1_alias < 10', 'var1_alias >= 10'])
+        payload = var.resource.patch.call_args[0][0]
+        assert payload['body']['expr']['args'][1:] == [
+            {'function': '<', 'args': [{'var': 'var1_alias'}, {'value': 10}]},
+            {'function': '>=', 'args': [{'var': 'var1_alias'}, {'value': 10}]},
+        ]
+        ds_mock.follow.assert_called_once_with('table', 'limit=0')
+
     def test_edit_alias(self):
         ds_mock = self._dataset_mock()
         ds = BaseDataset(ds_mock)
@@ -2029,6 +2056,141 @@ class TestForks(TestCase):
         assert_expected(ds_res.session.post.mock_calls[0])
 
 
+class TestVariableIndex(TestCase):
+    ds_url = 'http://host/api/datasets/abc/'
+    variables_url = 'http://host/api/datasets/abc/variables/'
+
+    def prepare_ds(self, base=variables_url):
+        session = MockSession()
+        dataset_resource = Entity(session, **{
+            "element": "shoji:entity",
+            "self": self.ds_url,
+            "body": {"name": "test_dataset", "streaming": "no"},
+            "catalogs": {"variables": self.variables_url},
+        })
+        session.add_fixture(self.variables_url, {
+            "element": "shoji:catalog",
+            "self": self.variables_url,
+            "index": {
+                "%s%03d/" % (base, i): {
+                    "alias": "var_%d" % i,
+                    "name": "Variable %d" % i,
+                    "id": "%03d" % i,
+                    "type": "multiple_response" if i == 0 else "numeric",
+                }
+                for i in range(50)
+            }
+        })
+        # Mocks that aren't relevant for the test
+        dataset_resource.folders = MagicMock()
+        return StreamingDataset(dataset_resource), session
+
+    def test_lookups(self):
+        ds, session = self.prepare_ds()
+        var_url = self.variables_url + '007/'
+        with mock.patch.object(Catalog, 'by') as by:
+            for key in ('var_7', 'Variable 7', var_url, '007'):
+                assert ds._lookup_variable(key).entity_url == var_url
+            assert ds.get_url_by_alias('var_7') == var_url
+            assert not by.called
+        assert ds._lookup_variable('missing') is None
+        with pytest.raises(ValueError):
+            ds['missing']
+        # One request for the variables catalog, variable entities aren't
+        # fetched to resolve URLs
+        assert len(session.requests) == 1
+
+    def test_rebuilt_on_reload(self):
+        ds, session = self.prepare_ds()
+        assert ds._variable_index.get('var_1') is not None
+        index = ds._variable_index
+        ds._reload_variables()
+        assert ds._var_index is None
+        assert ds._variable_index is not index
+
+    def test_variable_to_url(self):
+        from scrunch.cubes import variable_to_url
+        ds, _ = self.prepare_ds()
+        assert variable_to_url('var_3', ds) == self.variables_url + '003/'
+        assert variable_to_url('not_a_var', ds) == 'not_a_var'
+
+    @mock.patch('scrunch.streaming_dataset.StreamingDataset.multitables')
+    def test_create_multitable(self, multitables):
+        ds, session = self.prepare_ds()
+        ds.resource.multitables = MagicMock()
+        ds.create_multitable('mt', template=['var_0', 'var_1'])
+        payload = ds.resource.multitables.create.call_args[0][0]
+        mr_url = self.variables_url + '000/'
+        assert payload['body']['template'] == [
+            {'query': [
+                {'each': mr_url},
+                {'function': 'as_selected', 'args': [{'variable': mr_url}]},
+            ]},
+            {'query': [{'variable': self.variables_url + '001/'}]},
+        ]
+
+    @mock.patch('scrunch.streaming_dataset.StreamingDataset.multitables')
+    def test_create_multitable_relative_urls(self, multitables):
+        # Catalogs can index their variables by relative URLs
+        ds, session = self.prepare_ds(base='')
+        ds.resource.multitables = MagicMock()
+        ds.create_multitable('mt', template=['var_0', 'var_1'])
+        payload = ds.resource.multitables.create.call_args[0][0]
+        mr_url = self.variables_url + '000/'
+        assert payload['body']['template'] == [
+            {'query': [
+                {'each': mr_url},
+                {'function': 'as_selected', 'args': [{'variable': mr_url}]},
+            ]},
+            {'query': [{'variable': self.variables_url + '001/'}]},
+        ]
+
+    def test_duplicated_names(self):
+        catalog = Catalog(MockSession(), **{
+            "self": self.variables_url,
+            "index": {
+                self.variables_url + '001/': {"alias": "a", "name": "Same", "id": "001"},
+                self.variables_url + '002/': {"alias": "Same", "name": "b", "id": "002"},
+            }
+        })
+        index = VariableIndex(catalog)
+        assert len(index) == 2
+        # Aliases take precedence over names
+        assert index.get('Same')['id'] == '002'
+        assert index.get('Same', keys=('name',))['id'] == '001'
+
+
+class TestBackfillFromCSV(TestCase):
+    variables_url = 'http://host/api/datasets/abc/variables/'
+
+    def test_subvariable_urls_from_table(self):
+        session = MockSession()
+        metadata = DatasetMetadata({
+            '001': {'alias': 'age', 'name': 'Age', 'type': 'numeric'},
+            '002': {'alias': 'hobbies', 'name': 'Hobbies',
+                    'type': 'categorical_array', 'categories': [],
+                    'subvariables': ['0001', '0002'],
+                    'subreferences': {
+                        '0001': {'alias': 'hobbies_1', 'name': 'Sports'},
+                        '0002': {'alias': 'hobbies_2', 'name': 'Music'}}},
+        })
+        age = Tuple(session, self.variables_url + '001/', alias='age')
+        hobbies = Tuple(session, self.variables_url + '002/', alias='hobbies',
+                        subvariables=['0001/', '0002/'])
+        backfill = MagicMock()
+        backfill.dataset._vars = [(age.entity_url, age),
+                                  (hobbies.entity_url, hobbies)]
+        backfill.dataset.resource = metadata
+
+        assert BackfillFromCSV.load_vars_by_alias(backfill) == {
+            'age': self.variables_url + '001/',
+            'hobbies': self.variables_url + '002/',
+            'hobbies_1': self.variables_url + '002/subvariables/0001/',
+            'hobbies_2': self.variables_url + '002/subvariables/0002/',
+        }
+        assert session.requests == []
+
+
 class TestFillVariables(TestCase):
     def prepare_ds(self):
         session = MockSession()
@@ -2112,7 +2274,7 @@ class TestFillVariables(TestCase):
         ds.create_fill_values(responses, alias="filled", name="Filled var")
 
         # Check that the POST request contains the expected expression
-        post_request = session.requests[-3]
+        post_request = session.requests[-2]
         self.assertEqual(post_request.method, "POST")
         self.assertEqual(post_request.url, "http://host/api/projects/abc/variables/")
         case_expr = {
@@ -2168,6 +2330,24 @@ class TestFillVariables(TestCase):
         }
         self.assertEqual(result, expected)
 
+    def test_created_variable_added_to_catalog(self):
+        ds, session = self.prepare_ds()
+        assert ds._lookup_variable('Filled var') is None
+        responses = [{"case": "var_a == 1", "variable": "var_a"}]
+        ds.create_fill_values(responses, alias="filled", name="Filled var")
+
+        # Only the new variable is fetched after the POST, not the catalog
+        methods = [(r.method, r.url) for r in session.requests]
+        post = methods.index(('POST', 'http://host/api/projects/abc/variables/'))
+        assert methods[post + 1:] == [
+            ('GET', 'http://host/api/projects/abc/variables/123/')]
+        new_var = ds._lookup_variable('Filled var')
+        assert new_var.entity_url == 'http://host/api/projects/abc/variables/123/'
+        assert len(ds) == 3
+
+        ds.refresh_variables()
+        assert session.requests[-1].url == 'http://host/api/projects/abc/variables/'
+
     def test_else_code(self):
         ds, session = self.prepare_ds()
         responses = [
@@ -2179,7 +2359,7 @@ class TestFillVariables(TestCase):
         ds.create_fill_values(responses, alias="filled", name="Filled var")
 
         # Check that the POST request contains the expected expression
-        post_request = session.requests[-3]
+        post_request = session.requests[-2]
         self.assertEqual(post_request.method, "POST")
         self.assertEqual(post_request.url, "http://host/api/projects/abc/variables/")
         case_expr = {
@@ -2236,7 +2416,7 @@ class TestFillVariables(TestCase):
         ds.create_fill_values(responses, alias="filled", name="Filled var")
 
         # Check that the POST request contains the expected expression
-        post_request = session.requests[-3]
+        post_request = session.requests[-2]
         self.assertEqual(post_request.method, "POST")
         self.assertEqual(post_request.url, "http://host/api/projects/abc/variables/")
         case_expr = {
@@ -2284,6 +2464,629 @@ class TestFillVariables(TestCase):
         })
 
 
+class DatasetMutationsBase(object):
+    ds_url = 'http://host/api/datasets/abc/'
+    variables_url = 'http://host/api/datasets/abc/variables/'
+
+    def var_url(self, var_id):
+        return '%s%s/' % (self.variables_url, var_id)
+
+    def prepare_ds(self):
+        session = MockSession()
+        dataset_resource = Entity(session, **{
+            "element": "shoji:entity",
+            "self": self.ds_url,
+            "body": {"id": "abc", "name": "test_dataset", "streaming": "no"},
+            "catalogs": {
+                "variables": self.variables_url,
+                "table": self.ds_url + 'table/'
+            }
+        })
+        variables = {
+            "001": {"alias": "age", "name": "Age", "type": "numeric",
+                    "id": "001", "derived": False},
+            "002": {"alias": "income", "name": "Income", "type": "numeric",
+                    "id": "002", "derived": False},
+            "003": {"alias": "gender", "name": "Gender",
+                    "type": "categorical", "id": "003", "derived": False},
+        }
+        session.add_fixture(self.variables_url, {
+            "element": "shoji:catalog",
+            "self": self.variables_url,
+            "index": {var_id + '/': body for var_id, body in variables.items()}
+        })
+        session.add_fixture(self.ds_url + 'table/?limit=0', {
+            "element": "crunch:table",
+            "self": self.ds_url + 'table/?limit=0',
+            "metadata": {
+                var_id: dict(body, view={'show_counts': False})
+                for var_id, body in variables.items()
+            }
+        })
+        for var_id, body in variables.items():
+            body = dict(body)
+            if body['type'] == 'categorical':
+                body['categories'] = TEST_CATEGORIES()
+            session.add_fixture(self.var_url(var_id), {
+                "element": "shoji:entity",
+                "self": self.var_url(var_id),
+                "body": body,
+                "fragments": {
+                    "missing_rules": self.var_url(var_id) + 'missing_rules/'
+                }
+            })
+        dataset_resource.folders = MagicMock()
+        ds = MutableDataset(dataset_resource)
+        return ds, session
+
+    def response(self, status_code, payload=None):
+        response = Response()
+        response.status_code = status_code
+        if payload is not None:
+            response.headers['Content-Type'] = 'application/json'
+            response._content = json.dumps(payload).encode('utf-8')
+            response.request = MagicMock(url=self.variables_url)
+        return response
+
+
+class TestDatasetBatch(DatasetMutationsBase, TestCase):
+
+    def test_edits_sent_in_one_catalog_patch(self):
+        ds, session = self.prepare_ds()
+        age, income = ds['age'], ds['income']
+        session.add_patch_response(self.response(204))
+        del session.requests[:]
+
+        with ds.batch():
+            age.edit(name='Age in years')
+            age.edit(description='At the time of the survey')
+            age.hide()
+            income.unhide()
+            # Visible right away, even though nothing was sent
+            assert age.name == 'Age in years'
+            assert session.requests == []
+
+        methods = [(r.method, r.url) for r in session.requests]
+        assert methods == [
+            ('PATCH', self.variables_url),
+            ('GET', self.variables_url),
+        ]
+        assert json.loads(session.requests[0].body) == {
+            "element": "shoji:catalog",
+            "index": {
+                self.var_url('001'): {
+                    "name": "Age in years",
+                    "description": "At the time of the survey",
+                    "discarded": True,
+                },
+                self.var_url('002'): {"discarded": False},
+            }
+        }
+        assert ds._batch is None
+
+    def test_catalog_patches_chunked(self):
+        ds, session = self.prepare_ds()
+        variables = [ds['age'], ds['income'], ds['gender']]
+        for _ in range(2):
+            session.add_patch_response(self.response(204))
+        del session.requests[:]
+
+        with ds.batch(chunk_size=2):
+            for var in variables:
+                var.hide()
+
+        patches = [json.loads(r.body)['index'] for r in session.requests
+                   if r.method == 'PATCH']
+        assert [len(patch) for patch in patches] == [2, 1]
+
+    def test_categories_and_missing_rules_coalesced(self):
+        ds, session = self.prepare_ds()
+        age, gender = ds['age'], ds['gender']
+        ds.prefetch()
+        session.add_patch_response(self.response(204))
+        session.add_put_response(self.response(204))
+        del session.requests[:]
+
+        with ds.batch():
+            gender.categories[1].edit(name='Man')
+            gender.categories[2].edit(name='Woman')
+            age.set_missing_rules({"skipped": 9})
+            age.set_missing_rules({"skipped": 9, "not asked": 8})
+            assert session.requests == []
+
+        methods = [(r.method, r.url) for r in session.requests]
+        assert methods == [
+            ('PATCH', self.var_url('003')),
+            ('PUT', self.var_url('001') + 'missing_rules/'),
+            ('GET', self.variables_url),
+        ]
+        categories = json.loads(session.requests[0].body)['body']['categories']
+        assert [c['name'] for c in categories][:2] == ['Man', 'Woman']
+        assert json.loads(session.requests[1].body) == {
+            "rules": {"skipped": {"value": 9}, "not asked": {"value": 8}}
+        }
+
+    def test_missing_rules_items_queued(self):
+        ds, session = self.prepare_ds()
+        age = ds['age']
+        session.add_fixture(self.var_url('001') + 'missing_rules/', {
+            "element": "shoji:entity",
+            "body": {"rules": {"refused": {"value": 7}}}
+        })
+        session.add_put_response(self.response(204))
+        age.resource
+        del session.requests[:]
+
+        with ds.batch():
+            age.missing_rules['skipped'] = 9
+            age.missing_rules['not asked'] = 8
+            del age.missing_rules['refused']
+            # Read once, later changes start from the queued rules
+            assert age.missing_rules == {'skipped': 9, 'not asked': 8}
+
+        methods = [(r.method, r.url) for r in session.requests]
+        assert methods == [
+            ('GET', self.var_url('001') + 'missing_rules/'),
+            ('PUT', self.var_url('001') + 'missing_rules/'),
+            ('GET', self.variables_url),
+        ]
+        assert json.loads(session.requests[1].body) == {
+            "rules": {"skipped": {"value": 9}, "not asked": {"value": 8}}
+        }
+
+    def test_nested_batches_flush_once(self):
+        ds, session = self.prepare_ds()
+        age = ds['age']
+        session.add_patch_response(self.response(204))
+        del session.requests[:]
+
+        with ds.batch() as outer:
+            with ds.batch() as inner:
+                age.hide()
+            assert inner is outer
+            assert session.requests == []
+        assert [r.method for r in session.requests] == ['PATCH', 'GET']
+
+    def test_error_discards_queued_edits(self):
+        ds, session = self.prepare_ds()
+        age = ds['age']
+        del session.requests[:]
+
+        with pytest.raises(ZeroDivisionError):
+            with ds.batch():
+                age.hide()
+                1 / 0
+
+        # Nothing sent, local catalog reloaded from the server
+        assert [(r.method, r.url) for r in session.requests] == [
+            ('GET', self.variables_url)]
+        assert ds._batch is None
+
+    def test_failure_does_not_stop_flush(self):
+        ds, session = self.prepare_ds()
+        age, gender = ds['age'], ds['gender']
+        ds.prefetch()
+        session.add_patch_response(self.response(204))
+        session.add_patch_response(self.response(400, {'message': 'Nope'}))
+        session.add_put_response(self.response(204))
+        del session.requests[:]
+
+        with pytest.raises(BatchError) as err:
+            with ds.batch():
+                age.hide()
+                gender.categories[1].edit(name='Man')
+                age.set_missing_rules({"skipped": 9})
+
+        # The missing rules went through after the failed category edit
+        # and the catalog was reloaded
+        methods = [(r.method, r.url) for r in session.requests]
+        assert methods == [
+            ('PATCH', self.variables_url),
+            ('PATCH', self.var_url('003')),
+            ('PUT', self.var_url('001') + 'missing_rules/'),
+            ('GET', self.variables_url),
+        ]
+        [(url, exc)] = err.value.errors
+        assert url == self.var_url('003')
+        assert isinstance(exc, ClientError)
+        assert ds._batch is None
+
+    def test_catalog_server_error_does_not_stop_flush(self):
+        ds, session = self.prepare_ds()
+        age, gender = ds['age'], ds['gender']
+        ds.prefetch()
+        session.add_patch_response(self.response(503, {'message': 'Down'}))
+        session.add_patch_response(self.response(204))
+        session.add_put_response(self.response(204))
+        del session.requests[:]
+
+        with pytest.raises(BatchError) as err:
+            with ds.batch():
+                age.hide()
+                gender.categories[1].edit(name='Man')
+                age.set_missing_rules({"skipped": 9})
+
+        methods = [(r.method, r.url) for r in session.requests]
+        assert methods == [
+            ('PATCH', self.variables_url),
+            ('PATCH', self.var_url('003')),
+            ('PUT', self.var_url('001') + 'missing_rules/'),
+            ('GET', self.variables_url),
+        ]
+        [(url, exc)] = err.value.errors
+        assert url == self.var_url('001')
+        assert isinstance(exc, ServerError)
+        assert ds._batch is None
+
+    def test_created_variables_not_fetched(self):
+        ds, session = self.prepare_ds()
+        created = Response()
+        created.status_code = 201
+        created.headers['Location'] = self.var_url('010')
+        session.add_post_response(created)
+        del session.requests[:]
+
+        with ds.batch():
+            rent = ds.create_numeric('rent', 'Rent', 'age * 2')
+            assert rent.derived is True
+            assert rent.alias == 'rent'
+
+        # The new variable's entity isn't fetched, only the catalog is
+        # reloaded, once, when the batch is done
+        methods = [(r.method, r.url) for r in session.requests]
+        post = methods.index(('POST', self.variables_url))
+        assert methods[post:] == [
+            ('POST', self.variables_url),
+            ('GET', self.variables_url),
+        ]
+
+    def test_no_batch_sends_right_away(self):
+        ds, session = self.prepare_ds()
+        age = ds['age']
+        session.add_patch_response(self.response(204))
+        del session.requests[:]
+        age.hide()
+        assert [(r.method, r.url) for r in session.requests] == [
+            ('GET', self.var_url('001')),
+            ('PATCH', self.var_url('001')),
+        ]
+
+
+class TestCreateVariables(DatasetMutationsBase, TestCase):
+
+    def test_catalog_not_fetched_per_creation(self):
+        ds, session = self.prepare_ds()
+        ds['age']
+        for i in range(3):
+            var_id = '01%d' % i
+            created = Response()
+            created.status_code = 201
+            created.headers['Location'] = self.var_url(var_id)
+            session.add_post_response(created)
+            session.add_fixture(self.var_url(var_id), {
+                "element": "shoji:entity",
+                "self": self.var_url(var_id),
+                "body": {"alias": "rent_%d" % i, "name": "Rent %d" % i,
+                         "type": "numeric", "id": var_id, "derived": True},
+            })
+        del session.requests[:]
+
+        for i in range(3):
+            ds.create_numeric('rent_%d' % i, 'Rent %d' % i, 'age * 2')
+
+        # The table metadata is read again for each derivation, as the
+        # dataset changed, but the variables catalog is never downloaded
+        methods = [(r.method, r.url) for r in session.requests
+                   if not r.url.startswith(self.ds_url + 'table/')]
+        assert methods == [
+            request
+            for i in range(3)
+            for request in [('POST', self.variables_url),
+                            ('GET', self.var_url('01%d' % i))]
+        ]
+        assert ds['rent_2'].url == self.var_url('012')
+
+    def test_multiple_response_subvariables_registered(self):
+        ds, session = self.prepare_ds()
+        registry = ds.alias_registry
+        created = Response()
+        created.status_code = 201
+        created.headers['Location'] = self.var_url('010')
+        session.add_post_response(created)
+        session.add_fixture(self.var_url('010'), {
+            "element": "shoji:entity",
+            "self": self.var_url('010'),
+            "body": {"alias": "mr", "name": "MR", "id": "010",
+                     "type": "multiple_response", "derived": True},
+        })
+
+        ds.create_multiple_response([
+            {'id': 1, 'name': 'Young', 'case': 'age < 30'},
+            {'id': 2, 'name': 'Old', 'case': 'age >= 30'},
+        ], name='MR', alias='mr')
+
+        assert {'mr', 'mr_1', 'mr_2'} <= registry.aliases
+        codes = generate_subvariable_codes(ds, [{'alias': 'mr_1'}])
+        assert codes == ['mr_1__1']
+
+
+class TestEditVariables(DatasetMutationsBase, TestCase):
+
+    def test_edits_sent_as_catalog_patches(self):
+        ds, session = self.prepare_ds()
+        for _ in range(2):
+            session.add_patch_response(self.response(204))
+        registry = ds.alias_registry
+        del session.requests[:]
+
+        failed = ds.edit_variables({
+            'age': {'name': 'Age in years', 'view': {'show_counts': True}},
+            'income': {'description': 'Yearly', 'discarded': True},
+            'gender': {'alias': 'sex'},
+        }, chunk_size=2)
+
+        assert failed == {}
+        assert [(r.method, r.url) for r in session.requests] == [
+            ('PATCH', self.variables_url),
+            ('PATCH', self.variables_url),
+        ]
+        indexes = [json.loads(r.body)['index'] for r in session.requests]
+        assert indexes[0] == {
+            self.var_url('001'): {
+                'name': 'Age in years', 'view': {'show_counts': True}},
+            self.var_url('002'): {'description': 'Yearly', 'discarded': True},
+        }
+        assert indexes[1] == {self.var_url('003'): {'alias': 'sex'}}
+        # The local catalog is updated, not downloaded again
+        assert ds._lookup_variable('Age in years')['alias'] == 'age'
+        assert ds._lookup_variable('sex')['name'] == 'Gender'
+        assert 'sex' in registry and 'gender' not in registry
+
+    def test_variable_edit_renames_alias(self):
+        ds, session = self.prepare_ds()
+        session.add_patch_response(self.response(204))
+        session.add_patch_response(self.response(204))
+        registry = ds.alias_registry
+
+        ds['age'].edit(alias='years')
+        assert 'years' in registry and 'age' not in registry
+        with ds.batch():
+            ds['income'].edit(alias='earnings')
+        assert 'earnings' in registry and 'income' not in registry
+
+    def test_invalid_edits_reported(self):
+        ds, session = self.prepare_ds()
+        session.add_patch_response(self.response(204))
+        del session.requests[:]
+
+        failed = ds.edit_variables({
+            'age': {'name': 'Age in years'},
+            'income': {'type': 'text'},
+            'unknown': {'name': 'Unknown'},
+            'gender': {'derived': True},
+        })
+
+        assert list(failed) == ['income', 'unknown', 'gender']
+        assert isinstance(failed['income'], AttributeError)
+        assert isinstance(failed['gender'], AttributeError)
+        assert isinstance(failed['unknown'], ValueError)
+        # Valid edits are still sent
+        assert len(session.requests) == 1
+        assert list(json.loads(session.requests[0].body)['index']) == [
+            self.var_url('001')]
+
+    def test_rejected_chunk_sent_one_by_one(self):
+        ds, session = self.prepare_ds()
+        error = {'message': 'Alias already in use'}
+        session.add_patch_response(self.response(400, error))
+        session.add_patch_response(self.response(204))
+        session.add_patch_response(self.response(400, error))
+        del session.requests[:]
+
+        failed = ds.edit_variables({
+            'age': {'name': 'Age in years'},
+            'income': {'alias': 'age'},
+        })
+
+        assert list(failed) == ['income']
+        assert failed['income'].status_code == 400
+        assert len(session.requests) == 3
+        assert ds._lookup_variable('Age in years') is not None
+        assert ds._lookup_variable('income')['alias'] == 'income'
+
+
+class TestPrefetch(DatasetMutationsBase, TestCase):
+
+    def test_prefetch_entities(self):
+        ds, session = self.prepare_ds()
+        del session.requests[:]
+
+        ds.prefetch()
+
+        assert sorted(r.url for r in session.requests) == [
+            self.var_url('001'), self.var_url('002'), self.var_url('003')]
+        del session.requests[:]
+        # Reading entity attributes is local now
+        assert [c.name for c in ds['gender'].categories.values()][:2] == [
+            'Female', 'Male']
+        assert ds['age'].resource.body['type'] == 'numeric'
+        assert session.requests == []
+        # Nothing left to fetch
+        ds.prefetch()
+        assert session.requests == []
+
+    def test_prefetch_error_stops_workers(self):
+        ds, session = self.prepare_ds()
+        threads = threading.active_count()
+        with mock.patch.object(Tuple, 'fetch', side_effect=ValueError):
+            with pytest.raises(ValueError):
+                ds.prefetch()
+        assert threading.active_count() == threads
+        assert all(getattr(t, '_entity', None) is None
+                   for _, t in ds._vars)
+
+    def test_prefetch_some_variables(self):
+        ds, session = self.prepare_ds()
+        del session.requests[:]
+        ds.prefetch(['age', 'Gender'])
+        assert sorted(r.url for r in session.requests) == [
+            self.var_url('001'), self.var_url('003')]
+
+        with pytest.raises(ValueError):
+            ds.prefetch(['unknown'])
+
+    def test_prefetch_fields_from_table(self):
+        ds, session = self.prepare_ds()
+        del session.requests[:]
+
+        ds.prefetch(fields=['view'])
+
+        assert [r.url for r in session.requests] == [
+            self.ds_url + 'table/?limit=0']
+        assert ds._lookup_variable('age')['view'] == {'show_counts': False}
+
+        # The table metadata is shared with the expression helpers, the
+        # current snapshot is reused
+        ds._reload_variables()
+        del session.requests[:]
+        ds.prefetch(fields=['view'])
+        assert session.requests == []
+        assert ds._lookup_variable('age')['view'] == {'show_counts': False}
+
+    def test_prefetch_fields_not_in_table(self):
+        ds, session = self.prepare_ds()
+        del session.requests[:]
+        ds.prefetch(['age'], fields=['missing_rules'])
+        assert [r.url for r in session.requests] == [self.var_url('001')]
+
+
+class TestCompactVariables(DatasetMutationsBase, TestCase):
+
+    def test_variable_does_not_fetch_entity(self):
+        ds, session = self.prepare_ds()
+        del session.requests[:]
+        variables = list(ds.values())
+        assert [v.alias for v in variables] == ['age', 'income', 'gender']
+        assert session.requests == []
+        # Subvariables are looked up when needed
+        assert len(variables[0]) == 0
+        assert [r.url for r in session.requests] == [self.var_url('001')]
+
+    def test_cache_variables(self):
+        ds, session = self.prepare_ds()
+        assert ds['age'] is not ds['age']
+        ds.cache_variables()
+        age = ds['age']
+        assert ds['age'] is age
+        assert [v for v in ds.values() if v.alias == 'age'] == [age]
+        ds.refresh_variables()
+        assert ds['age'] is not age
+        ds.cache_variables(False)
+        assert ds['age'] is not ds['age']
+
+    def test_memory_on_wide_catalog(self):
+        tracemalloc = pytest.importorskip('tracemalloc')
+
+        class DictVariable(object):
+            # The attributes Variable had before it used __slots__
+            def __init__(self, var_tuple, dataset):
+                self.shoji_tuple = var_tuple
+                self.is_instance = False
+                self._resource = None
+                self.url = var_tuple.entity_url
+                self.dataset = dataset
+                self._vars = []
+                self._catalog = {}
+
+        dataset = MagicMock()
+        dataset.resource.body = {'streaming': 'no'}
+        tuples = [
+            Tuple(None, '%s%04d/' % (self.variables_url, i), alias='v%d' % i,
+                  name='Variable %d' % i, type='numeric', derived=False)
+            for i in range(5000)
+        ]
+
+        def allocated(variable_class):
+            tracemalloc.start()
+            try:
+                variables = [variable_class(t, dataset) for t in tuples]
+                size, _ = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            assert len(variables) == len(tuples)
+            return size
+
+        assert allocated(Variable) < 0.9 * allocated(DictVariable)
+
+    def test_attributes_assignable(self):
+        ds, _ = self.prepare_ds()
+        var = ds['age']
+        var.CATEGORICAL_TYPES = {'numeric'}
+        assert var.CATEGORICAL_TYPES == {'numeric'}
+        with pytest.raises(AttributeError):
+            var.name = 'Other'
+
+
+class TestIterVariables(DatasetMutationsBase, TestCase):
+
+    def test_iter_variables(self):
+        ds, session = self.prepare_ds()
+        for offset, var_ids in ((0, ['001', '002']), (2, ['003'])):
+            url = '%s?limit=2&offset=%d' % (self.variables_url, offset)
+            session.add_fixture(url, {
+                "element": "shoji:catalog",
+                "self": url,
+                "index": {
+                    var_id + '/': {"alias": "var_" + var_id, "id": var_id,
+                                   "name": "Variable " + var_id,
+                                   "type": "numeric", "derived": False}
+                    for var_id in var_ids
+                }
+            })
+        del session.requests[:]
+
+        variables = ds.iter_variables(batch_size=2)
+        first = next(variables)
+        assert isinstance(first, Variable)
+        assert first.url == self.var_url('001')
+        assert first.dataset is ds
+        assert len(session.requests) == 1
+        rest = list(variables)
+        assert [v.alias for v in rest] == ['var_002', 'var_003']
+        assert len(session.requests) == 2
+        # Entity data is fetched as for the other variables
+        assert rest[1].categories[1].name == 'Female'
+        assert session.requests[-1].url == self.var_url('003')
+
+
+class TestSnapshotSchema(DatasetMutationsBase, TestCase):
+
+    def test_snapshot_schema(self):
+        ds, session = self.prepare_ds()
+        exclusion = {'function': '==', 'args': [{'var': 'age'}, {'value': 1}]}
+        ds.resource.exclusion = {'body': {'expression': exclusion}}
+        ds.folders = MagicMock()
+        ds.folders.tree.return_value = {
+            'public': {'name': 'Public', 'children': ['age', 'gender']}}
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        path = os.path.join(path, 'schema.jsonl.gz')
+
+        ds.snapshot_schema(path)
+        del session.requests[:]
+        snapshot = DatasetMetadata.load(path)
+        assert snapshot.dataset == {
+            'id': 'abc', 'name': 'test_dataset', 'url': self.ds_url}
+        assert snapshot.exclusion == exclusion
+        assert snapshot.folders == ds.folders.tree.return_value
+        assert sorted(snapshot.catalog) == [
+            self.var_url('001'), self.var_url('002'), self.var_url('003')]
+        assert snapshot.catalog[self.var_url('003')]['alias'] == 'gender'
+        assert snapshot.variable_aliases() == {'age', 'income', 'gender'}
+        assert snapshot.variables['age']['view'] == {'show_counts': False}
+        assert session.requests == []
+
+
 class TestRecode(TestDatasetBase):
     def test_recode_single_categorical(self):
         variables = {
@@ -2739,6 +3542,34 @@ class TestRecode(TestDatasetBase):
             }
         })
 
+    def test_create_categorical_metadata_read_once(self):
+        variables = {
+            'var_a': {
+                'id': '001',
+                'alias': 'var_a',
+                'name': 'Variable A',
+                'type': 'numeric',
+                'is_subvar': False
+            },
+        }
+        ds_mock = self._dataset_mock(variables=variables)
+        ds = StreamingDataset(ds_mock)
+        categories = [
+            {'id': i, 'name': 'Age %d' % i, 'case': 'var_a == %d' % i}
+            for i in range(1, 201)
+        ]
+        with mock.patch.object(DatasetMetadata, 'fetch',
+                               wraps=DatasetMetadata.fetch) as fetch:
+            with pytest.raises(ValueError) as err:
+                ds.create_categorical(
+                    categories, alias='agerange', name='Age Range',
+                    multiple=False)
+        assert 'Entity test_dataset_name has no (sub)variable' in str(err.value)
+        assert fetch.call_count == 1
+        expr = ds.resource.variables.create.call_args[0][0]['body']['expr']
+        assert expr['args'][200] == {
+            'function': '==', 'args': [{'var': 'var_a'}, {'value': 200}]}
+
     def test_create_2_multiple_response_else_case(self):
         variables = {
             'age': {
@@ -3693,6 +4524,39 @@ class TestRecode(TestDatasetBase):
             }
         })
 
+    def test_expression_cases(self):
+        variables = {
+            'var_a': {
+                'id': '001',
+                'alias': 'var_a',
+                'name': 'Variable A',
+                'type': 'numeric',
+                'is_subvar': False
+            },
+        }
+        ds = StreamingDataset(self._dataset_mock(variables=variables))
+        categories = [
+            {'id': 1, 'name': 'Yes', 'selected': True},
+            {'id': 2, 'name': 'No'},
+        ]
+
+        def payload(wrap):
+            with pytest.raises(ValueError):
+                ds.derive_multiple_response(categories, [
+                    {'id': 1, 'name': 'Low',
+                     'cases': {1: wrap('var_a < 2'), 2: wrap('var_a >= 2')}},
+                ], name='my mr', alias='mr')
+            with pytest.raises(ValueError):
+                ds.create_multiple_response([
+                    {'id': 1, 'name': 'Low', 'case': wrap('var_a < 2')},
+                    {'id': 2, 'name': 'High', 'case': wrap('var_a >= 2')},
+                ], name='other mr', alias='other')
+            return [call[0][0]
+                    for call in ds.resource.variables.create.call_args_list[-2:]]
+
+        # Expressions make the same payloads as the strings they wrap
+        assert payload(Expression) == payload(lambda expr: expr)
+
 
 class TestCopyVariable(TestCase):
 
@@ -5734,10 +6598,16 @@ class TestDatasetExport(TestCase):
 
     def test_basic_json_export(self, export_ds_mock, dl_file_mock):
         ds = self.ds
-        ds.resource.table.__getitem__.return_value = 'json serializable'
-        ds.export('export.csv', metadata_path='metadata.json')
+        metadata = {'001': {'alias': 'age', 'name': 'Age', 'type': 'numeric'}}
+        ds.resource.follow.return_value = mock.MagicMock(metadata=metadata)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        metadata_path = os.path.join(path, 'metadata.json')
+        ds.export('export.csv', metadata_path=metadata_path)
 
-        ds.resource.table.__getitem__.assert_called_with('metadata')
+        ds.resource.follow.assert_called_with('table', 'limit=0')
+        with open(metadata_path) as f:
+            assert json.load(f) == metadata
 
     def test_csv_export_options(self, export_ds_mock, dl_file_mock):
         ds = self.ds
@@ -6427,7 +7297,7 @@ class TestHeadingSubtotals(TestDatasetBase):
 
         # Assert that the last PATCH made contains paylod including BOTH
         # transforms. The existing and the new one
-        final_patch = session.adapter.requests[-2]
+        final_patch = session.adapter.requests[-1]
         payload = json.loads(final_patch.body)
         assert final_patch.method == "PATCH"
         assert final_patch.url == var_url
@@ -6452,14 +7322,46 @@ class TestSubvariableCodes:
         def _mock_getitem(_alias):
             return "/variables/%s/" % _alias
 
-        def _mock_aliases(include_subvariables=True):
-            return {"var_1", "var_2"}
+        _mock_aliases = MagicMock(return_value={"var_1", "var_2"})
 
         setattr(dataset, "_var_create_reload_return", _mock_create)
         setattr(dataset, "get_url_by_alias", _mock_getitem)
         setattr(dataset, "variable_aliases", _mock_aliases)
         return dataset, args
 
+    def test_alias_registry(self):
+        registry = AliasRegistry(["age", "age__3", "q1__x", "q2__1"])
+        assert registry.unique("gender") == "gender"
+        assert registry.unique("gender") == "gender__1"
+        # Counters start from the highest suffix in use
+        assert registry.unique("age") == "age__4"
+        assert registry.unique("age__3") == "age__5"
+        assert registry.unique("q1__x") == "q1__x__1"
+        assert registry.unique("q2__1") == "q2__2"
+        assert registry.unique("q2") == "q2"
+        registry.rename("age", "years")
+        assert "age" not in registry and "years" in registry
+        assert registry.unique("age") == "age"
+
+    def test_aliases_read_once(self):
+        dataset, args = self.prepare_dataset()
+        subvariables = [
+            {"alias": "var_1", "name": "Variable 1"},
+            {"alias": "var_3", "name": "Variable 3"},
+        ]
+        dataset.bind_categorical_array("Array 1", "array_1", subvariables)
+        dataset.bind_categorical_array("Array 2", "array_2", subvariables)
+
+        dataset.variable_aliases.assert_called_once_with(
+            include_subvariables=True)
+        codes = [
+            [subref["alias"] for subref in
+             payload["body"]["derivation"]["references"]["subreferences"]]
+            for payload in args
+        ]
+        # The codes generated for the first array are taken for the second
+        assert codes == [["var_1__1", "var_3"], ["var_1__2", "var_3__1"]]
+
     def test_bind_categorical_array_without_codes(self):
         dataset, args = self.prepare_dataset()
         subvariables = [
@@ -1,13 +1,17 @@
+import copy
 import sys
+from collections import OrderedDict
 
 import pytest
 import mock
 from unittest import TestCase
 
 import scrunch
-from scrunch.datasets import parse_expr
+from scrunch.expressions import parse_expr
 from scrunch.datasets import process_expr
-from scrunch.expressions import prettify, adapt_multiple_response, get_dataset_variables
+from scrunch import expressions
+from scrunch.expressions import Expression, prettify, adapt_multiple_response, get_dataset_variables
+from scrunch.metadata import DatasetMetadata
 from scrunch.tests.conftest import mark_fail_py2
 
 
@@ -5319,3 +5323,311 @@ class TestGetDatasetVariables(TestCase):
                 "categories": categories
             }
         }
+
+
+class TestProcessExprBenchmark(TestCase):
+    """
+    Generated filters have hundreds of and/or clauses, processing them has
+    to stay linear in their size.
+    """
+    metadata = {
+        '001': {
+            'alias': 'gender', 'name': 'Gender', 'type': 'categorical',
+            'categories': [{'id': 1, 'name': 'Female'}, {'id': 2, 'name': 'Male'}],
+        },
+        '002': {
+            'alias': 'hobbies', 'name': 'Hobbies', 'type': 'categorical_array',
+            'categories': [{'id': 1, 'name': 'Yes'}, {'id': 2, 'name': 'No'}],
+            'subvariables': ['0001', '0002'],
+            'subreferences': {
+                '0001': {'alias': 'hobbies_1', 'name': 'Sports'},
+                '0002': {'alias': 'hobbies_2', 'name': 'Music'},
+            },
+        },
+        '003': {'alias': 'age', 'name': 'Age', 'type': 'numeric'},
+    }
+
+    def clause(self, i):
+        if i % 2:
+            return {'function': 'in', 'args': [
+                {'var': 'gender'}, {'value': ['Female', 'Male']}]}
+        return {'function': '==', 'args': [
+            {'var': 'hobbies_1'}, {'value': i}]}
+
+    def deep(self, depth):
+        expr = self.clause(0)
+        for i in range(1, depth):
+            expr = {'function': 'and' if i % 2 else 'or',
+                    'args': [self.clause(i), expr]}
+        return expr
+
+    def wide(self, width):
+        return {'function': 'or', 'args': [
+            {'function': 'and', 'args': [
+                self.clause(i),
+                {'function': '>', 'args': [{'var': 'age'}, {'value': i}]},
+            ]}
+            for i in range(width)
+        ]}
+
+    def test_input_copied_once(self):
+        ds = DatasetMetadata(copy.deepcopy(self.metadata))
+        for expr in (self.deep(100), self.wide(100)):
+            original = copy.deepcopy(expr)
+            with mock.patch.object(expressions, 'copy', wraps=copy) as copy_mock:
+                result = process_expr(expr, ds)
+            assert copy_mock.deepcopy.call_count == 1
+            assert expr == original
+            assert result != original
+
+        result = process_expr(self.deep(3), ds)
+        assert result == {'function': 'or', 'args': [
+            {'function': '==', 'args': [
+                {'var': 'hobbies', 'axes': ['hobbies_1']}, {'value': 2}]},
+            {'function': 'and', 'args': [
+                {'function': 'in', 'args': [
+                    {'var': 'gender'}, {'value': [1, 2]}]},
+                {'function': '==', 'args': [
+                    {'var': 'hobbies', 'axes': ['hobbies_1']}, {'value': 0}]},
+            ]},
+        ]}
+
+    def test_linear_time(self):
+        ds = DatasetMetadata(copy.deepcopy(self.metadata))
+
+        def nodes(obj):
+            if isinstance(obj, dict):
+                return 1 + sum(nodes(value) for value in obj.values())
+            if isinstance(obj, list):
+                return sum(nodes(item) for item in obj)
+            return 0
+
+        def operations(expr):
+            # Nodes copied and list items looked at
+            counts = {'copied': 0, 'checked': 0}
+            real_is_number = expressions.is_number
+
+            def deepcopy(obj):
+                counts['copied'] += nodes(obj)
+                return copy.deepcopy(obj)
+
+            def is_number(value):
+                counts['checked'] += 1
+                return real_is_number(value)
+
+            with mock.patch.object(expressions, 'copy') as copy_mock, \
+                    mock.patch.object(expressions, 'is_number', is_number):
+                copy_mock.deepcopy.side_effect = deepcopy
+                process_expr(expr, ds)
+            return counts
+
+        for build, size in ((self.deep, 100), (self.wide, 300)):
+            # Twice the clauses, about twice the work. A copy per level
+            # made deep filters quadratic: close to 4 times.
+            small, big = operations(build(size)), operations(build(size * 2))
+            for key in small:
+                ratio = float(big[key]) / small[key]
+                assert ratio < 2.5, (build.__name__, key, ratio)
+
+    def test_category_names_indexed(self):
+        ds = DatasetMetadata(copy.deepcopy(self.metadata))
+        # Variables without categories after the filtered one don't stop
+        # the names from being resolved
+        assert process_expr(parse_expr('gender == "Male"'), ds) == {
+            'function': '==', 'args': [{'var': 'gender'}, {'value': 2}]}
+        with pytest.raises(ValueError):
+            process_expr(parse_expr('gender == "Other"'), ds)
+
+        expr = {'function': 'or', 'args': [
+            {'function': 'in', 'args': [
+                {'var': 'gender'}, {'value': ['Female', 'Male', 3]}]}
+            for _ in range(2000)
+        ]}
+        result = process_expr(expr, ds)
+        assert all(
+            clause['args'][1] == {'value': [1, 2, 3]}
+            for clause in result['args'])
+        # The {name: ids} index is built once, for the filtered variable
+        assert list(ds._category_ids) == ['gender']
+
+    def test_unknown_category_names(self):
+        # A single unknown name is an error, even when variables without
+        # categories come before the filtered one
+        ds = DatasetMetadata(OrderedDict(sorted(
+            copy.deepcopy(self.metadata).items(),
+            key=lambda item: item[0] != '003')))
+        with pytest.raises(ValueError):
+            process_expr(parse_expr('gender == "Other"'), ds)
+        # Unknown names in a list are left out, as they always were
+        expr = {'function': 'in', 'args': [
+            {'var': 'gender'}, {'value': ['Male', 'Other', 3]}]}
+        assert process_expr(expr, ds) == {
+            'function': 'in', 'args': [{'var': 'gender'}, {'value': [2, 3]}]}
+
+    def test_duplicate_category_names(self):
+        metadata = copy.deepcopy(self.metadata)
+        metadata['001']['categories'].append({'id': 3, 'name': 'Male'})
+        ds = DatasetMetadata(metadata)
+        # A single name takes the first category, lists take all of them
+        assert process_expr(parse_expr('gender == "Male"'), ds) == {
+            'function': '==', 'args': [{'var': 'gender'}, {'value': 2}]}
+        assert process_expr(parse_expr('gender in ["Male", "Female"]'), ds) == {
+            'function': 'in', 'args': [{'var': 'gender'}, {'value': [2, 3, 1]}]}
+
+
+class TestParseCache(TestCase):
+
+    def setUp(self):
+        parse_expr.cache_clear()
+        self.addCleanup(parse_expr.cache_clear)
+        self.addCleanup(
+            expressions.set_parse_cache_size, expressions.PARSE_CACHE_SIZE)
+
+    def test_cached(self):
+        expr = parse_expr('age > 30 and gender in [1, 2]')
+        assert parse_expr('age > 30 and gender in [1, 2]') is expr
+        assert parse_expr('age > 40') is not expr
+        info = parse_expr.cache_info()
+        assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+        assert info.maxsize == expressions.PARSE_CACHE_SIZE
+
+    def test_read_only(self):
+        expr = parse_expr('gender in ["Male"]')
+        with pytest.raises(TypeError):
+            expr['function'] = 'not'
+        with pytest.raises(TypeError):
+            expr['args'].append({'value': 1})
+        with pytest.raises(TypeError):
+            expr['args'][1]['value'][0] = 'Female'
+
+        mutable = copy.deepcopy(expr)
+        assert type(mutable) is dict
+        assert type(mutable['args'][1]['value']) is list
+        assert mutable == expr
+        mutable['args'][1]['value'][0] = 'Female'
+        assert parse_expr('gender in ["Male"]')['args'][1]['value'] == ['Male']
+
+    def test_process_expr_leaves_cache_alone(self):
+        ds = DatasetMetadata({
+            '001': {'alias': 'gender', 'name': 'Gender', 'type': 'categorical',
+                    'categories': [{'id': 1, 'name': 'Female'},
+                                   {'id': 2, 'name': 'Male'}]},
+        })
+        expr = parse_expr('gender in ["Male"]')
+        assert process_expr(expr, ds)['args'][1] == {'value': [2]}
+        assert process_expr([expr], ds)[0]['args'][1] == {'value': [2]}
+        assert parse_expr('gender in ["Male"]') == {
+            'function': 'in',
+            'args': [{'var': 'gender'}, {'value': ['Male']}]}
+
+    def test_cache_size(self):
+        expressions.set_parse_cache_size(1)
+        first = parse_expr('age > 1')
+        parse_expr('age > 2')
+        assert parse_expr('age > 1') is not first
+        assert parse_expr.cache_info().currsize == 1
+
+        expressions.set_parse_cache_size(0)
+        assert parse_expr.cache_info().currsize == 0
+        assert parse_expr('age > 1') is not parse_expr('age > 1')
+
+
+class TestExpression(TestCase):
+
+    def wave(self, version, categories=None, subvariables=('0001', '0002')):
+        categories = categories or [
+            {'id': 1, 'name': 'Female'}, {'id': 2, 'name': 'Male'}]
+        return DatasetMetadata({
+            '001': {'alias': 'gender', 'name': 'Gender', 'type': 'categorical',
+                    'categories': categories},
+            '002': {'alias': 'hobbies', 'name': 'Hobbies',
+                    'type': 'categorical_array',
+                    'categories': [{'id': 1, 'name': 'Yes'}],
+                    'subvariables': list(subvariables),
+                    'subreferences': {
+                        subvar_id: {'alias': 'hobbies_%d' % int(subvar_id),
+                                    'name': 'Hobby %s' % subvar_id}
+                        for subvar_id in subvariables}},
+            '003': {'alias': 'age', 'name': 'Age wave %d' % version,
+                    'type': 'numeric'},
+        }, version=version)
+
+    def test_bind(self):
+        expr = Expression('gender in ["Male"] and hobbies_1 == 1')
+        assert expr.aliases == {'gender', 'hobbies_1'}
+        ds = self.wave(1)
+        assert expr.bind(ds) == process_expr(
+            parse_expr('gender in ["Male"] and hobbies_1 == 1'), ds)
+        assert process_expr(expr, ds) is expr.bind(ds)
+        assert parse_expr(expr) is expr.parsed
+        assert parse_expr(expr)['function'] == 'and'
+        with pytest.raises(TypeError):
+            expr.bind(ds)['function'] = 'or'
+
+    def test_same_layout_reused(self):
+        expr = Expression('gender in ["Male"] and age > 30')
+        with mock.patch.object(
+                expressions, 'process_expr',
+                wraps=expressions.process_expr) as process:
+            first = expr.bind(self.wave(1))
+            # Other names or versions don't change the processed expression
+            assert expr.bind(self.wave(2)) is first
+            assert process.call_count == 1
+
+            # Different categories do
+            other = expr.bind(self.wave(3, categories=[
+                {'id': 2, 'name': 'Female'}, {'id': 1, 'name': 'Male'}]))
+            assert other['args'][0]['args'][1] == {'value': [1]}
+            assert process.call_count == 2
+
+            # Subvariables of variables the expression doesn't use don't
+            assert expr.bind(self.wave(4, subvariables=['0001'])) is first
+            assert process.call_count == 2
+
+    def test_subvariable_layout(self):
+        expr = Expression('hobbies_1 == 1')
+        assert (expr.fingerprint(self.wave(1))
+                != expr.fingerprint(self.wave(1, subvariables=['0001'])))
+        assert (expr.fingerprint(self.wave(1))
+                == expr.fingerprint(self.wave(2)))
+
+    def test_invalid_alias_not_cached(self):
+        expr = Expression('unknown == 1')
+        with pytest.raises(ValueError):
+            expr.bind(self.wave(1))
+        assert len(expr._bindings) == 0
+
+    def test_exclude(self):
+        ds = mock.MagicMock()
+        ds.resource.fragments.exclusion = 'http://host/api/datasets/abc/exclusion/'
+        expr = Expression('age > 30')
+        with mock.patch('scrunch.datasets.process_expr') as process:
+            process.return_value = {'function': '>'}
+            scrunch.datasets.BaseDataset.exclude(ds, expr)
+        process.assert_called_once_with(expr, ds.resource)
+
+
+class TestProcessExprs(TestCase):
+
+    def test_one_metadata_download(self):
+        ds = mock.MagicMock()
+        ds.self = 'http://host/api/datasets/abc/'
+        ds.body = {'modification_time': '2020-01-01T00:00:00'}
+        ds.follow.return_value = mock.MagicMock(metadata={
+            '001': {'alias': 'gender', 'name': 'Gender', 'type': 'categorical',
+                    'categories': [{'id': 1, 'name': 'Female'},
+                                   {'id': 2, 'name': 'Male'}]},
+            '002': {'alias': 'age', 'name': 'Age', 'type': 'numeric'},
+        })
+        exprs = ['age == %d' % i for i in range(100)] + [
+            Expression('gender in ["Male"]'),
+            parse_expr('gender in ["Female"]'),
+        ]
+        processed = expressions.process_exprs(exprs, ds)
+        ds.follow.assert_called_once_with('table', 'limit=0')
+        assert len(processed) == 102
+        assert processed[99] == process_expr(parse_expr('age == 99'), ds)
+        assert processed[100]['args'][1] == {'value': [2]}
+        assert processed[101]['args'][1] == {'value': [1]}
+
+        assert expressions.process_exprs([], mock.MagicMock()) == []
@@ -248,3 +248,72 @@ def test_unique_folders_no_hidden():
     assert dataset.folders.public.name == "Public"
     assert not hasattr(dataset.folders, "secure")
     assert not hasattr(dataset.folders, "hidden")
+
+
+def test_folders_tree():
+    session = MockSession()
+    dataset_url = 'http://host/api/datasets/abc/'
+    folders_url = 'http://host/api/datasets/abc/folders/'
+    public_url = 'http://host/api/datasets/abc/folders/public/'
+    subfolder_url = 'http://host/api/datasets/abc/folders/1/'
+    var_url = 'http://host/api/datasets/abc/variables/%s/'
+    dataset_resource = Entity(session, **{
+        "element": "shoji:entity",
+        "self": dataset_url,
+        "body": {
+            "name": "test_dataset_project"
+        },
+        "catalogs": {
+            "folders": folders_url,
+        }
+    })
+    dataset_resource.variables = MagicMock()
+    dataset_resource.settings = MagicMock()
+    folders_resource = Catalog(session, **{
+        "element": "shoji:catalog",
+        "self": folders_url,
+        "index": {},
+        "body": {
+            "name": "Root"
+        },
+        "catalogs": {
+            "public": public_url,
+        }
+    })
+    public_resource = Catalog(session, **{
+        "element": "shoji:catalog",
+        "self": public_url,
+        "index": {
+            var_url % '001': {"type": "numeric", "alias": "age"},
+            subfolder_url: {"type": "folder", "name": "Demographics"},
+        },
+        "body": {
+            "name": "Public"
+        },
+        "graph": [subfolder_url, var_url % '001'],
+    })
+    subfolder_resource = Catalog(session, **{
+        "element": "shoji:catalog",
+        "self": subfolder_url,
+        "index": {
+            var_url % '002': {"type": "categorical", "alias": "gender"},
+        },
+        "body": {
+            "name": "Demographics"
+        },
+        "graph": [var_url % '002'],
+    })
+    session.add_fixture(folders_url, folders_resource)
+    session.add_fixture(public_url, public_resource)
+    session.add_fixture(subfolder_url, subfolder_resource)
+    dataset = MutableDataset(dataset_resource)
+
+    assert dataset.folders.tree() == {
+        'public': {
+            'name': 'Public',
+            'children': [
+                {'name': 'Demographics', 'children': ['gender']},
+                'age',
+            ]
+        }
+    }
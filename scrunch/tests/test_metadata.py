@@ -0,0 +1,208 @@
+import copy
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+from pycrunch.elements import ElementSession
+from pycrunch.lemonpy import URL
+from pycrunch.shoji import Tuple
+from requests import Response
+from unittest import TestCase
+
+from scrunch import metadata
+from scrunch.expressions import get_dataset_variables, parse_expr, process_expr
+from scrunch.helpers import generate_subvariable_codes
+from scrunch.metadata import DatasetMetadata, dataset_metadata
+from scrunch.mutable_dataset import MutableDataset, compare_datasets
+from scrunch.tests.mock_session import MockSession
+
+
+TABLE_METADATA = {
+    '001': {
+        'alias': 'gender',
+        'name': 'Gender',
+        'type': 'categorical',
+        'categories': [
+            {'id': 1, 'name': 'Female'},
+            {'id': 2, 'name': 'Male'},
+        ],
+    },
+    '002': {
+        'alias': 'hobbies',
+        'name': 'Hobbies',
+        'type': 'categorical_array',
+        'categories': [{'id': 1, 'name': 'Yes'}, {'id': 2, 'name': 'No'}],
+        'subvariables': ['0001', '0002'],
+        'subreferences': {
+            '0001': {'alias': 'hobbies_1', 'name': 'Sports'},
+            '0002': {'alias': 'hobbies_2', 'name': 'Music'},
+        },
+    },
+    '003': {'alias': 'age', 'name': 'Age', 'type': 'numeric'},
+}
+
+
+class TestDatasetMetadata(TestCase):
+    ds_url = 'http://host/api/datasets/abc/'
+
+    def resource(self, modification_time='2020-01-01T00:00:00'):
+        resource = mock.MagicMock()
+        resource.self = self.ds_url
+        resource.body = {'modification_time': modification_time}
+        resource.follow.return_value = mock.MagicMock(
+            metadata=copy.deepcopy(TABLE_METADATA))
+        return resource
+
+    def test_indexes(self):
+        snapshot = DatasetMetadata(copy.deepcopy(TABLE_METADATA))
+        assert snapshot.variables['gender']['id'] == '001'
+        assert snapshot.variables['hobbies_1']['parent_id'] == '002'
+        assert snapshot.variables['hobbies[hobbies_2]']['is_subvar']
+        assert snapshot.parents == {
+            'hobbies_1': 'hobbies', 'hobbies_2': 'hobbies'}
+        assert snapshot.category_ids('gender') == {'Female': [1], 'Male': [2]}
+        assert snapshot.category_ids('hobbies_1') == {'Yes': [1], 'No': [2]}
+        assert snapshot.category_ids('age') == {}
+        assert snapshot.variable_aliases() == {'gender', 'hobbies', 'age'}
+        assert snapshot.variable_aliases(include_subvariables=True) == {
+            'gender', 'hobbies', 'age', 'hobbies_1', 'hobbies_2'}
+        # The API payload is left untouched
+        assert snapshot.metadata == TABLE_METADATA
+
+    def test_fetched_once(self):
+        resource = self.resource()
+        variables = get_dataset_variables(resource)
+        assert dataset_metadata(resource).variables is variables
+        assert get_dataset_variables(resource) is variables
+        resource.follow.assert_called_once_with('table', 'limit=0')
+
+    def test_new_version_fetched(self):
+        resource = self.resource()
+        snapshot = dataset_metadata(resource)
+        resource.body['modification_time'] = '2020-01-02T00:00:00'
+        assert dataset_metadata(resource) is not snapshot
+        assert resource.follow.call_count == 2
+
+    def test_invalidate(self):
+        resource = self.resource()
+        snapshot = dataset_metadata(resource)
+        metadata.invalidate('http://host/api/datasets/other/')
+        assert dataset_metadata(resource) is snapshot
+        metadata.invalidate(self.ds_url + 'variables/001/')
+        assert dataset_metadata(resource) is not snapshot
+
+    def test_session_writes_invalidate(self):
+        resource = self.resource()
+        snapshot = dataset_metadata(resource)
+        session = MockSession()
+        session.add_fixture(self.ds_url + 'variables/', {})
+        session.get(self.ds_url + 'variables/')
+        assert snapshot.is_current(resource)
+
+        response = Response()
+        response.status_code = 204
+        session.add_patch_response(response)
+        session.patch(self.ds_url + 'variables/', '{}')
+        assert not snapshot.is_current(resource)
+
+    def test_dataset_writes_invalidate(self):
+        # Over a plain pycrunch session, not a ScrunchSession, the dataset
+        # methods writing to it invalidate the snapshot themselves
+        resource = self.resource()
+        resource.session = mock.MagicMock(spec=ElementSession)
+        var_url = self.ds_url + 'variables/001/'
+        resource.variables = mock.MagicMock()
+        resource.variables.self = self.ds_url + 'variables/'
+        resource.variables.index = {var_url: Tuple(
+            resource.session, URL(var_url, ''), alias='age', name='Age',
+            type='numeric', derived=False)}
+        resource.variables.create.return_value = {
+            'self': self.ds_url + 'variables/002/'}
+        resource.session.get.return_value.payload.body = {
+            'alias': 'new', 'name': 'New', 'type': 'numeric'}
+        ds = MutableDataset(resource)
+
+        writes = [
+            lambda: ds.create_numeric('new', 'New', 'age + 1'),
+            lambda: ds['age'].edit(description='Years'),
+            lambda: ds.edit_variables({'age': {'name': 'Years'}}),
+            lambda: ds['age'].hide(),
+            lambda: ds['new'].delete(),
+        ]
+        for write in writes:
+            snapshot = dataset_metadata(resource)
+            write()
+            assert not snapshot.is_current(resource)
+
+        snapshot = dataset_metadata(resource)
+        with ds.batch():
+            ds['age'].edit(description='Age in years')
+            assert snapshot.is_current(resource)
+        assert not snapshot.is_current(resource)
+
+
+class TestSchemaSnapshot(TestCase):
+    ds_url = 'http://host/api/datasets/abc/'
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def snapshot(self):
+        return DatasetMetadata(
+            copy.deepcopy(TABLE_METADATA),
+            version='2020-01-01T00:00:00',
+            catalog={self.ds_url + 'variables/001/': {
+                'alias': 'gender', 'name': 'Gender', 'type': 'categorical'}},
+            folders={'public': {'name': 'Public', 'children': ['gender']}},
+            exclusion={'function': '==', 'args': [{'var': 'age'}, {'value': 1}]},
+            dataset={'id': 'abc', 'name': 'Survey', 'url': self.ds_url},
+        )
+
+    def test_roundtrip(self):
+        snapshot = self.snapshot()
+        for name in ('schema.jsonl', 'schema.jsonl.gz'):
+            path = os.path.join(self.path, name)
+            snapshot.dump(path)
+            loaded = DatasetMetadata.load(path)
+            assert loaded.metadata == TABLE_METADATA
+            assert list(loaded.metadata) == sorted(TABLE_METADATA)
+            assert loaded.version == snapshot.version
+            assert loaded.catalog == snapshot.catalog
+            assert loaded.folders == snapshot.folders
+            assert loaded.exclusion == snapshot.exclusion
+            assert loaded.dataset == snapshot.dataset
+            assert loaded.variables == snapshot.variables
+
+        with open(os.path.join(self.path, 'schema.jsonl.gz'), 'rb') as f:
+            assert f.read(2) == b'\x1f\x8b'  # Gzipped
+
+    def test_not_a_snapshot(self):
+        path = os.path.join(self.path, 'other.json')
+        with open(path, 'w') as f:
+            f.write('{"alias": "gender"}\n')
+        with pytest.raises(ValueError):
+            DatasetMetadata.load(path)
+
+    def test_offline(self):
+        path = os.path.join(self.path, 'schema.jsonl')
+        self.snapshot().dump(path)
+        snapshot = DatasetMetadata.load(path)
+
+        expr = process_expr(parse_expr('gender in ["Male"]'), snapshot)
+        assert expr == {
+            'function': 'in', 'args': [{'var': 'gender'}, {'value': [2]}]}
+        expr = process_expr(parse_expr('hobbies_1 == 1'), snapshot)
+        assert expr['args'][0] == {'var': 'hobbies', 'axes': ['hobbies_1']}
+        assert generate_subvariable_codes(
+            snapshot, [{'alias': 'age'}, {'alias': 'hobbies_1'}]) == [
+            'age__1', 'hobbies_1__1']
+
+        other = DatasetMetadata(dict(
+            copy.deepcopy(TABLE_METADATA),
+            **{'003': {'alias': 'age', 'name': 'Age', 'type': 'text'}}))
+        diff = compare_datasets(snapshot, other)
+        assert diff['variables']['by_type'] == ['Age']
+        assert diff['subvariables'] == {}
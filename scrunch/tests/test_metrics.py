@@ -0,0 +1,104 @@
+# coding: utf-8
+
+from unittest import TestCase
+
+import mock
+import requests
+from requests.adapters import HTTPAdapter
+
+import scrunch
+from scrunch import metrics
+from scrunch.metrics import Histogram, Metrics, RequestRecord, endpoint_template
+from scrunch.session import ScrunchSession
+
+
+SITE = 'https://test.crunch.io/api/'
+DS_ID = 'b4d10b49c385aa405756fbbf572649d3'
+
+
+def _send(request, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json'
+    response._content = b'{"element": "shoji:view", "value": 1}'
+    response.request = request
+    response.url = request.url
+    return response
+
+
+class TestMetrics(TestCase):
+
+    def test_endpoint_template(self):
+        assert endpoint_template(
+            SITE + 'datasets/%s/variables/000001/?limit=0' % DS_ID
+        ) == '/api/datasets/{id}/variables/{id}/'
+        assert endpoint_template(
+            SITE + 'datasets/%s/table/' % DS_ID) == '/api/datasets/{id}/table/'
+        assert endpoint_template(
+            SITE + 'progress/123e4567-e89b-12d3-a456-426614174000/'
+        ) == '/api/progress/{id}/'
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 5):
+            histogram.observe(value)
+        assert histogram.bucket_counts == [1, 2, 1]
+        assert histogram.count == 4
+        assert histogram.min == 0.05
+        assert histogram.max == 5
+        assert histogram.quantile(0.5) == 1
+        assert histogram.quantile(1) == 5
+
+    def test_registry(self):
+        registry = Metrics()
+        record = RequestRecord('GET', '/api/', 200, 0.2, 0, 10, SITE)
+        registry.record(record)
+        registry.record(record)
+        assert registry.counters == {('GET', '/api/', 200): 2}
+        assert registry.histograms[('GET', '/api/')].count == 2
+        assert registry.bytes_received == 20
+        assert registry.total_requests == 2
+
+    def test_session_requests_are_recorded(self):
+        session = ScrunchSession(token='abc', site_url=SITE)
+        var_url = SITE + 'datasets/%s/variables/%%06d/' % DS_ID
+        with mock.patch.object(HTTPAdapter, 'send', side_effect=_send):
+            with scrunch.metrics.collect() as summary:
+                for i in range(3):
+                    session.get(var_url % i)
+                session.post(SITE + 'datasets/', data='{"body": {}}')
+        assert len(summary) == 4
+        assert summary.by_endpoint()[0][:3] == (
+            'GET', '/api/datasets/{id}/variables/{id}/', 3)
+        post = summary.records[-1]
+        assert post.status == 200
+        assert post.bytes_sent == len('{"body": {}}')
+        assert post.bytes_received == len(_send(mock.MagicMock()).content)
+        assert summary.report().startswith('4 requests')
+        assert metrics.registry.counters[
+            ('GET', '/api/datasets/{id}/variables/{id}/', 200)] >= 3
+
+    def test_bytes_sent_counts_encoded_text(self):
+        session = ScrunchSession(token='abc', site_url=SITE)
+        body = u'{"name": "Año"}'
+        with mock.patch.object(HTTPAdapter, 'send', side_effect=_send):
+            with metrics.collect() as summary:
+                session.post(SITE + 'datasets/', data=body)
+        assert summary.records[0].bytes_sent == len(body.encode('utf-8'))
+
+    def test_connection_errors_are_recorded(self):
+        session = ScrunchSession(token='abc', site_url=SITE, retry=False)
+        with mock.patch.object(HTTPAdapter, 'send',
+                               side_effect=requests.ConnectionError()):
+            with metrics.collect() as summary:
+                with self.assertRaises(requests.ConnectionError):
+                    session.get(SITE)
+        assert [r.status for r in summary.records] == [None]
+
+    def test_disabled(self):
+        session = ScrunchSession(token='abc', site_url=SITE)
+        with mock.patch.object(metrics, 'enabled', False):
+            with mock.patch.object(HTTPAdapter, 'send', side_effect=_send):
+                with metrics.collect() as summary:
+                    session.get(SITE)
+        assert len(summary) == 0
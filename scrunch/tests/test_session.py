@@ -0,0 +1,471 @@
+# coding: utf-8
+
+import os
+import shutil
+import stat
+import tempfile
+from unittest import TestCase
+
+import mock
+import pytest
+import requests
+from pycrunch.lemonpy import ClientError, ServerError
+from requests.adapters import HTTPAdapter
+from requests.sessions import Session
+
+import scrunch
+from scrunch.cache import DiskCache, HTTPCache, LRUCache
+from scrunch.exceptions import CircuitOpenError
+from scrunch.retry import CircuitBreaker, RetryPolicy, parse_retry_after
+from scrunch.session import ScrunchSession
+
+
+SITE = 'https://test.crunch.io/api/'
+
+
+class TestScrunchSession(TestCase):
+
+    def test_pool_options(self):
+        session = ScrunchSession(token='abc', site_url=SITE, pool_connections=4,
+                                 pool_maxsize=32, pool_block=True)
+        for prefix in ('https://', 'http://'):
+            adapter = session.get_adapter(prefix + 'test.crunch.io')
+            assert adapter._pool_connections == 4
+            assert adapter._pool_maxsize == 32
+            assert adapter._pool_block is True
+        assert session.headers['Connection'] == 'keep-alive'
+
+    def test_keep_alive_disabled(self):
+        session = ScrunchSession(token='abc', site_url=SITE, keep_alive=False)
+        assert session.headers['Connection'] == 'close'
+
+    def test_default_timeout(self):
+        session = ScrunchSession(token='abc', site_url=SITE, timeout=(3, 30))
+        with mock.patch.object(Session, 'send') as mock_send:
+            session.get(SITE)
+            session.get(SITE, timeout=5)
+        assert mock_send.call_args_list[0][1]['timeout'] == (3, 30)
+        assert mock_send.call_args_list[1][1]['timeout'] == 5
+
+    def test_pool_stats(self):
+        session = ScrunchSession(token='abc', site_url=SITE, pool_maxsize=5)
+        assert session.pool_stats() == {}
+        adapter = session.get_adapter(SITE)
+        adapter.poolmanager.connection_from_url(SITE)
+        assert session.pool_stats() == {
+            'https://test.crunch.io:443': {
+                'connections': 0,
+                'requests': 0,
+                'idle': 0,
+                'maxsize': 5,
+            }
+        }
+
+    def test_connect_session_options(self):
+        with mock.patch('scrunch.session._connect') as _connect:
+            _connect.return_value = mock.MagicMock()
+            scrunch.connect(api_key='abc', site_url=SITE, pool_maxsize=20,
+                            timeout=10)
+        kwargs = _connect.call_args[1]
+        assert 'pool_maxsize' not in kwargs
+        session = kwargs['session_class'](token='abc', site_url=SITE)
+        assert isinstance(session, ScrunchSession)
+        assert session.get_adapter(SITE)._pool_maxsize == 20
+        assert session.timeout == 10
+
+    def test_connect_username(self):
+        with mock.patch('scrunch.session._connect') as _connect:
+            scrunch.connect(username='me@example.com', pw='secret', site_url=SITE)
+        kwargs = _connect.call_args[1]
+        assert kwargs['user'] == 'me@example.com'
+        assert 'username' not in kwargs
+
+
+def _response(status_code, headers=None):
+    def make(request, **kwargs):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers or {})
+        response._content = b''
+        response.request = request
+        response.url = request.url
+        return response
+    return make
+
+
+@mock.patch('scrunch.session.time.sleep')
+class TestRetries(TestCase):
+
+    def _session(self, responses, **kwargs):
+        session = ScrunchSession(token='abc', site_url=SITE, **kwargs)
+        send = mock.patch.object(HTTPAdapter, 'send', side_effect=[
+            r if isinstance(r, Exception) else _response(r)(mock.MagicMock(url=SITE))
+            for r in responses
+        ])
+        self.addCleanup(send.stop)
+        self.send = send.start()
+        return session
+
+    def test_retry_safe_methods(self, sleep):
+        session = self._session([503, requests.ConnectionError(), 200])
+        assert session.get(SITE).status_code == 200
+        assert self.send.call_count == 3
+        assert sleep.call_count == 2
+
+    def test_retries_exhausted(self, sleep):
+        session = self._session([503] * 3, retry=RetryPolicy(total=2))
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        assert self.send.call_count == 3
+
+    def test_no_retry_on_client_errors(self, sleep):
+        session = self._session([404])
+        with pytest.raises(ClientError):
+            session.get(SITE)
+        assert self.send.call_count == 1
+
+    def test_custom_statuses(self, sleep):
+        session = self._session([500, 200], retry=RetryPolicy(statuses=[500]))
+        assert session.get(SITE).status_code == 200
+        assert self.send.call_count == 2
+
+        session = self._session([503], retry=RetryPolicy(statuses=[500]))
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        assert self.send.call_count == 1
+
+    def test_unsafe_methods_opt_in(self, sleep):
+        session = self._session([503, 503, 201, 503, 201])
+        with pytest.raises(ServerError):
+            session.post(SITE, data='{}')
+        assert self.send.call_count == 1
+
+        assert session.post(SITE, data='{}', retry=True).status_code == 201
+        assert self.send.call_count == 3
+
+        with session.retrying():
+            assert session.post(SITE, data='{}').status_code == 201
+        assert self.send.call_count == 5
+
+    def test_retry_disabled(self, sleep):
+        session = self._session([503], retry=False)
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        assert self.send.call_count == 1
+
+    def test_retry_after(self, sleep):
+        session = ScrunchSession(token='abc', site_url=SITE)
+        with mock.patch.object(HTTPAdapter, 'send', side_effect=[
+                _response(429, {'Retry-After': '7'})(mock.MagicMock(url=SITE)),
+                _response(200)(mock.MagicMock(url=SITE))]):
+            session.get(SITE)
+        sleep.assert_called_once_with(7.0)
+
+    def test_circuit_breaker(self, sleep):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        session = self._session([503, 503, 200], retry=False,
+                                circuit_breaker=breaker)
+        for _ in range(2):
+            with pytest.raises(ServerError):
+                session.get(SITE)
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            session.get(SITE)
+        assert self.send.call_count == 2
+
+        # After the reset timeout a trial request closes the circuit
+        breaker.opened_at -= 30
+        assert session.get(SITE).status_code == 200
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_circuit_breaker_counts_server_errors(self, sleep):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        session = self._session([503, 500, 500, 200], retry=False,
+                                circuit_breaker=breaker)
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        # Not retryable, still a failure rather than a success
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # A failed trial request opens the circuit again
+        breaker.opened_at -= 30
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            session.get(SITE)
+        assert self.send.call_count == 3
+
+    def test_circuit_breaker_ignores_client_errors(self, sleep):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        session = self._session([503, 404, 503, 404, 200], retry=False,
+                                circuit_breaker=breaker)
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        with pytest.raises(ClientError):
+            session.get(SITE)
+        assert breaker.failures == 1
+        with pytest.raises(ServerError):
+            session.get(SITE)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # A client error on the trial request keeps the circuit open
+        breaker.opened_at -= 30
+        with pytest.raises(ClientError):
+            session.get(SITE)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert session.get(SITE).status_code == 200
+        assert breaker.state == CircuitBreaker.CLOSED
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff_factor=1, max_backoff=5)
+        for attempt in range(6):
+            assert 0 <= policy.backoff(attempt) <= min(5, 2 ** attempt)
+
+    def test_parse_retry_after(self):
+        assert parse_retry_after('12') == 12.0
+        assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+        assert parse_retry_after('soon') is None
+        assert parse_retry_after(None) is None
+
+
+class TestFeatureFlags(TestCase):
+
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        env = mock.patch.dict(os.environ, {'SCRUNCH_CACHE_DIR': self.cache_path})
+        env.start()
+        self.addCleanup(env.stop)
+        self.addCleanup(shutil.rmtree, self.cache_path)
+
+    def _session(self):
+        session = ScrunchSession(token='abc', site_url=SITE)
+        session.site_root = mock.MagicMock()
+        session.site_root.follow.return_value.value = {'active': True}
+        return session
+
+    def test_connect_does_not_fetch_flags(self):
+        with mock.patch('scrunch.session._connect'):
+            site = scrunch.connect(api_key='abc', site_url=SITE)
+        assert not site.follow.called
+        assert site.session.site_root is site
+
+    def test_lazy_and_cached_on_disk(self):
+        session = self._session()
+        assert session.feature_flags == {'clients_strict_subvariable_syntax': True}
+        session.site_root.follow.assert_called_once_with(
+            'feature_flag', 'feature_name=clients_strict_subvariable_syntax')
+        # Read once per session
+        session.feature_flags
+        assert session.site_root.follow.call_count == 1
+
+        # A new session on the same site finds them on disk
+        other = self._session()
+        assert other.feature_flags == {'clients_strict_subvariable_syntax': True}
+        assert not other.site_root.follow.called
+
+    def test_flags_can_be_set(self):
+        session = self._session()
+        session.feature_flags = {}
+        assert session.feature_flags == {}
+        assert not session.site_root.follow.called
+
+
+class TestDiskCache(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_get_set(self):
+        cache = DiskCache('things', ttl=60, path=self.path)
+        assert cache.get('key') is None
+        cache.set('key', {'a': 1})
+        assert cache.get('key') == {'a': 1}
+        assert DiskCache('others', ttl=60, path=self.path).get('key') is None
+        cache.delete('key')
+        assert cache.get('key') is None
+
+    def test_file_permissions(self):
+        cache = DiskCache('things', ttl=60, path=self.path)
+        cache.set('key', 'value')
+        file_paths = [cache._file('key'), cache._file('key', '.key')]
+        for file_path in file_paths:
+            assert stat.S_IMODE(os.stat(file_path).st_mode) == 0o600
+        assert sorted(os.listdir(cache.path)) == sorted(
+            os.path.basename(file_path) for file_path in file_paths)
+
+    def test_expired(self):
+        cache = DiskCache('things', ttl=60, path=self.path)
+        cache.set('key', 'value')
+        with mock.patch('scrunch.cache.time.time', return_value=1e12):
+            assert cache.get('key') is None
+
+    def test_delete_prefix_and_clear(self):
+        cache = DiskCache('things', ttl=60, path=self.path)
+        for key in ('http://a/1/', 'http://a/1/?limit=0', 'http://a/2/'):
+            cache.set(key, 'value')
+        cache.delete_prefix('http://a/1/')
+        assert cache.get('http://a/1/') is None
+        assert cache.get('http://a/1/?limit=0') is None
+        assert cache.get('http://a/2/') == 'value'
+        cache.clear()
+        assert os.listdir(cache.path) == []
+
+    def test_delete_prefix_reads_keys_only(self):
+        cache = DiskCache('things', ttl=60, path=self.path)
+        for key in ('http://a/1/', 'http://a/2/'):
+            cache.set(key, 'value')
+        # An entry without its key file can't be matched, so it goes
+        os.remove(cache._file('http://a/2/', '.key'))
+        opened = []
+        real_open = open
+
+        def _open(file_path, *args, **kwargs):
+            opened.append(file_path)
+            return real_open(file_path, *args, **kwargs)
+
+        with mock.patch('scrunch.cache.open', _open, create=True):
+            cache.delete_prefix('http://a/3/')
+        assert opened == [cache._file('http://a/1/', '.key')]
+        assert cache.get('http://a/1/') == 'value'
+        assert cache.get('http://a/2/') is None
+
+    def test_disabled(self):
+        cache = DiskCache('things', ttl=0, path=self.path)
+        cache.set('key', 'value')
+        assert cache.get('key') is None
+        assert not os.path.exists(cache.path)
+
+
+class TestHTTPCache(TestCase):
+
+    def setUp(self):
+        self.responses = []
+        self.requests = []
+        send = mock.patch.object(HTTPAdapter, 'send', side_effect=self._send)
+        send.start()
+        self.addCleanup(send.stop)
+
+    def _send(self, request, **kwargs):
+        self.requests.append(dict(request.headers))
+        status, headers, content = self.responses.pop(0)
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = content
+        response.request = request
+        response.url = request.url
+        return response
+
+    def test_conditional_get(self):
+        session = ScrunchSession(token='abc', site_url=SITE, http_cache=True)
+        headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+        body = b'{"element": "shoji:entity", "body": {"name": "ds"}}'
+        self.responses = [(200, headers, body), (304, {'ETag': '"v1"'}, b'')]
+
+        first = session.get(SITE + 'datasets/abc/')
+        assert 'If-None-Match' not in self.requests[0]
+        second = session.get(SITE + 'datasets/abc/')
+        assert self.requests[1]['If-None-Match'] == '"v1"'
+        assert second.status_code == 200
+        assert second.from_cache is True
+        assert second.payload.body.name == 'ds'
+        assert second.content == first.content
+        assert session.http_cache.hits == 1
+
+    def test_mutations_are_not_cached(self):
+        session = ScrunchSession(token='abc', site_url=SITE, http_cache=True)
+        url = SITE + 'datasets/abc/'
+        headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+        self.responses = [
+            (200, headers, b'{}'), (204, headers, b''),
+            (200, dict(headers, ETag='"v2"'), b'{}'),
+        ]
+        session.get(url)
+        session.patch(url, data='{}')
+        assert 'If-None-Match' not in self.requests[1]
+        # The PATCH dropped the cached entry
+        session.get(url)
+        assert 'If-None-Match' not in self.requests[2]
+        assert session.http_cache.get(url).validators == {'If-None-Match': '"v2"'}
+
+    def test_no_validators_not_cached(self):
+        session = ScrunchSession(token='abc', site_url=SITE, http_cache=True)
+        self.responses = [(200, {}, b''), (200, {}, b'')]
+        session.get(SITE)
+        session.get(SITE)
+        assert 'If-None-Match' not in self.requests[1]
+        assert len(session.http_cache.memory) == 0
+
+    def test_disk_tier(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        url = SITE + 'datasets/abc/'
+        HTTPCache(disk_ttl=60, path=path).set(url, self._send_response(
+            200, {'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}, b'{}'))
+
+        # A new process finds the response on disk
+        cache = HTTPCache(disk_ttl=60, path=path)
+        assert cache.get(url).content == b'{}'
+        assert cache.get(url).validators == {
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+
+    def test_disk_tier_invalidated(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        url = SITE + 'datasets/abc/'
+        headers = {'ETag': '"v1"'}
+        cache = HTTPCache(disk_ttl=60, path=path)
+        cache.set(url + 'table/?limit=0',
+                  self._send_response(200, headers, b'{}'))
+        cache.set(SITE + 'datasets/', self._send_response(200, headers, b'{}'))
+
+        # A write to the dataset drops what's under it from both tiers
+        cache.invalidate(url)
+        assert cache.get(url + 'table/?limit=0') is None
+        other = HTTPCache(disk_ttl=60, path=path)
+        assert other.get(url + 'table/?limit=0') is None
+        assert other.get(SITE + 'datasets/') is not None
+
+        cache.clear()
+        assert HTTPCache(disk_ttl=60, path=path).get(SITE + 'datasets/') is None
+
+    def _send_response(self, status, headers, content):
+        self.responses.append((status, headers, content))
+        return self._send(requests.Request('GET', SITE).prepare())
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction_by_size(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.get('a')  # 'b' becomes the least recently used
+        cache.set('c', 'x' * 4)
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+        assert cache.size == 8
+        cache.set('big', 'x' * 11)
+        assert 'big' not in cache
+
+    def test_resize(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.set(key, key)
+        cache.resize(1)
+        assert len(cache) == 1 and 'c' in cache
+        assert cache.size == 1
+
+    def test_delete_prefix(self):
+        cache = LRUCache(10)
+        cache.set('/ds/1/', 1)
+        cache.set('/ds/1/variables/', 2)
+        cache.set('/ds/2/', 3)
+        cache.delete_prefix('/ds/1/')
+        assert len(cache) == 1
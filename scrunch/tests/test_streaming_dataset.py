@@ -0,0 +1,303 @@
+# coding: utf-8
+
+import json
+import threading
+from unittest import TestCase
+
+import pytest
+import mock
+from mock import MagicMock
+from six.moves import queue
+
+try:
+    import numpy
+    import pandas
+except ImportError:
+    # pandas is not installed
+    numpy = pandas = None
+
+from scrunch.streaming_dataset import (StreamingDataset, StreamAck,
+                                       StreamingWriter, columnar_ldjson,
+                                       is_columnar, ldjson_batches)
+from scrunch.tests.test_datasets import TestDatasetBase
+
+
+class TestStreamRows(TestDatasetBase, TestCase):
+
+    def _streaming_dataset(self):
+        ds_mock = self._dataset_mock()
+        ds_mock.session.post.return_value = MagicMock(status_code=204)
+        return StreamingDataset(ds_mock)
+
+    def test_ldjson_batches_by_count(self):
+        lines = ['{"a": %d}' % i for i in range(5)]
+        batches = list(ldjson_batches(lines, batch_size=2))
+        assert batches == [lines[0:2], lines[2:4], lines[4:]]
+
+    def test_ldjson_batches_by_size(self):
+        lines = ['x' * 9, 'y' * 9, 'z' * 9]
+        # Each line takes 10 bytes with its separator
+        batches = list(ldjson_batches(lines, batch_size=10, max_batch_bytes=25))
+        assert batches == [lines[0:2], lines[2:]]
+
+        # A line bigger than the limit still goes on its own
+        batches = list(ldjson_batches(lines, batch_size=10, max_batch_bytes=5))
+        assert batches == [[line] for line in lines]
+
+    def test_ldjson_batches_invalid_size(self):
+        with self.assertRaises(ValueError):
+            list(ldjson_batches(['{}'], batch_size=0))
+
+    def test_stream_rows_batched(self):
+        ds = self._streaming_dataset()
+        session = ds.resource.session
+        columns = {'var1': [1, 2, 3, 4, 5], 'var2': ['a', 'b', 'c', 'd', 'e']}
+
+        assert ds.stream_rows(columns, batch_size=2) == 5
+        assert session.post.call_count == 3
+        sent_rows = []
+        for call in session.post.call_args_list:
+            assert call[0][0] == ds.resource.fragments.stream
+            sent_rows.extend(
+                json.loads(line) for line in call[1]['data'].split('\n'))
+        assert sent_rows == [
+            {'var1': 1, 'var2': 'a'},
+            {'var1': 2, 'var2': 'b'},
+            {'var1': 3, 'var2': 'c'},
+            {'var1': 4, 'var2': 'd'},
+            {'var1': 5, 'var2': 'e'},
+        ]
+
+    def test_stream_rows_single_request(self):
+        ds = self._streaming_dataset()
+        ds.stream_rows({'var1': list(range(100))})
+        assert ds.resource.session.post.call_count == 1
+
+    def test_stream_batches_acks(self):
+        ds = self._streaming_dataset()
+        rows = [{'var1': i} for i in range(3)]
+        acks = ds.stream_batches(rows, batch_size=2)
+        assert acks == [
+            StreamAck(rows=2, size=len('{"var1": 0}\n{"var1": 1}'), status_code=204),
+            StreamAck(rows=1, size=len('{"var1": 2}'), status_code=204),
+        ]
+
+
+@pytest.mark.skipif(pandas is None, reason='pandas is not installed')
+class TestColumnarStreaming(TestDatasetBase, TestCase):
+
+    def _streaming_dataset(self):
+        ds_mock = self._dataset_mock()
+        ds_mock.session.post.return_value = MagicMock(status_code=204)
+        return StreamingDataset(ds_mock)
+
+    def _sent_rows(self, ds):
+        return [
+            json.loads(line)
+            for call in ds.resource.session.post.call_args_list
+            for line in call[1]['data'].split('\n')
+        ]
+
+    def test_is_columnar(self):
+        assert is_columnar(pandas.DataFrame({'a': [1]}))
+        assert is_columnar({'a': numpy.array([1, 2])})
+        assert is_columnar(numpy.zeros(2, dtype=[('a', 'i8')]))
+        assert not is_columnar({'a': [1, 2]})
+
+    def test_columnar_ldjson(self):
+        frame = pandas.DataFrame({
+            'num': numpy.array([1, 2, 3], dtype=numpy.int64),
+            'float': [1.5, numpy.nan, 0.123456789012],
+            'text': ['a', 'line\nbreak', None],
+        })
+        lines = list(columnar_ldjson(frame, chunk_size=2))
+        assert [json.loads(line) for line in lines] == [
+            {'num': 1, 'float': 1.5, 'text': 'a'},
+            {'num': 2, 'float': None, 'text': 'line\nbreak'},
+            {'num': 3, 'float': 0.123456789012, 'text': None},
+        ]
+
+    def test_stream_dataframe(self):
+        ds = self._streaming_dataset()
+        frame = pandas.DataFrame({'var1': numpy.arange(5), 'var2': list('abcde')})
+        assert ds.stream_rows(frame, batch_size=2) == 5
+        assert ds.resource.session.post.call_count == 3
+        assert self._sent_rows(ds) == [
+            {'var1': i, 'var2': c} for i, c in enumerate('abcde')]
+
+    def test_stream_numpy_columns(self):
+        ds = self._streaming_dataset()
+        columns = {'var1': numpy.array([1, 2]), 'var2': numpy.array([0.5, 1.5])}
+        assert ds.stream_rows(columns) == 2
+        assert self._sent_rows(ds) == [
+            {'var1': 1, 'var2': 0.5}, {'var1': 2, 'var2': 1.5}]
+
+    def test_stream_structured_array(self):
+        ds = self._streaming_dataset()
+        data = numpy.array([(1, 2.5), (2, 3.5)], dtype=[('var1', 'i8'), ('var2', 'f8')])
+        assert ds.stream_rows(data) == 2
+        assert self._sent_rows(ds) == [
+            {'var1': 1, 'var2': 2.5}, {'var1': 2, 'var2': 3.5}]
+
+    def test_stream_arrow_like_table(self):
+        ds = self._streaming_dataset()
+        table = MagicMock(spec=['to_pandas'])
+        table.to_pandas.return_value = pandas.DataFrame({'var1': [1, 2]})
+        assert ds.stream_rows(table) == 2
+        assert self._sent_rows(ds) == [{'var1': 1}, {'var1': 2}]
+
+
+class TestStreamingWriter(TestCase):
+
+    def _dataset(self):
+        dataset = MagicMock()
+        dataset.iter_stream_batches.side_effect = lambda rows, *args: iter([
+            StreamAck(len(rows), 0, 204)])
+        return dataset
+
+    def _streamed_rows(self, dataset):
+        return [
+            row for call in dataset.iter_stream_batches.call_args_list
+            for row in call[0][0]
+        ]
+
+    def test_close_delivers_and_pushes(self):
+        dataset = self._dataset()
+        with StreamingWriter(dataset, batch_size=2) as writer:
+            for i in range(5):
+                writer.write({'var1': i})
+        assert self._streamed_rows(dataset) == [{'var1': i} for i in range(5)]
+        assert writer.rows_streamed == 5
+        assert sum(ack.rows for ack in writer.acks) == 5
+        dataset.push_rows.assert_called_once_with(5)
+
+    def test_flush(self):
+        dataset = self._dataset()
+        writer = StreamingWriter(dataset, flush_interval=60)
+        writer.write({'var1': 1})
+        writer.flush()
+        assert self._streamed_rows(dataset) == [{'var1': 1}]
+        dataset.push_rows.assert_called_once_with(1)
+
+        # Nothing new to push on close
+        writer.close()
+        dataset.push_rows.assert_called_once_with(1)
+        with self.assertRaises(ValueError):
+            writer.write({'var1': 2})
+
+    def test_push_every(self):
+        dataset = self._dataset()
+        with StreamingWriter(dataset, batch_size=2, push_every=2) as writer:
+            for i in range(4):
+                writer.write({'var1': i})
+            writer.flush()
+        assert [c[0][0] for c in dataset.push_rows.call_args_list] == [2, 2]
+
+    def test_worker_error_is_raised(self):
+        dataset = self._dataset()
+        dataset.iter_stream_batches.side_effect = ValueError('bad rows')
+        writer = StreamingWriter(dataset)
+        writer.write({'var1': 1})
+        with self.assertRaises(ValueError):
+            writer.flush()
+        # Sent again on close, failing again
+        with self.assertRaises(ValueError):
+            writer.close()
+
+    def test_failed_rows_sent_again(self):
+        dataset = self._dataset()
+        sent = []
+
+        def stream_batches(rows, *args):
+            # One request per row, the second request fails
+            for row in rows:
+                if len(sent) == 1 and not dataset.failed:
+                    dataset.failed = True
+                    raise ValueError('timeout')
+                sent.append(row)
+                yield StreamAck(1, 0, 204)
+
+        dataset.failed = False
+        dataset.iter_stream_batches.side_effect = stream_batches
+        writer = StreamingWriter(dataset, flush_interval=60)
+        writer.write({'var1': 0})
+        writer.write({'var1': 1})
+        with self.assertRaises(ValueError):
+            writer.flush()
+        # Only the rows that went through are pushed
+        assert writer.rows_streamed == 1
+        dataset.push_rows.assert_called_once_with(1)
+
+        writer.write({'var1': 2})
+        writer.close()
+        assert sent == [{'var1': i} for i in range(3)]
+        assert writer.rows_streamed == 3
+        assert writer.unsent_rows == []
+        dataset.push_rows.assert_called_with(2)
+
+    def test_unsent_rows_kept_on_close(self):
+        dataset = self._dataset()
+        dataset.iter_stream_batches.side_effect = ValueError('down')
+        writer = StreamingWriter(dataset, flush_interval=60)
+        writer.write({'var1': 1})
+        with self.assertRaises(ValueError):
+            writer.close()
+        assert writer.unsent_rows == [{'var1': 1}]
+
+    def test_failed_rows_back_off(self):
+        dataset = self._dataset()
+        dataset.iter_stream_batches.side_effect = ValueError('down')
+        backing_off = threading.Event()
+        policy = MagicMock()
+
+        def backoff(attempt):
+            backing_off.set()
+            return 60
+
+        policy.backoff.side_effect = backoff
+        writer = StreamingWriter(dataset, batch_size=1, max_queue_size=1,
+                                 retry_policy=policy)
+        writer.write({'var1': 1})
+        assert backing_off.wait(1)
+        with self.assertRaises(ValueError):
+            writer.write({'var1': 2})
+
+        # New rows wait in the queue, they don't trigger another attempt
+        writer.write({'var1': 2}, timeout=1)
+        with self.assertRaises(queue.Full):
+            writer.write({'var1': 3}, timeout=0.1)
+        assert dataset.iter_stream_batches.call_count == 1
+        policy.backoff.assert_called_once_with(0)
+
+        # close() doesn't wait for the back off to be over
+        with self.assertRaises(ValueError):
+            writer.close()
+        assert dataset.iter_stream_batches.call_count == 2
+        assert writer.unsent_rows == [{'var1': 1}, {'var1': 2}]
+
+    def test_acks_bounded(self):
+        dataset = self._dataset()
+        with mock.patch.object(StreamingWriter, 'MAX_ACKS', 2):
+            with StreamingWriter(dataset, batch_size=1) as writer:
+                for i in range(5):
+                    writer.write({'var1': i})
+        assert list(writer.acks) == [StreamAck(1, 0, 204)] * 2
+        assert writer.rows_streamed == 5
+
+    def test_backpressure(self):
+        dataset = self._dataset()
+        release = threading.Event()
+
+        def stream_batches(rows, *args):
+            release.wait()
+            return iter([StreamAck(len(rows), 0, 204)])
+
+        dataset.iter_stream_batches.side_effect = stream_batches
+        writer = StreamingWriter(dataset, batch_size=1, max_queue_size=1)
+        writer.write({'var1': 1})  # Taken by the worker, blocked sending
+        writer.write({'var1': 2}, timeout=1)  # Fills the queue
+        with self.assertRaises(queue.Full):
+            writer.write({'var1': 3}, timeout=0.1)
+        release.set()
+        writer.close()
+        assert dataset.iter_stream_batches.call_count == 2
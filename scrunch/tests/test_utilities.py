@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
+import subprocess
+import sys
+
 import pytest
 import mock
 from pycrunch import ClientError, shoji, lemonpy
@@ -22,6 +26,69 @@ def envpatch():
     os.environ['CRUNCH_PASSWORD'] = 'PASSWORD'
 
 
+# Modules that make `import scrunch` slow, only loaded when used
+HEAVY_MODULES = ['requests', 'pycrunch', 'pandas', 'numpy', 'cr.cube',
+                 'scrunch.datasets']
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='Lazy imports need module __getattr__')
+def test_import_is_lazy():
+    code = (
+        'import json, sys\n'
+        'import scrunch\n'
+        'print(json.dumps([m for m in %r if m in sys.modules]))\n'
+        'scrunch.get_dataset\n'
+        'assert "scrunch.datasets" in sys.modules\n'
+    ) % HEAVY_MODULES
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert json.loads(output.decode('utf-8')) == []
+
+
+def _import_times(code):
+    """
+    Cumulative import time, in microseconds, of the top level modules
+    `code` imports, as reported by `python -X importtime`.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.STDOUT)
+    times = {}
+    for line in output.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit() and name[1:2] != ' ':
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='Lazy imports need module __getattr__')
+def test_import_time():
+    # Measured against the modules the package now defers rather than in
+    # absolute terms, so the check holds on slow and noisy CI machines
+    lazy = _import_times('import scrunch')['scrunch']
+    eager = _import_times('import scrunch.datasets')['scrunch.datasets']
+    assert lazy * 2 < eager
+
+
+def test_submodule_attributes():
+    code = (
+        'import scrunch\n'
+        'assert scrunch.streaming_dataset.StreamingDataset\n'
+        'assert scrunch.expressions.parse_expr\n'
+        'assert "session" in dir(scrunch)\n'
+        'try:\n'
+        '    scrunch.not_a_module\n'
+        'except AttributeError:\n'
+        '    pass\n'
+        'else:\n'
+        '    raise AssertionError\n'
+    )
+    subprocess.check_call([sys.executable, '-c', code])
+
+
 def test_variable_url_validation():
     ds_url = 'https://test.crunch.io/api/datasets/b4d10b49c385aa405756fbbf572649d3/'
     assert not validate_variable_url(ds_url)
@@ -124,6 +191,62 @@ class TestUtilities(object):
         scrunch.datasets._get_connection()
         assert connect_mock.mock_calls[0].kwargs == {'username': user, 'pw': pw}
 
+    @pytest.fixture
+    def token_cache_env(self, monkeypatch, tmp_path):
+        monkeypatch.setenv('SCRUNCH_CACHE_DIR', str(tmp_path))
+        monkeypatch.setenv('CRUNCH_TOKEN_CACHE', 'true')
+        monkeypatch.setenv('CRUNCH_URL', 'https://test.crunch.io/api/')
+        monkeypatch.setenv('CRUNCH_USERNAME', 'USERNAME')
+        monkeypatch.setenv('CRUNCH_PASSWORD', 'PASSWORD')
+        monkeypatch.delenv('CRUNCH_API_KEY', raising=False)
+
+    def _logged_in_site(self, token='logintoken'):
+        from requests.cookies import RequestsCookieJar
+        site = mock.MagicMock()
+        site.session.cookies = RequestsCookieJar()
+        site.session.cookies.set('token', token)
+        return site
+
+    @mock.patch('scrunch.connections.connect')
+    def test_get_connection_token_cache(self, connect_mock, token_cache_env):
+        connect_mock.return_value = self._logged_in_site()
+        scrunch.connections._get_connection()
+        assert connect_mock.mock_calls[0].kwargs == {
+            'site_url': 'https://test.crunch.io/api/',
+            'username': 'USERNAME', 'pw': 'PASSWORD'}
+
+        # Another process reuses the token instead of logging in
+        connect_mock.reset_mock()
+        scrunch.connections._get_connection()
+        assert connect_mock.mock_calls[0].kwargs == {
+            'site_url': 'https://test.crunch.io/api/', 'api_key': 'logintoken'}
+
+    @mock.patch('scrunch.connections.connect')
+    def test_get_connection_token_rejected(self, connect_mock, token_cache_env):
+        connect_mock.return_value = self._logged_in_site('expired')
+        scrunch.connections._get_connection()
+
+        connect_mock.reset_mock()
+        connect_mock.side_effect = [
+            ClientError(mock.MagicMock()), self._logged_in_site('fresh')]
+        scrunch.connections._get_connection()
+        assert connect_mock.call_count == 2
+        assert connect_mock.mock_calls[1].kwargs['username'] == 'USERNAME'
+
+        connect_mock.reset_mock()
+        connect_mock.side_effect = None
+        scrunch.connections._get_connection()
+        assert connect_mock.mock_calls[0].kwargs['api_key'] == 'fresh'
+
+    @mock.patch('scrunch.connections.connect')
+    def test_get_connection_token_cache_disabled(self, connect_mock,
+                                                 token_cache_env, monkeypatch):
+        monkeypatch.delenv('CRUNCH_TOKEN_CACHE')
+        connect_mock.return_value = self._logged_in_site()
+        scrunch.connections._get_connection()
+        scrunch.connections._get_connection()
+        assert all('username' in call.kwargs for call in connect_mock.mock_calls)
+
     @mock.patch('pycrunch.session')
     def test_get_dataset(self, root):
         session = root.session
@@ -74,6 +74,7 @@ params = dict(
             # local
         ],
         'pandas': ['pandas'],
+        'streaming': ['ijson>=3.1'],
     },
     setup_requires=[
         'setuptools_scm>=1.15.0,<8',